@@ -1,6 +1,25 @@
 const WS_READY_STATE_OPEN = 1;
 const WS_READY_STATE_CLOSING = 2;
 const CF_FALLBACK_IPS = ['[2a00:1098:2b::1:6815:5881]'];
+// 直连尚无结果时每隔 FALLBACK_STAGGER_MS 提前发起下一个回退连接，回退的握手与直连重叠进行
+const FALLBACK_STAGGER_MS = 200;
+// 记住直连被拒绝（托管在 Cloudflare）的目标主机，之后直接走回退地址；每个 isolate 一份，按最近使用淘汰
+const FALLBACK_CACHE_SIZE = 1024;
+const fallbackHosts = new Map();
+
+// 下行合并：空闲后的首个小块立即发送，突发期间的小块在 COALESCE_DELAY_MS 内合并成一帧
+const COALESCE_MAX_BYTES = 64 * 1024;
+const COALESCE_MIN_CHUNK = 16 * 1024;
+const COALESCE_DELAY_MS = 2;
+// 上行排队上限，超出说明远端长时间不可写，直接断开
+const UPLOAD_HIGH_WATER = 4 * 1024 * 1024;
+
+// 二进制握手：客户端在升级请求中携带 X-ECH-Proto: bin1，Worker 回显表示接受，
+// 随后首个二进制帧为 MAGIC|VERSION|FLAGS|ATYP|ADDR|PORT|首帧数据，旧客户端仍走文本 CONNECT
+const PROTO_HEADER = 'X-ECH-Proto';
+const PROTO_BINARY_V1 = 'bin1';
+const HANDSHAKE_MAGIC = 0xec;
+const HANDSHAKE_VERSION = 0x01;
 
 // 复用 TextEncoder，避免重复创建
 const encoder = new TextEncoder();
@@ -26,7 +45,8 @@ export default {
       const [client, server] = Object.values(new WebSocketPair());
       server.accept();
       
-      handleSession(server).catch(() => safeCloseWebSocket(server));
+      const binaryProto = request.headers.get(PROTO_HEADER) === PROTO_BINARY_V1;
+      handleSession(server, binaryProto).catch(() => safeCloseWebSocket(server));
 
       // 修复 spread 类型错误
       const responseInit = {
@@ -34,9 +54,10 @@ export default {
         webSocket: client
       };
       
-      if (token) {
-        responseInit.headers = { 'Sec-WebSocket-Protocol': token };
-      }
+      const headers = {};
+      if (token) headers['Sec-WebSocket-Protocol'] = token;
+      if (binaryProto) headers[PROTO_HEADER] = PROTO_BINARY_V1;
+      if (token || binaryProto) responseInit.headers = headers;
 
       return new Response(null, responseInit);
       
@@ -46,9 +67,19 @@ export default {
   },
 };
 
-async function handleSession(webSocket) {
+async function handleSession(webSocket, binaryProto) {
   let remoteSocket, remoteWriter, remoteReader;
   let isClosed = false;
+  // 上行队列：消息处理不再逐帧 await，由单个写循环合并写出；
+  // 连接建立前到达的帧（如单独发送的二进制首帧）也在这里排队
+  let uploadQueue = [];
+  let uploadBytes = 0;
+  let uploading = false;
+  // UDP 通道模式：每个二进制帧是一个数据报 ATYP|ADDR|PORT|DATA
+  let udpMode = false;
+  const udpRejected = new Set();
+  // 已收到连接请求（文本或二进制握手），此后的二进制帧都是上行数据
+  let connectStarted = false;
 
   const cleanup = () => {
     if (isClosed) return;
@@ -59,19 +90,93 @@ async function handleSession(webSocket) {
     try { remoteSocket?.close(); } catch {}
     
     remoteWriter = remoteReader = remoteSocket = null;
+    uploadQueue = [];
+    uploadBytes = 0;
     safeCloseWebSocket(webSocket);
   };
 
+  const concatChunks = (chunks, size) => {
+    if (chunks.length === 1) return chunks[0];
+    const out = new Uint8Array(size);
+    let offset = 0;
+    for (const chunk of chunks) {
+      out.set(chunk, offset);
+      offset += chunk.byteLength;
+    }
+    return out;
+  };
+
+  const enqueueUpload = (chunk) => {
+    uploadQueue.push(chunk);
+    uploadBytes += chunk.byteLength;
+    if (uploadBytes > UPLOAD_HIGH_WATER) {
+      throw new Error('上行缓冲超出上限');
+    }
+    if (!uploading) drainUpload();
+  };
+
+  const drainUpload = async () => {
+    uploading = true;
+    try {
+      while (uploadQueue.length && remoteWriter) {
+        const data = concatChunks(uploadQueue, uploadBytes);
+        uploadQueue = [];
+        uploadBytes = 0;
+        await remoteWriter.write(data);
+      }
+    } catch (err) {
+      try { webSocket.send('ERROR:' + err.message); } catch {}
+      cleanup();
+    } finally {
+      uploading = false;
+    }
+  };
+
   const pumpRemoteToWebSocket = async () => {
+    let batch = [];
+    let batchBytes = 0;
+    let timer = null;
+    let lastSend = 0;
+
+    const flush = () => {
+      if (timer) {
+        clearTimeout(timer);
+        timer = null;
+      }
+      if (batchBytes && webSocket.readyState === WS_READY_STATE_OPEN) {
+        webSocket.send(concatChunks(batch, batchBytes));
+        lastSend = Date.now();
+      }
+      batch = [];
+      batchBytes = 0;
+    };
+
     try {
       while (!isClosed && remoteReader) {
         const { done, value } = await remoteReader.read();
         
         if (done) break;
         if (webSocket.readyState !== WS_READY_STATE_OPEN) break;
-        if (value?.byteLength > 0) webSocket.send(value);
+        if (!(value?.byteLength > 0)) continue;
+
+        // 大块数据或空闲后的首个小块（交互式流量）直接发送，不增加延迟
+        if (!batchBytes && (value.byteLength >= COALESCE_MIN_CHUNK ||
+                            Date.now() - lastSend > COALESCE_DELAY_MS)) {
+          webSocket.send(value);
+          lastSend = Date.now();
+          continue;
+        }
+
+        batch.push(value);
+        batchBytes += value.byteLength;
+        if (batchBytes >= COALESCE_MAX_BYTES) {
+          flush();
+        } else if (!timer) {
+          timer = setTimeout(flush, COALESCE_DELAY_MS);
+        }
       }
     } catch {}
+    flush();
     
     if (!isClosed) {
       try { webSocket.send('CLOSE'); } catch {}
@@ -94,50 +199,88 @@ async function handleSession(webSocket) {
     };
   };
 
-  const isCFError = (err) => {
-    const msg = err?.message?.toLowerCase() || '';
-    return msg.includes('proxy request') || 
-           msg.includes('cannot connect') || 
-           msg.includes('cloudflare');
-  };
+  // earlyData 为随握手到达的首帧字节（Uint8Array），可为空
+  const connectToRemote = async (host, port, earlyData) => {
+    connectStarted = true;
+    try {
+      const socket = await openRemoteSocket(host, port);
+      if (isClosed) {
+        // 连接建立期间客户端已断开
+        try { socket.close(); } catch {}
+        return;
+      }
+      remoteSocket = socket;
+      remoteWriter = remoteSocket.writable.getWriter();
+      remoteReader = remoteSocket.readable.getReader();
 
-  const connectToRemote = async (targetAddr, firstFrameData) => {
-    const { host, port } = parseAddress(targetAddr);
-    const attempts = [null, ...CF_FALLBACK_IPS];
+      // 发送首帧数据
+      if (earlyData && earlyData.byteLength > 0) {
+        await remoteWriter.write(earlyData);
+      }
+      if (!uploading) drainUpload();
 
-    for (let i = 0; i < attempts.length; i++) {
-      try {
-        remoteSocket = connect({
-          hostname: attempts[i] || host,
-          port
-        });
+      webSocket.send('CONNECTED');
+      pumpRemoteToWebSocket();
 
-        if (remoteSocket.opened) await remoteSocket.opened;
+    } catch (err) {
+      // 清理失败的连接
+      try { remoteWriter?.releaseLock(); } catch {}
+      try { remoteReader?.releaseLock(); } catch {}
+      try { remoteSocket?.close(); } catch {}
+      remoteWriter = remoteReader = remoteSocket = null;
+      throw err;
+    }
+  };
 
-        remoteWriter = remoteSocket.writable.getWriter();
-        remoteReader = remoteSocket.readable.getReader();
+  // 解析 SOCKS5 风格的 ATYP|ADDR|PORT 地址（UDP 数据报头和二进制握手共用），
+  // 返回目标地址、端口和地址结束位置
+  const parseSocksAddress = (buf, start) => {
+    const atyp = buf[start];
+    let host, offset;
+    if (atyp === 0x01 && buf.length >= start + 7) {
+      host = buf.subarray(start + 1, start + 5).join('.');
+      offset = start + 5;
+    } else if (atyp === 0x03 && buf.length >= start + 2 && buf.length >= start + 4 + buf[start + 1]) {
+      host = new TextDecoder().decode(buf.subarray(start + 2, start + 2 + buf[start + 1]));
+      offset = start + 2 + buf[start + 1];
+    } else if (atyp === 0x04 && buf.length >= start + 19) {
+      const parts = [];
+      for (let i = start + 1; i < start + 17; i += 2) {
+        parts.push(((buf[i] << 8) | buf[i + 1]).toString(16));
+      }
+      host = parts.join(':');
+      offset = start + 17;
+    } else {
+      return null;
+    }
+    return {
+      host,
+      port: (buf[offset] << 8) | buf[offset + 1],
+      headerLen: offset + 2
+    };
+  };
 
-        // 发送首帧数据
-        if (firstFrameData) {
-          await remoteWriter.write(encoder.encode(firstFrameData));
-        }
+  // 处理二进制握手帧，首帧数据直接以字节视图写出，无需文本编解码
+  const handleBinaryConnect = async (buf) => {
+    if (buf.length < 4 || buf[1] !== HANDSHAKE_VERSION) {
+      throw new Error('不支持的握手版本: ' + buf[1]);
+    }
+    const addr = parseSocksAddress(buf, 3);
+    if (!addr) throw new Error('无效的握手地址');
+    await connectToRemote(addr.host, addr.port, buf.subarray(addr.headerLen));
+  };
 
-        webSocket.send('CONNECTED');
-        pumpRemoteToWebSocket();
-        return;
+  // 处理 UDP 通道上的数据报
+  const handleUDPDatagram = (datagram) => {
+    const addr = parseSocksAddress(datagram, 0);
+    if (!addr) return;
 
-      } catch (err) {
-        // 清理失败的连接
-        try { remoteWriter?.releaseLock(); } catch {}
-        try { remoteReader?.releaseLock(); } catch {}
-        try { remoteSocket?.close(); } catch {}
-        remoteWriter = remoteReader = remoteSocket = null;
-
-        // 如果不是 CF 错误或已是最后尝试，抛出错误
-        if (!isCFError(err) || i === attempts.length - 1) {
-          throw err;
-        }
-      }
+    // Workers 运行时只提供 TCP 出站连接，UDP 目标一律拒绝并告知客户端一次；
+    // DNS 查询由客户端经 DoH 应答，不会进入通道
+    const key = addr.host + ':' + addr.port;
+    if (!udpRejected.has(key)) {
+      udpRejected.add(key);
+      try { webSocket.send('ERROR:UDP ' + key + ' 不受支持，Workers 仅支持 TCP 出站'); } catch {}
     }
   };
 
@@ -150,22 +293,30 @@ async function handleSession(webSocket) {
       if (typeof data === 'string') {
         if (data.startsWith('CONNECT:')) {
           const sep = data.indexOf('|', 8);
-          await connectToRemote(
-            data.substring(8, sep),
-            data.substring(sep + 1)
-          );
+          const { host, port } = parseAddress(data.substring(8, sep));
+          const firstFrame = data.substring(sep + 1);
+          await connectToRemote(host, port, firstFrame ? encoder.encode(firstFrame) : null);
         }
         else if (data.startsWith('DATA:')) {
-          if (remoteWriter) {
-            await remoteWriter.write(encoder.encode(data.substring(5)));
-          }
+          enqueueUpload(encoder.encode(data.substring(5)));
+        }
+        else if (data === 'UDP') {
+          udpMode = true;
+          webSocket.send('CONNECTED');
         }
         else if (data === 'CLOSE') {
           cleanup();
         }
       }
-      else if (data instanceof ArrayBuffer && remoteWriter) {
-        await remoteWriter.write(new Uint8Array(data));
+      else if (data instanceof ArrayBuffer) {
+        const buf = new Uint8Array(data);
+        if (udpMode) {
+          handleUDPDatagram(buf);
+        } else if (binaryProto && !connectStarted && buf[0] === HANDSHAKE_MAGIC) {
+          await handleBinaryConnect(buf);
+        } else {
+          enqueueUpload(buf);
+        }
       }
     } catch (err) {
       try { webSocket.send('ERROR:' + err.message); } catch {}
@@ -177,6 +328,96 @@ async function handleSession(webSocket) {
   webSocket.addEventListener('error', cleanup);
 }
 
+function isCFError(err) {
+  const msg = err?.message?.toLowerCase() || '';
+  return msg.includes('proxy request') || 
+         msg.includes('cannot connect') || 
+         msg.includes('cloudflare');
+}
+
+function rememberFallbackHost(host) {
+  fallbackHosts.delete(host);
+  fallbackHosts.set(host, true);
+  if (fallbackHosts.size > FALLBACK_CACHE_SIZE) {
+    fallbackHosts.delete(fallbackHosts.keys().next().value);
+  }
+}
+
+// 打开到目标的 TCP 连接。直连与回退地址错开并行尝试：直连成功即采用；回退连接可能先于直连打开，
+// 但只有直连因目标托管在 Cloudflare 被拒绝后才采用（否则会连到错误的目标），回退之间先成功者胜出。
+// 已知需要回退的主机跳过直连；回退全部失败时将其移出缓存，下次重新直连
+function openRemoteSocket(host, port) {
+  const cached = fallbackHosts.has(host);
+  if (cached) rememberFallbackHost(host);
+  const targets = cached ? CF_FALLBACK_IPS : [host, ...CF_FALLBACK_IPS];
+
+  return new Promise((resolve, reject) => {
+    const sockets = [];
+    let next = 0;
+    let failed = 0;
+    let timer = null;
+    let settled = false;
+    let fallbackAllowed = cached;
+    // 直连尚无结果时最先打开的回退连接
+    let pending = null;
+
+    const finish = (winner, err) => {
+      if (settled) return;
+      settled = true;
+      clearTimeout(timer);
+      for (const socket of sockets) {
+        if (socket !== winner) {
+          try { socket.close(); } catch {}
+        }
+      }
+      winner ? resolve(winner) : reject(err);
+    };
+
+    const onFail = (direct, err) => {
+      if (settled) return;
+      failed++;
+      if (direct) {
+        if (!isCFError(err)) return finish(null, err);
+        if (CF_FALLBACK_IPS.length) rememberFallbackHost(host);
+        fallbackAllowed = true;
+        if (pending) return finish(pending);
+      }
+      if (failed === targets.length) {
+        if (cached) fallbackHosts.delete(host);
+        return finish(null, err);
+      }
+      // 有尝试失败时不再等待错开间隔，立即发起下一个
+      if (next < targets.length) {
+        clearTimeout(timer);
+        launch();
+      }
+    };
+
+    const launch = () => {
+      timer = null;
+      if (settled || next >= targets.length) return;
+      const direct = !cached && next === 0;
+      const hostname = targets[next++];
+      if (next < targets.length) timer = setTimeout(launch, FALLBACK_STAGGER_MS);
+
+      let socket;
+      try {
+        socket = connect({ hostname, port });
+      } catch (err) {
+        return onFail(direct, err);
+      }
+      sockets.push(socket);
+      Promise.resolve(socket.opened).then(() => {
+        if (settled) return;
+        if (direct || fallbackAllowed) finish(socket);
+        else if (!pending) pending = socket;
+      }, (err) => onFail(direct, err));
+    };
+
+    launch();
+  });
+}
+
 function safeCloseWebSocket(ws) {
   try {
     if (ws.readyState === WS_READY_STATE_OPEN || 
@@ -6,4 +6,18 @@ function index()
 	end
 
 	entry({"admin", "services", "ech-wk"}, cbi("ech-wk"), _("ECH Workers Proxy"), 100).dependent = true
+	entry({"admin", "services", "ech-wk", "log_tail"}, call("action_log_tail")).leaf = true
+end
+
+-- 日志页轮询：转发给 rpcd 的 ech-wk.log_tail，按游标只返回新增的行
+function action_log_tail()
+	local http = require "luci.http"
+	local util = require "luci.util"
+
+	local result = util.ubus("ech-wk", "log_tail", {
+		inode = tonumber(http.formvalue("inode")) or 0,
+		offset = tonumber(http.formvalue("offset")) or 0
+	})
+	http.prepare_content("application/json")
+	http.write_json(result or { inode = 0, offset = 0, data = "", reset = true })
 end
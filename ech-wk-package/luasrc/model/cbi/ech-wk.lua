@@ -3,6 +3,40 @@
 
 local sys = require "luci.sys"
 local uci = require "luci.model.uci".cursor()
+local fs = require "nixio.fs"
+local jsonc = require "luci.jsonc"
+local datatypes = require "luci.cbi.datatypes"
+
+-- 各实例每 5 秒写入一次运行统计快照，超过 30 秒未更新视为已退出
+local STATS_GLOB = "/tmp/ech-wk/stats.*.json"
+local STATS_STALE = 30
+
+local function format_bytes(n)
+    local units = { "B", "KB", "MB", "GB", "TB" }
+    local i = 1
+    n = n or 0
+    while n >= 1024 and i < #units do
+        n = n / 1024
+        i = i + 1
+    end
+    return i == 1 and string.format("%d %s", n, units[i]) or string.format("%.1f %s", n, units[i])
+end
+
+-- 读取所有实例的统计快照，按实例序号排序
+local function instance_stats()
+    local list = {}
+    local now = os.time()
+    for path in (fs.glob(STATS_GLOB) or function() end) do
+        local st = jsonc.parse(fs.readfile(path) or "")
+        if type(st) == "table" then
+            st.index = tonumber(path:match("stats%.(%d+)%.json$")) or 0
+            st.stale = now - (st.updated or 0) > STATS_STALE
+            list[#list + 1] = st
+        end
+    end
+    table.sort(list, function(a, b) return a.index < b.index end)
+    return list
+end
 
 m = Map("ech-wk", translate("ECH Workers Proxy"), translate("ECH Workers 代理客户端配置"))
 
@@ -12,10 +46,17 @@ s.anonymous = true
 s.addremove = false
 
 -- 运行状态显示
-local running = (sys.call("pidof ech-wk > /dev/null") == 0)
+local pids = {}
+for pid in sys.exec("pidof ech-wk 2>/dev/null"):gmatch("%d+") do
+    pids[#pids + 1] = pid
+end
+local running = #pids > 0
 local status_text = running and 
     '<span style="color:green;font-weight:bold;">● 运行中</span>' or 
     '<span style="color:red;font-weight:bold;">○ 已停止</span>'
+if #pids > 1 then
+    status_text = status_text .. string.format("（%d 个实例）", #pids)
+end
 
 o = s:option(DummyValue, "_status", translate("运行状态"))
 o.rawhtml = true
@@ -23,6 +64,43 @@ o.cfgvalue = function(self, section)
     return status_text
 end
 
+-- 运行统计：逐个实例列出并汇总
+local stats = instance_stats()
+if #stats > 0 then
+    o = s:option(DummyValue, "_stats", translate("运行统计"))
+    o.rawhtml = true
+    o.cfgvalue = function(self, section)
+        local fields = { "active", "accepted", "tunnels", "direct", "bytes_up", "bytes_down", "failures", "shed" }
+        local total = {}
+        local rows = {}
+        local function row(name, st)
+            return string.format(
+                "<tr><td>%s</td><td>%d</td><td>%d</td><td>%d / %d</td><td>%s</td><td>%s</td><td>%d</td><td>%d</td></tr>",
+                name, st.active or 0, st.accepted or 0, st.tunnels or 0, st.direct or 0,
+                format_bytes(st.bytes_up), format_bytes(st.bytes_down), st.failures or 0, st.shed or 0)
+        end
+        for _, st in ipairs(stats) do
+            local name = string.format("#%d (PID %d)", st.index, st.pid or 0)
+            if st.stale then
+                name = name .. " " .. translate("未响应")
+            end
+            rows[#rows + 1] = row(name, st)
+            for _, f in ipairs(fields) do
+                total[f] = (total[f] or 0) + (st[f] or 0)
+            end
+        end
+        if #stats > 1 then
+            rows[#rows + 1] = row("<b>" .. translate("合计") .. "</b>", total)
+        end
+        return '<table class="table"><tr class="tr table-titles">' ..
+            "<th>" .. translate("实例") .. "</th><th>" .. translate("活动连接") .. "</th><th>" ..
+            translate("已接受") .. "</th><th>" .. translate("隧道 / 直连") .. "</th><th>" ..
+            translate("上行") .. "</th><th>" .. translate("下行") .. "</th><th>" ..
+            translate("失败") .. "</th><th>" .. translate("拒绝") .. "</th></tr>" ..
+            table.concat(rows) .. "</table>"
+    end
+end
+
 -- 启用开关
 o = s:option(Flag, "enabled", translate("启用服务"))
 o.rmempty = false
@@ -70,7 +148,7 @@ adv.anonymous = true
 adv.addremove = false
 
 o = adv:option(Value, "server_ip", translate("优选IP/域名"),
-    translate("指定服务器IP以绕过DNS解析"))
+    translate("指定服务器IP以绕过DNS解析，可填写多个（逗号分隔），连接时并行择优"))
 o.rmempty = true
 o.placeholder = "例如: saas.sin.fan"
 
@@ -82,35 +160,112 @@ o = adv:option(Value, "ech_domain", translate("ECH域名"))
 o.default = "cloudflare-ech.com"
 o.placeholder = "cloudflare-ech.com"
 
+o = adv:option(Value, "max_conns", translate("最大连接数"),
+    translate("超出后新连接被快速拒绝（SOCKS5 一般性失败 / HTTP 503），0 表示不限制"))
+o.datatype = "uinteger"
+o.default = "4096"
+o.placeholder = "4096"
+
+o = adv:option(Value, "max_conns_per_client", translate("单客户端连接数"),
+    translate("单个局域网设备的最大并发连接数，0 表示不限制"))
+o.datatype = "uinteger"
+o.default = "0"
+o.placeholder = "0"
+
+o = adv:option(Value, "max_dials", translate("并发握手数"),
+    translate("同时向 Workers 发起的连接数，超出的请求排队等待"))
+o.datatype = "uinteger"
+o.default = "64"
+o.placeholder = "64"
+
+o = adv:option(Value, "instances", translate("进程实例数"),
+    translate("多核路由器上启动多个进程，经 SO_REUSEPORT 共享监听端口；0 表示按 CPU 核数。连接数限制按每个实例计算"))
+o.datatype = "uinteger"
+o.default = "1"
+o.placeholder = "1"
+
+o = adv:option(Value, "log_max_kb", translate("日志大小上限 (KB)"),
+    translate("/tmp/ech-wk.log 与轮转文件 .1 合计的大小上限，日志保存在内存中"))
+o.datatype = "uinteger"
+o.default = "512"
+o.placeholder = "512"
+
+o = adv:option(Value, "metrics_addr", translate("指标监听地址"),
+    translate("Prometheus 指标接口，如 127.0.0.1:9464，访问 /metrics；留空不启用。多实例时端口按实例序号递增"))
+o.placeholder = "127.0.0.1:9464"
+
 -- ========== 分流设置 ==========
 routing = m:section(NamedSection, "general", "ech-wk", translate("分流设置"))
 routing.anonymous = true
 routing.addremove = false
 
-o = routing:option(ListValue, "proxy_mode", translate("代理模式"))
+o = routing:option(ListValue, "proxy_mode", translate("代理模式"),
+    translate("跳过中国大陆时由代理进程按域名后缀和 /etc/ech-wk/chn_ip.txt 中的 IP 段直连"))
 o:value("global", translate("全局代理"))
 o:value("bypass_cn", translate("跳过中国大陆"))
 o:value("gfwlist", translate("仅代理被墙站点"))
 o:value("direct", translate("直连（不代理）"))
 o.default = "bypass_cn"
 
+o = routing:option(DynamicList, "rule", translate("策略规则"),
+    translate("每条 \"类型,值,目标\"：类型为 DOMAIN-SUFFIX 或 IP-CIDR，目标为服务器名称、DIRECT（直连）或 PROXY（当前服务器）。" ..
+        "域名取最长后缀匹配，IP 段重叠时靠前的优先；规则优先于代理模式"))
+o.placeholder = "DOMAIN-SUFFIX,youtube.com,视频节点"
+o.rmempty = true
+o.validate = function(self, value, section)
+    local kind, val, target = value:match("^%s*([%w%-]+)%s*,%s*([^,]-)%s*,%s*([^,]-)%s*$")
+    if not kind or val == "" or target == "" then
+        return nil, translate("规则格式应为 \"类型,值,目标\"")
+    end
+    kind = kind:upper()
+    if kind == "IP-CIDR" then
+        if not datatypes.cidr4(val) and not datatypes.ip4addr(val) then
+            return nil, translate("无效的 IPv4 CIDR") .. ": " .. val
+        end
+    elseif kind ~= "DOMAIN-SUFFIX" then
+        return nil, translate("规则类型仅支持 DOMAIN-SUFFIX、IP-CIDR")
+    end
+    return value
+end
+
+o = routing:option(Flag, "transparent", translate("透明代理"),
+    translate("用 nftables TPROXY 接管局域网设备的 TCP 流量，设备无需设置代理；跳过中国大陆时大陆 IP 由内核直接放行"))
+o.rmempty = false
+
+o = routing:option(Value, "tproxy_port", translate("透明代理端口"))
+o.datatype = "port"
+o.default = "30001"
+o.placeholder = "30001"
+o:depends("transparent", "1")
+
+o = routing:option(Value, "lan_ifname", translate("局域网接口"))
+o.default = "br-lan"
+o.placeholder = "br-lan"
+o:depends("transparent", "1")
+
+o = routing:option(Button, "_update_cn", translate("中国大陆 IP 列表"),
+    translate("下载最新列表；透明代理运行中时只增量更新 nftables 集合"))
+o.inputtitle = translate("立即更新")
+o.inputstyle = "apply"
+o.write = function(self, section)
+    sys.call("/etc/init.d/ech-wk update_cn >/dev/null 2>&1")
+end
+
 -- ========== 运行日志 ==========
 log = m:section(TypedSection, "ech-wk", translate("运行日志"))
 log.anonymous = true
 log.addremove = false
 
-o = log:option(TextValue, "_log")
-o.rows = 15
-o.readonly = true
-o.cfgvalue = function(self, section)
-    local log_content = sys.exec("tail -n 50 /tmp/ech-wk.log 2>/dev/null || echo '暂无日志'")
-    return log_content
-end
+-- 由页面脚本经 rpcd 按字节偏移增量拉取，渲染页面时不再读取日志
+o = log:option(DummyValue, "_log")
+o.template = "ech-wk/log_view"
 
 o = log:option(Button, "_clear_log", translate("清空日志"))
 o.inputstyle = "remove"
 o.write = function(self, section)
-    sys.exec("echo '' > /tmp/ech-wk.log")
+    -- 截断而不是删除：代理进程仍以追加方式写着这个文件
+    fs.writefile("/tmp/ech-wk.log", "")
+    fs.remove("/tmp/ech-wk.log.1")
 end
 
 return m
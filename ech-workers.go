@@ -3,23 +3,37 @@ package main
 import (
 	"bufio"
 	"bytes"
+	"container/heap"
 	"context"
+	"crypto/sha256"
 	"crypto/tls"
 	"crypto/x509"
 	"encoding/base64"
 	"encoding/binary"
+	"encoding/hex"
+	"encoding/json"
 	"errors"
 	"flag"
 	"fmt"
 	"io"
 	"log"
+	"math/bits"
 	"net"
 	"net/http"
+	"net/http/httputil"
 	"net/url"
+	"os"
+	"os/signal"
+	"path/filepath"
 	"reflect"
+	"sort"
+	"strconv"
 	"strings"
 	"sync"
+	"sync/atomic"
+	"syscall"
 	"time"
+	"unicode/utf8"
 
 	"github.com/gorilla/websocket"
 )
@@ -27,41 +41,319 @@ import (
 // ======================== 全局参数 ========================
 
 var (
-	listenAddr string
-	serverAddr string
-	serverIP   string
-	token      string
-	dnsServer  string
-	echDomain  string
+	listenAddr   string
+	serverAddr   string
+	serverIP     string
+	token        string
+	dnsServer    string
+	echDomain    string
+	routeMode    string
+	cnIPFile     string
+	confFile     string
+	metricsAddr  string
+	echCacheFile string
+	tlsCacheFile string
+	tproxyAddr   string
+	reusePort    bool
+	statsFile    string
+	logFile      string
+	logMaxKB     int
+
+	nftGenFile    string
+	nftUpdateFrom string
+	nftIface      string
+	nftMark       int
+
+	maxConns          int
+	maxConnsPerClient int
+	maxPendingDials   int
 
 	echListMu sync.RWMutex
 	echList   []byte
 )
 
 func init() {
-	flag.StringVar(&listenAddr, "l", "127.0.0.1:30000", "代理监听地址 (支持 SOCKS5 和 HTTP)")
+	flag.StringVar(&listenAddr, "l", "127.0.0.1:30000", "代理监听地址 (支持 SOCKS5 和 HTTP)；SOCKS5 UDP 只转发 DNS 和直连目标，需经服务端的其他 UDP 会被拒绝（QUIC、游戏等不可用）")
 	flag.StringVar(&serverAddr, "f", "", "服务端地址 (格式: x.x.workers.dev:443)")
-	flag.StringVar(&serverIP, "ip", "", "指定服务端 IP（绕过 DNS 解析）")
+	flag.StringVar(&serverIP, "ip", "", "指定服务端 IP（绕过 DNS 解析），多个用逗号分隔，并行择优连接")
 	flag.StringVar(&token, "token", "", "身份验证令牌")
 	flag.StringVar(&dnsServer, "dns", "dns.alidns.com/dns-query", "ECH 查询 DoH 服务器")
 	flag.StringVar(&echDomain, "ech", "cloudflare-ech.com", "ECH 查询域名")
+	flag.StringVar(&echCacheFile, "ech-cache", "", "ECH 配置缓存文件，启动时直接使用并在后台重新验证（为空则不缓存）")
+	flag.StringVar(&tlsCacheFile, "tls-cache", "", "TLS 会话票据缓存文件，重启后仍可复用会话（为空则只缓存在内存中）")
+	flag.IntVar(&maxConns, "max-conns", 4096, "最大并发连接数 (0 表示不限制)")
+	flag.IntVar(&maxConnsPerClient, "max-conns-per-client", 0, "单个客户端 IP 的最大并发连接数 (0 表示不限制)")
+	flag.IntVar(&maxPendingDials, "max-dials", 64, "同时进行的服务端握手数，超出的连接排队等待 (0 表示不限制)")
+	flag.StringVar(&routeMode, "routing", "global", "分流模式: global 全部经服务端 / bypass_cn 中国大陆直连 / direct 全部直连")
+	flag.StringVar(&cnIPFile, "cn-ip-list", "", "中国大陆 IP 列表文件（每行 \"起始IP 结束IP\" 或 CIDR），用于 bypass_cn")
+	flag.StringVar(&confFile, "conf", "", "可热加载的配置文件（JSON，键: server token ip dns ech routing cn_ip_list），覆盖同名命令行参数；收到 SIGHUP 或 POST /reload 时重新读取")
+	flag.StringVar(&tproxyAddr, "tproxy", "", "透明代理监听地址，如 :30001（Linux TPROXY，配合 -nft-gen 生成的规则使用；为空则不启用）")
+	flag.StringVar(&nftGenFile, "nft-gen", "", "按 -routing、-cn-ip-list 和 -tproxy 生成 nftables 透明代理规则文件后退出")
+	flag.StringVar(&nftUpdateFrom, "nft-update", "", "与 -nft-gen 一起使用：只生成从该 IP 列表文件到 -cn-ip-list 的集合增量")
+	flag.StringVar(&nftIface, "nft-iif", "br-lan", "透明代理接管的入接口")
+	flag.IntVar(&nftMark, "nft-mark", 0x1e, "透明代理数据包的防火墙标记，需与策略路由的 fwmark 一致")
+	flag.BoolVar(&reusePort, "reuseport", false, "监听套接字开启 SO_REUSEPORT，多个进程共享同一端口，由内核分发连接（仅 Linux）")
+	flag.StringVar(&statsFile, "stats-file", "", "定期写入运行统计快照（JSON）的文件，供 LuCI 汇总多个实例（为空则不写）")
+	flag.StringVar(&logFile, "log-file", "", "日志文件（为空则输出到标准错误）；超过上限时轮转为 .1，只保留两个文件")
+	flag.IntVar(&logMaxKB, "log-max-kb", 512, "日志文件与其 .1 轮转文件合计的大小上限（KB）")
+	flag.StringVar(&metricsAddr, "metrics", "", "Prometheus 指标监听地址，如 127.0.0.1:9464（为空则不启用）；POST /reload 只接受本机发起的请求")
 }
 
 func main() {
 	flag.Parse()
 
-	if serverAddr == "" {
+	if nftGenFile != "" {
+		if err := generateNftables(nftGenFile); err != nil {
+			log.Fatalf("[透明代理] 生成 nftables 规则失败: %v", err)
+		}
+		return
+	}
+
+	if logFile != "" {
+		rl, err := openRingLog(logFile, int64(logMaxKB)*1024)
+		if err != nil {
+			log.Fatalf("[启动] 打开日志文件失败: %v", err)
+		}
+		log.SetOutput(rl)
+	}
+
+	s, err := loadSettings()
+	if err != nil {
+		log.Fatalf("[启动] 读取配置失败: %v", err)
+	}
+	if s.Server == "" {
 		log.Fatal("必须指定服务端地址 -f\n\n示例:\n  ./client -l 127.0.0.1:1080 -f your-worker.workers.dev:443 -token your-token")
 	}
+	table, err := loadRouteTable(s)
+	if err != nil {
+		log.Fatalf("[启动] 加载分流规则失败: %v", err)
+	}
+	settings.Store(s)
+	routes.Store(table)
+	go watchReload()
+
+	if metricsAddr != "" {
+		go serveMetrics(metricsAddr)
+	}
+	if statsFile != "" {
+		go writeStatsLoop(statsFile)
+	}
+
+	if tlsCacheFile != "" {
+		tlsSessions.load(tlsCacheFile)
+	}
 
-	log.Printf("[启动] 正在获取 ECH 配置...")
-	if err := prepareECH(); err != nil {
-		log.Fatalf("[启动] 获取 ECH 配置失败: %v", err)
+	// 有可用的磁盘缓存时直接用它开始监听，不等待 DoH
+	expires, cached := loadECHCache()
+	if !cached {
+		log.Printf("[启动] 正在获取 ECH 配置...")
+		if err := prepareECH(s); err != nil {
+			log.Fatalf("[启动] 获取 ECH 配置失败: %v", err)
+		}
+		expires = time.Unix(0, echExpires.Load())
+	}
+	if echCacheFile != "" {
+		go revalidateECH(expires)
 	}
 
 	runProxyServer(listenAddr)
 }
 
+// ======================== 日志文件 ========================
+
+// ringLog 大小受限的追加日志：当前文件超过上限的一半时改名为 path.1（覆盖旧的 .1）再新建，
+// 两个文件合计不超过上限，tmpfs 上的日志不会无限增长。
+// 多个实例可以写同一个文件：大小按文件实际长度判断，只有仍持有 path 当前文件的进程才执行改名，
+// 其余进程发现文件已被轮转后直接重新打开
+type ringLog struct {
+	mu   sync.Mutex
+	path string
+	half int64
+	f    *os.File
+}
+
+func openRingLog(path string, max int64) (*ringLog, error) {
+	l := &ringLog{path: path, half: max / 2}
+	if err := l.reopen(); err != nil {
+		return nil, err
+	}
+	return l, nil
+}
+
+func (l *ringLog) reopen() error {
+	if err := os.MkdirAll(filepath.Dir(l.path), 0755); err != nil {
+		return err
+	}
+	f, err := os.OpenFile(l.path, os.O_WRONLY|os.O_APPEND|os.O_CREATE, 0644)
+	if err != nil {
+		return err
+	}
+	if l.f != nil {
+		l.f.Close()
+	}
+	l.f = f
+	return nil
+}
+
+func (l *ringLog) Write(p []byte) (int, error) {
+	l.mu.Lock()
+	defer l.mu.Unlock()
+
+	if fi, err := l.f.Stat(); err == nil && fi.Size()+int64(len(p)) > l.half {
+		l.rotate(fi)
+	}
+	return l.f.Write(p)
+}
+
+// rotate 轮转日志；fi 为当前持有文件的状态
+func (l *ringLog) rotate(fi os.FileInfo) {
+	if cur, err := os.Stat(l.path); err == nil && os.SameFile(cur, fi) {
+		os.Rename(l.path, l.path+".1")
+	}
+	// 轮转失败时继续写原文件，不丢日志
+	l.reopen()
+}
+
+// ======================== 配置热加载 ========================
+
+// proxySettings 可在运行中重新加载的参数。新连接读取当前快照，
+// 已建立的隧道、ECH/TLS 会话缓存和边缘节点统计都不受重新加载影响
+type proxySettings struct {
+	Server   string `json:"server"`
+	Token    string `json:"token"`
+	IP       string `json:"ip"`
+	DNS      string `json:"dns"`
+	ECH      string `json:"ech"`
+	Routing  string `json:"routing"`
+	CNIPList string `json:"cn_ip_list"`
+
+	// 策略路由（仅 -conf）：Name 为默认服务端在日志和指标中的名称，
+	// Upstreams 为其他命名服务端，Rules 把域名后缀和 IP 段分配给它们或直连（见 parsePolicyRule）
+	Name      string           `json:"name"`
+	Upstreams []upstreamConfig `json:"upstreams"`
+	Rules     []string         `json:"rules"`
+}
+
+var (
+	settings atomic.Pointer[proxySettings]
+	reloadMu sync.Mutex
+)
+
+// loadSettings 以命令行参数为基础，叠加 -conf 文件中出现的字段（出现但为空的字段同样覆盖）
+func loadSettings() (*proxySettings, error) {
+	s := &proxySettings{
+		Server:   serverAddr,
+		Token:    token,
+		IP:       serverIP,
+		DNS:      dnsServer,
+		ECH:      echDomain,
+		Routing:  routeMode,
+		CNIPList: cnIPFile,
+	}
+	if confFile == "" {
+		return s, nil
+	}
+	data, err := os.ReadFile(confFile)
+	if err != nil {
+		return nil, err
+	}
+	if err := json.Unmarshal(data, s); err != nil {
+		return nil, fmt.Errorf("解析 %s 失败: %w", confFile, err)
+	}
+	return s, nil
+}
+
+// reloadSettings 重新读取 -conf 并替换当前配置；任何一步失败都保留原配置。
+// 只有查询域名或 DoH 服务器变化时才重新获取 ECH，服务端或分流规则变化时关闭池中的空闲连接
+func reloadSettings() error {
+	reloadMu.Lock()
+	defer reloadMu.Unlock()
+
+	next, err := loadSettings()
+	if err != nil {
+		return err
+	}
+	if next.Server == "" {
+		return errors.New("服务端地址为空")
+	}
+	table, err := loadRouteTable(next)
+	if err != nil {
+		return fmt.Errorf("加载分流规则失败: %w", err)
+	}
+
+	prev := settings.Load()
+	if next.ECH != prev.ECH || next.DNS != prev.DNS {
+		if err := prepareECH(next); err != nil {
+			return fmt.Errorf("获取 ECH 配置失败: %w", err)
+		}
+	}
+	settings.Store(next)
+	routes.Store(table)
+	// 除 ECH 查询参数外有任何变化，池中按旧服务端或旧规则建立的空闲连接都不再复用
+	a, b := *prev, *next
+	a.ECH, a.DNS, b.ECH, b.DNS = "", "", "", ""
+	if !reflect.DeepEqual(a, b) {
+		httpPool.closeIdle()
+	}
+
+	metrics.reloads.Add(1)
+	log.Printf("[配置] 已重新加载: 服务端 %s, 分流 %s", next.Server, next.Routing)
+	if edges := table.proxy.edges; len(edges) > 0 {
+		log.Printf("[配置] 使用优选 IP: %s", strings.Join(edges, ", "))
+	}
+	return nil
+}
+
+// watchReload 收到 SIGHUP 时重新加载配置（procd reload 发送该信号）
+func watchReload() {
+	ch := make(chan os.Signal, 1)
+	signal.Notify(ch, syscall.SIGHUP)
+	for range ch {
+		if err := reloadSettings(); err != nil {
+			metrics.reloadErrors.Add(1)
+			log.Printf("[配置] 重新加载失败，继续使用原配置: %v", err)
+		}
+	}
+}
+
+// serveReload 处理 POST /reload，供图形界面在不重启进程的情况下应用新配置。
+// 指标地址可能监听在局域网上，重新加载只接受本机发起的请求
+func serveReload(w http.ResponseWriter, r *http.Request) {
+	if !isLocalRequest(r) {
+		http.Error(w, "forbidden", http.StatusForbidden)
+		return
+	}
+	if r.Method != http.MethodPost {
+		w.Header().Set("Allow", http.MethodPost)
+		http.Error(w, "method not allowed", http.StatusMethodNotAllowed)
+		return
+	}
+	if err := reloadSettings(); err != nil {
+		metrics.reloadErrors.Add(1)
+		log.Printf("[配置] 重新加载失败，继续使用原配置: %v", err)
+		http.Error(w, err.Error(), http.StatusUnprocessableEntity)
+		return
+	}
+	w.WriteHeader(http.StatusNoContent)
+}
+
+// isLocalRequest 判断请求是否来自本机：回环地址，或与监听端相同的地址（如按局域网 IP 访问本机）
+func isLocalRequest(r *http.Request) bool {
+	host, _, err := net.SplitHostPort(r.RemoteAddr)
+	if err != nil {
+		return false
+	}
+	ip := net.ParseIP(host)
+	if ip == nil {
+		return false
+	}
+	if ip.IsLoopback() {
+		return true
+	}
+	local, ok := r.Context().Value(http.LocalAddrContextKey).(*net.TCPAddr)
+	return ok && local.IP.Equal(ip)
+}
+
 // ======================== 工具函数 ========================
 
 func isNormalCloseError(err error) bool {
@@ -82,8 +374,9 @@ func isNormalCloseError(err error) bool {
 
 const typeHTTPS = 65
 
-func prepareECH() error {
-	echBase64, err := queryHTTPSRecord(echDomain, dnsServer)
+// prepareECH 按 s 中的查询域名和 DoH 服务器获取 ECH 配置
+func prepareECH(s *proxySettings) error {
+	echBase64, ttl, err := queryHTTPSRecord(s.ECH, s.DNS)
 	if err != nil {
 		return fmt.Errorf("DNS 查询失败: %w", err)
 	}
@@ -98,12 +391,15 @@ func prepareECH() error {
 	echList = raw
 	echListMu.Unlock()
 	log.Printf("[ECH] 配置已加载，长度: %d 字节", len(raw))
+	echExpires.Store(time.Now().Add(clampECHTTL(ttl)).UnixNano())
+	saveECHCache(s, raw, ttl)
 	return nil
 }
 
 func refreshECH() error {
 	log.Printf("[ECH] 刷新配置...")
-	return prepareECH()
+	metrics.echRefreshes.Add(1)
+	return prepareECH(settings.Load())
 }
 
 func getECHList() ([]byte, error) {
@@ -126,9 +422,10 @@ func buildTLSConfigWithECH(serverName string, echList []byte) (*tls.Config, erro
 	}
 
 	config := &tls.Config{
-		MinVersion: tls.VersionTLS13,
-		ServerName: serverName,
-		RootCAs:    roots,
+		MinVersion:         tls.VersionTLS13,
+		ServerName:         serverName,
+		RootCAs:            roots,
+		ClientSessionCache: tlsSessions.forECH(echList),
 	}
 
 	// 使用反射设置 ECH 字段（ECH 是核心功能，必须设置成功）
@@ -163,8 +460,8 @@ func setECHConfig(config *tls.Config, echList []byte) error {
 	return nil
 }
 
-// queryHTTPSRecord 通过 DoH 查询 HTTPS 记录
-func queryHTTPSRecord(domain, dnsServer string) (string, error) {
+// queryHTTPSRecord 通过 DoH 查询 HTTPS 记录，返回 ech 参数（base64）及记录的 TTL
+func queryHTTPSRecord(domain, dnsServer string) (string, time.Duration, error) {
 	dohURL := dnsServer
 	if !strings.HasPrefix(dohURL, "https://") && !strings.HasPrefix(dohURL, "http://") {
 		dohURL = "https://" + dohURL
@@ -173,10 +470,10 @@ func queryHTTPSRecord(domain, dnsServer string) (string, error) {
 }
 
 // queryDoH 执行 DoH 查询（用于获取 ECH 配置）
-func queryDoH(domain, dohURL string) (string, error) {
+func queryDoH(domain, dohURL string) (string, time.Duration, error) {
 	u, err := url.Parse(dohURL)
 	if err != nil {
-		return "", fmt.Errorf("无效的 DoH URL: %v", err)
+		return "", 0, fmt.Errorf("无效的 DoH URL: %v", err)
 	}
 
 	dnsQuery := buildDNSQuery(domain, typeHTTPS)
@@ -188,7 +485,7 @@ func queryDoH(domain, dohURL string) (string, error) {
 
 	req, err := http.NewRequest("GET", u.String(), nil)
 	if err != nil {
-		return "", fmt.Errorf("创建请求失败: %v", err)
+		return "", 0, fmt.Errorf("创建请求失败: %v", err)
 	}
 	req.Header.Set("Accept", "application/dns-message")
 	req.Header.Set("Content-Type", "application/dns-message")
@@ -196,17 +493,20 @@ func queryDoH(domain, dohURL string) (string, error) {
 	client := &http.Client{Timeout: 10 * time.Second}
 	resp, err := client.Do(req)
 	if err != nil {
-		return "", fmt.Errorf("DoH 请求失败: %v", err)
+		metrics.dohECHErrors.Add(1)
+		return "", 0, fmt.Errorf("DoH 请求失败: %v", err)
 	}
 	defer resp.Body.Close()
 
 	if resp.StatusCode != http.StatusOK {
-		return "", fmt.Errorf("DoH 服务器返回错误: %d", resp.StatusCode)
+		metrics.dohECHErrors.Add(1)
+		return "", 0, fmt.Errorf("DoH 服务器返回错误: %d", resp.StatusCode)
 	}
+	metrics.dohECHQueries.Add(1)
 
 	body, err := io.ReadAll(resp.Body)
 	if err != nil {
-		return "", fmt.Errorf("读取 DoH 响应失败: %v", err)
+		return "", 0, fmt.Errorf("读取 DoH 响应失败: %v", err)
 	}
 
 	return parseDNSResponse(body)
@@ -223,13 +523,13 @@ func buildDNSQuery(domain string, qtype uint16) []byte {
 	return query
 }
 
-func parseDNSResponse(response []byte) (string, error) {
+func parseDNSResponse(response []byte) (string, time.Duration, error) {
 	if len(response) < 12 {
-		return "", errors.New("响应过短")
+		return "", 0, errors.New("响应过短")
 	}
 	ancount := binary.BigEndian.Uint16(response[6:8])
 	if ancount == 0 {
-		return "", errors.New("无应答记录")
+		return "", 0, errors.New("无应答记录")
 	}
 
 	offset := 12
@@ -254,6 +554,7 @@ func parseDNSResponse(response []byte) (string, error) {
 			break
 		}
 		rrType := binary.BigEndian.Uint16(response[offset : offset+2])
+		ttl := time.Duration(binary.BigEndian.Uint32(response[offset+4:offset+8])) * time.Second
 		offset += 8
 		dataLen := binary.BigEndian.Uint16(response[offset : offset+2])
 		offset += 2
@@ -265,11 +566,11 @@ func parseDNSResponse(response []byte) (string, error) {
 
 		if rrType == typeHTTPS {
 			if ech := parseHTTPSRecord(data); ech != "" {
-				return ech, nil
+				return ech, ttl, nil
 			}
 		}
 	}
-	return "", nil
+	return "", 0, nil
 }
 
 func parseHTTPSRecord(data []byte) string {
@@ -301,11 +602,279 @@ func parseHTTPSRecord(data []byte) string {
 	return ""
 }
 
+// ======================== ECH 配置缓存 ========================
+
+const (
+	// 后台重新验证间隔取 HTTPS 记录的 TTL，并限制在该范围内
+	echMinRevalidate = time.Minute
+	echMaxRevalidate = 6 * time.Hour
+	// echRevalidateRetry 后台刷新失败后的重试间隔
+	echRevalidateRetry = 30 * time.Second
+)
+
+// echCacheEntry -ech-cache 文件内容；查询域名或 DoH 服务器与当前参数不同时不使用
+type echCacheEntry struct {
+	Domain  string `json:"domain"`
+	DNS     string `json:"dns"`
+	Config  []byte `json:"config"`
+	Fetched int64  `json:"fetched"`
+	TTL     int64  `json:"ttl"`
+}
+
+var (
+	echCacheMu sync.Mutex
+	// echExpires 当前配置的重新验证时间（UnixNano）
+	echExpires atomic.Int64
+)
+
+func clampECHTTL(ttl time.Duration) time.Duration {
+	if ttl < echMinRevalidate {
+		return echMinRevalidate
+	}
+	if ttl > echMaxRevalidate {
+		return echMaxRevalidate
+	}
+	return ttl
+}
+
+// loadECHCache 读取磁盘缓存的 ECH 配置并立即启用，返回其重新验证时间（可能已过期）
+func loadECHCache() (time.Time, bool) {
+	if echCacheFile == "" {
+		return time.Time{}, false
+	}
+	data, err := os.ReadFile(echCacheFile)
+	if err != nil {
+		if !os.IsNotExist(err) {
+			log.Printf("[ECH] 读取缓存失败: %v", err)
+		}
+		return time.Time{}, false
+	}
+	var entry echCacheEntry
+	if err := json.Unmarshal(data, &entry); err != nil || len(entry.Config) == 0 {
+		log.Printf("[ECH] 缓存文件无效，忽略")
+		return time.Time{}, false
+	}
+	if s := settings.Load(); entry.Domain != s.ECH || entry.DNS != s.DNS {
+		return time.Time{}, false
+	}
+
+	echListMu.Lock()
+	echList = entry.Config
+	echListMu.Unlock()
+	fetched := time.Unix(entry.Fetched, 0)
+	log.Printf("[ECH] 使用缓存配置（%v 前获取），长度: %d 字节", time.Since(fetched).Round(time.Second), len(entry.Config))
+	return fetched.Add(clampECHTTL(time.Duration(entry.TTL) * time.Second)), true
+}
+
+// saveECHCache 把新获取的配置写入 -ech-cache
+func saveECHCache(s *proxySettings, raw []byte, ttl time.Duration) {
+	if echCacheFile == "" {
+		return
+	}
+	data, err := json.Marshal(echCacheEntry{
+		Domain:  s.ECH,
+		DNS:     s.DNS,
+		Config:  raw,
+		Fetched: time.Now().Unix(),
+		TTL:     int64(ttl / time.Second),
+	})
+	if err != nil {
+		return
+	}
+
+	echCacheMu.Lock()
+	defer echCacheMu.Unlock()
+	if err := writeFileAtomic(echCacheFile, data); err != nil {
+		log.Printf("[ECH] 写入缓存失败: %v", err)
+	}
+}
+
+// writeFileAtomic 先写临时文件再替换，避免进程中途退出留下半个文件；内容可能含密钥材料，仅当前用户可读
+func writeFileAtomic(path string, data []byte) error {
+	if err := os.MkdirAll(filepath.Dir(path), 0700); err != nil {
+		return err
+	}
+	tmp := path + ".tmp"
+	if err := os.WriteFile(tmp, data, 0600); err != nil {
+		return err
+	}
+	return os.Rename(tmp, path)
+}
+
+// revalidateECH 到期后在后台重新查询 ECH 配置，失败时继续使用当前配置并定期重试；
+// 配置在到期前轮换时，连接会被服务器拒绝 ECH，仍由 dialWebSocketWithECH 立即刷新
+func revalidateECH(expires time.Time) {
+	for {
+		time.Sleep(time.Until(expires))
+		if err := refreshECH(); err != nil {
+			log.Printf("[ECH] 后台刷新失败，继续使用当前配置: %v", err)
+			expires = time.Now().Add(echRevalidateRetry)
+			continue
+		}
+		expires = time.Unix(0, echExpires.Load())
+	}
+}
+
+// ======================== TLS 会话复用 ========================
+
+const (
+	// tlsSessionCacheSize 最多保留的会话票据数（按服务器名和 ECH 配置区分）
+	tlsSessionCacheSize = 64
+	// tlsSessionSaveDelay 收到新票据后合并写盘的等待时间
+	tlsSessionSaveDelay = 5 * time.Second
+)
+
+// tlsSessionCache 所有到边缘节点的连接（WebSocket 隧道与 DoH 代理）共享的 TLS 1.3 会话票据缓存。
+// 同一服务器名在不同 ECH 配置下分开存放，配置轮换后旧票据不会再被使用
+type tlsSessionCache struct {
+	mu       sync.Mutex
+	sessions map[string]*tls.ClientSessionState
+	order    []string // 插入顺序，超出容量时淘汰最早的
+	file     string   // -tls-cache，为空则只在内存中缓存
+	saving   bool
+}
+
+var tlsSessions = &tlsSessionCache{sessions: make(map[string]*tls.ClientSessionState)}
+
+// tlsSessionView 绑定某个 ECH 配置的缓存视图，实现 tls.ClientSessionCache
+type tlsSessionView struct {
+	cache  *tlsSessionCache
+	prefix string
+}
+
+func (c *tlsSessionCache) forECH(echList []byte) tls.ClientSessionCache {
+	sum := sha256.Sum256(echList)
+	return tlsSessionView{cache: c, prefix: hex.EncodeToString(sum[:8]) + "|"}
+}
+
+func (v tlsSessionView) Get(key string) (*tls.ClientSessionState, bool) {
+	v.cache.mu.Lock()
+	defer v.cache.mu.Unlock()
+	cs, ok := v.cache.sessions[v.prefix+key]
+	return cs, ok
+}
+
+// Put 保存新票据；crypto/tls 以 nil 调用表示票据已失效
+func (v tlsSessionView) Put(key string, cs *tls.ClientSessionState) {
+	c := v.cache
+	key = v.prefix + key
+	c.mu.Lock()
+	defer c.mu.Unlock()
+
+	if _, ok := c.sessions[key]; ok {
+		c.removeOrder(key)
+	}
+	if cs == nil {
+		delete(c.sessions, key)
+	} else {
+		c.sessions[key] = cs
+		c.order = append(c.order, key)
+		for len(c.order) > tlsSessionCacheSize {
+			delete(c.sessions, c.order[0])
+			c.order = c.order[1:]
+		}
+	}
+	c.scheduleSave()
+}
+
+func (c *tlsSessionCache) removeOrder(key string) {
+	for i, k := range c.order {
+		if k == key {
+			c.order = append(c.order[:i], c.order[i+1:]...)
+			return
+		}
+	}
+}
+
+// tlsSessionEntry -tls-cache 中的一条票据（crypto/tls 的序列化格式）
+type tlsSessionEntry struct {
+	Ticket []byte `json:"ticket"`
+	State  []byte `json:"state"`
+}
+
+// load 读取 -tls-cache 中保存的票据；过期票据由 crypto/tls 在握手时自行忽略
+func (c *tlsSessionCache) load(file string) {
+	c.mu.Lock()
+	defer c.mu.Unlock()
+	c.file = file
+
+	data, err := os.ReadFile(file)
+	if err != nil {
+		if !os.IsNotExist(err) {
+			log.Printf("[TLS] 读取会话缓存失败: %v", err)
+		}
+		return
+	}
+	var entries map[string]tlsSessionEntry
+	if err := json.Unmarshal(data, &entries); err != nil {
+		log.Printf("[TLS] 会话缓存文件无效，忽略")
+		return
+	}
+	for key, entry := range entries {
+		state, err := tls.ParseSessionState(entry.State)
+		if err != nil {
+			continue
+		}
+		cs, err := tls.NewResumptionState(entry.Ticket, state)
+		if err != nil || len(c.order) >= tlsSessionCacheSize {
+			continue
+		}
+		c.sessions[key] = cs
+		c.order = append(c.order, key)
+	}
+	log.Printf("[TLS] 已加载 %d 个会话票据", len(c.sessions))
+}
+
+// scheduleSave 在 tlsSessionSaveDelay 后写盘，期间的多次更新合并为一次（调用方持有 c.mu）
+func (c *tlsSessionCache) scheduleSave() {
+	if c.file == "" || c.saving {
+		return
+	}
+	c.saving = true
+	time.AfterFunc(tlsSessionSaveDelay, c.save)
+}
+
+func (c *tlsSessionCache) save() {
+	c.mu.Lock()
+	c.saving = false
+	entries := make(map[string]tlsSessionEntry, len(c.sessions))
+	for key, cs := range c.sessions {
+		ticket, state, err := cs.ResumptionState()
+		if err != nil || state == nil {
+			continue
+		}
+		data, err := state.Bytes()
+		if err != nil {
+			continue
+		}
+		entries[key] = tlsSessionEntry{Ticket: ticket, State: data}
+	}
+	file := c.file
+	c.mu.Unlock()
+
+	data, err := json.Marshal(entries)
+	if err == nil {
+		err = writeFileAtomic(file, data)
+	}
+	if err != nil {
+		log.Printf("[TLS] 写入会话缓存失败: %v", err)
+	}
+}
+
+// recordTLSHandshake 统计到边缘节点的握手次数及其中复用会话的次数
+func recordTLSHandshake(state tls.ConnectionState) {
+	metrics.tlsHandshakes.Add(1)
+	if state.DidResume {
+		metrics.tlsResumed.Add(1)
+	}
+}
+
 // ======================== DoH 代理支持 ========================
 
 // queryDoHForProxy 通过 ECH 转发 DNS 查询到 Cloudflare DoH
 func queryDoHForProxy(dnsQuery []byte) ([]byte, error) {
-	_, port, _, err := parseServerAddr(serverAddr)
+	up := routes.Load().proxy
+	_, port, _, err := parseServerAddr(up.server)
 	if err != nil {
 		return nil, err
 	}
@@ -328,19 +897,8 @@ func queryDoHForProxy(dnsQuery []byte) ([]byte, error) {
 		TLSClientConfig: tlsCfg,
 	}
 
-	// 如果指定了 IP，使用自定义 Dialer
-	if serverIP != "" {
-		transport.DialContext = func(ctx context.Context, network, addr string) (net.Conn, error) {
-			_, port, err := net.SplitHostPort(addr)
-			if err != nil {
-				return nil, err
-			}
-			dialer := &net.Dialer{
-				Timeout: 10 * time.Second,
-			}
-			return dialer.DialContext(ctx, network, net.JoinHostPort(serverIP, port))
-		}
-	}
+	// 在优选 IP（或 DNS 解析结果）之间并行择优连接
+	transport.DialContext = up.dialEdge
 
 	client := &http.Client{
 		Transport: transport,
@@ -358,13 +916,20 @@ func queryDoHForProxy(dnsQuery []byte) ([]byte, error) {
 
 	resp, err := client.Do(req)
 	if err != nil {
+		metrics.dohProxyErrors.Add(1)
 		return nil, fmt.Errorf("DoH 请求失败: %w", err)
 	}
 	defer resp.Body.Close()
 
+	// 每次查询使用新的 Transport，因此每个响应都对应一次握手
+	if resp.TLS != nil {
+		recordTLSHandshake(*resp.TLS)
+	}
 	if resp.StatusCode != http.StatusOK {
+		metrics.dohProxyErrors.Add(1)
 		return nil, fmt.Errorf("DoH 响应错误: %d", resp.StatusCode)
 	}
+	metrics.dohProxyQueries.Add(1)
 
 	return io.ReadAll(resp.Body)
 }
@@ -387,10 +952,12 @@ func parseServerAddr(addr string) (host, port, path string, err error) {
 	return host, port, path, nil
 }
 
-func dialWebSocketWithECH(maxRetries int) (*websocket.Conn, error) {
-	host, port, path, err := parseServerAddr(serverAddr)
+// dialWebSocketWithECH 建立到服务端 up 的 WebSocket 连接，同时声明支持二进制握手；
+// 返回的握手响应用于判断 Worker 是否支持（见 supportsBinaryHandshake）
+func dialWebSocketWithECH(up *upstream, maxRetries int) (*websocket.Conn, *http.Response, error) {
+	host, port, path, err := parseServerAddr(up.server)
 	if err != nil {
-		return nil, err
+		return nil, nil, err
 	}
 
 	wsURL := fmt.Sprintf("wss://%s:%s%s", host, port, path)
@@ -402,103 +969,592 @@ func dialWebSocketWithECH(maxRetries int) (*websocket.Conn, error) {
 				refreshECH()
 				continue
 			}
-			return nil, echErr
+			return nil, nil, echErr
 		}
 
 		tlsCfg, tlsErr := buildTLSConfigWithECH(host, echBytes)
 		if tlsErr != nil {
-			return nil, tlsErr
+			return nil, nil, tlsErr
 		}
 
 		dialer := websocket.Dialer{
 			TLSClientConfig: tlsCfg,
 			Subprotocols: func() []string {
-				if token == "" {
+				if up.token == "" {
 					return nil
 				}
-				return []string{token}
+				return []string{up.token}
 			}(),
 			HandshakeTimeout: 10 * time.Second,
+			NetDialContext:   up.dialEdge,
 		}
 
-		if serverIP != "" {
-			dialer.NetDial = func(network, address string) (net.Conn, error) {
-				_, port, err := net.SplitHostPort(address)
-				if err != nil {
-					return nil, err
-				}
-				return net.DialTimeout(network, net.JoinHostPort(serverIP, port), 10*time.Second)
+		header := http.Header{}
+		header.Set(protoHeader, protoBinaryV1)
+
+		wsConn, resp, dialErr := dialer.Dial(wsURL, header)
+		if dialErr == nil {
+			if tlsConn, ok := wsConn.UnderlyingConn().(*tls.Conn); ok {
+				recordTLSHandshake(tlsConn.ConnectionState())
 			}
 		}
-
-		wsConn, _, dialErr := dialer.Dial(wsURL, nil)
 		if dialErr != nil {
 			if strings.Contains(dialErr.Error(), "ECH") && attempt < maxRetries {
 				log.Printf("[ECH] 连接失败，尝试刷新配置 (%d/%d)", attempt, maxRetries)
 				refreshECH()
-				time.Sleep(time.Second)
 				continue
 			}
-			return nil, dialErr
+			return nil, nil, dialErr
 		}
 
-		return wsConn, nil
+		return wsConn, resp, nil
 	}
 
-	return nil, errors.New("连接失败，已达最大重试次数")
+	return nil, nil, errors.New("连接失败，已达最大重试次数")
 }
 
-// ======================== 统一代理服务器 ========================
+// ======================== 优选 IP 并行拨号 ========================
 
-func runProxyServer(addr string) {
-	listener, err := net.Listen("tcp", addr)
-	if err != nil {
-		log.Fatalf("[代理] 监听失败: %v", err)
-	}
-	defer listener.Close()
+const (
+	// edgeDialTimeout 单次择优拨号的总超时
+	edgeDialTimeout = 10 * time.Second
+	// edgeStagger 相邻两次连接尝试的间隔（RFC 8305 建议 250ms）
+	edgeStagger = 250 * time.Millisecond
+	// edgeStatDecay 每次记录结果前旧计数的衰减系数，使评分跟随边缘节点的近期状况
+	edgeStatDecay = 0.9
+)
 
-	log.Printf("[代理] 服务器启动: %s (支持 SOCKS5 和 HTTP)", addr)
-	log.Printf("[代理] 后端服务器: %s", serverAddr)
-	if serverIP != "" {
-		log.Printf("[代理] 使用固定 IP: %s", serverIP)
-	}
+// edgeStat 单个候选地址的历史连接结果
+type edgeStat struct {
+	successes float64
+	failures  float64
+	rtt       time.Duration // 成功连接耗时的 EWMA
+}
 
-	for {
-		conn, err := listener.Accept()
-		if err != nil {
-			log.Printf("[代理] 接受连接失败: %v", err)
-			continue
-		}
+func (st *edgeStat) score() float64 {
+	return (st.successes + 1) / (st.successes + st.failures + 2)
+}
+
+var (
+	edgeStatsMu sync.Mutex
+	edgeStats   = make(map[string]*edgeStat)
+)
 
-		go handleConnection(conn)
+// parseEdgeCandidates 解析 -ip 参数中的候选地址（逗号或空白分隔）
+func parseEdgeCandidates(list string) []string {
+	var hosts []string
+	seen := make(map[string]bool)
+	for _, h := range strings.FieldsFunc(list, func(r rune) bool {
+		return r == ',' || r == ' ' || r == '\t' || r == ';'
+	}) {
+		h = strings.Trim(h, "[]")
+		if h != "" && !seen[h] {
+			seen[h] = true
+			hosts = append(hosts, h)
+		}
 	}
+	return hosts
 }
 
-func handleConnection(conn net.Conn) {
-	defer conn.Close()
-
-	clientAddr := conn.RemoteAddr().String()
-	conn.SetDeadline(time.Now().Add(30 * time.Second))
+func recordEdgeResult(host string, ok bool, rtt time.Duration) {
+	edgeStatsMu.Lock()
+	defer edgeStatsMu.Unlock()
 
-	// 读取第一个字节判断协议
-	buf := make([]byte, 1)
-	n, err := conn.Read(buf)
-	if err != nil || n == 0 {
+	st := edgeStats[host]
+	if st == nil {
+		st = &edgeStat{}
+		edgeStats[host] = st
+	}
+	st.successes *= edgeStatDecay
+	st.failures *= edgeStatDecay
+	if !ok {
+		st.failures++
 		return
 	}
+	st.successes++
+	if st.rtt == 0 {
+		st.rtt = rtt
+	} else {
+		st.rtt = (st.rtt*7 + rtt) / 8
+	}
+}
 
-	firstByte := buf[0]
+// orderEdges 按历史成功率从高到低、连接耗时从低到高排列候选地址；
+// 没有记录的地址耗时视为 0，会被优先尝试一次
+func orderEdges(hosts []string) []string {
+	edgeStatsMu.Lock()
+	defer edgeStatsMu.Unlock()
 
-	// 使用 switch 判断协议类型
-	switch firstByte {
-	case 0x05:
-		// SOCKS5 协议
-		handleSOCKS5(conn, clientAddr, firstByte)
-	case 'C', 'G', 'P', 'H', 'D', 'O', 'T':
-		// HTTP 协议 (CONNECT, GET, POST, HEAD, DELETE, OPTIONS, TRACE, PUT, PATCH)
-		handleHTTP(conn, clientAddr, firstByte)
-	default:
-		log.Printf("[代理] %s 未知协议: 0x%02x", clientAddr, firstByte)
+	ordered := append([]string(nil), hosts...)
+	stat := func(h string) edgeStat {
+		if st := edgeStats[h]; st != nil {
+			return *st
+		}
+		return edgeStat{}
+	}
+	sort.SliceStable(ordered, func(i, j int) bool {
+		a, b := stat(ordered[i]), stat(ordered[j])
+		if sa, sb := a.score(), b.score(); sa != sb {
+			return sa > sb
+		}
+		return a.rtt < b.rtt
+	})
+	return ordered
+}
+
+// dialEdge 在服务端的优选 IP 之间并行择优建立 TCP 连接；未指定优选 IP 时使用 DNS 解析出的全部地址。
+// 各服务端共用 edgeStats，同一边缘节点的历史结果对所有服务端有效
+func (u *upstream) dialEdge(ctx context.Context, network, address string) (net.Conn, error) {
+	host, port, err := net.SplitHostPort(address)
+	if err != nil {
+		return nil, err
+	}
+
+	hosts := u.edges
+	if len(hosts) == 0 {
+		if net.ParseIP(host) != nil {
+			hosts = []string{host}
+		} else {
+			addrs, err := net.DefaultResolver.LookupHost(ctx, host)
+			if err != nil {
+				return nil, err
+			}
+			hosts = addrs
+		}
+	}
+	return raceDial(ctx, network, orderEdges(hosts), port)
+}
+
+// raceDial 按顺序每隔 edgeStagger 发起一次连接尝试，上一次失败时立即发起下一次，
+// 第一个成功的连接胜出，其余尝试被取消或关闭
+func raceDial(ctx context.Context, network string, hosts []string, port string) (net.Conn, error) {
+	ctx, cancelTimeout := context.WithTimeout(ctx, edgeDialTimeout)
+	defer cancelTimeout()
+	dialCtx, cancel := context.WithCancel(ctx)
+	defer cancel()
+
+	type result struct {
+		conn net.Conn
+		err  error
+	}
+	results := make(chan result, len(hosts))
+	var dialer net.Dialer
+
+	next, pending := 0, 0
+	startNext := func() {
+		h := hosts[next]
+		next++
+		pending++
+		go func() {
+			begin := time.Now()
+			conn, err := dialer.DialContext(dialCtx, network, net.JoinHostPort(h, port))
+			switch {
+			case err == nil:
+				recordEdgeResult(h, true, time.Since(begin))
+			case dialCtx.Err() != nil && ctx.Err() == nil:
+				// 其他尝试已胜出而被取消，不计为失败
+			default:
+				recordEdgeResult(h, false, 0)
+			}
+			results <- result{conn, err}
+		}()
+	}
+
+	timer := time.NewTimer(edgeStagger)
+	defer timer.Stop()
+	startNext()
+
+	// closeLate 关闭胜出后才完成的连接
+	closeLate := func() {
+		go func(n int) {
+			for i := 0; i < n; i++ {
+				if r := <-results; r.conn != nil {
+					r.conn.Close()
+				}
+			}
+		}(pending)
+	}
+
+	var firstErr error
+	for {
+		select {
+		case <-timer.C:
+			if next < len(hosts) {
+				startNext()
+				timer.Reset(edgeStagger)
+			}
+
+		case r := <-results:
+			pending--
+			if r.err == nil {
+				cancel()
+				closeLate()
+				return r.conn, nil
+			}
+			if firstErr == nil {
+				firstErr = r.err
+			}
+			if next < len(hosts) {
+				if !timer.Stop() {
+					select {
+					case <-timer.C:
+					default:
+					}
+				}
+				startNext()
+				timer.Reset(edgeStagger)
+			} else if pending == 0 {
+				return nil, firstErr
+			}
+
+		case <-ctx.Done():
+			cancel()
+			closeLate()
+			if firstErr != nil {
+				return nil, firstErr
+			}
+			return nil, ctx.Err()
+		}
+	}
+}
+
+// ======================== 统一代理服务器 ========================
+
+func runProxyServer(addr string) {
+	lc := listenConfig(false)
+	listener, err := lc.Listen(context.Background(), "tcp", addr)
+	if err != nil {
+		log.Fatalf("[代理] 监听失败: %v", err)
+	}
+	defer listener.Close()
+
+	log.Printf("[代理] 服务器启动: %s (支持 SOCKS5 和 HTTP)", addr)
+	if reusePort {
+		log.Printf("[代理] 已开启 SO_REUSEPORT，与同端口的其他实例共同接受连接")
+	}
+	log.Printf("[代理] 后端服务器: %s", settings.Load().Server)
+	if edges := routes.Load().proxy.edges; len(edges) > 0 {
+		log.Printf("[代理] 使用优选 IP: %s", strings.Join(edges, ", "))
+	}
+
+	admit = newAdmission(maxConns, maxConnsPerClient, maxPendingDials)
+	log.Printf("[代理] 连接限制: 总数 %d, 单客户端 %d, 并发握手 %d (0 表示不限制)",
+		maxConns, maxConnsPerClient, maxPendingDials)
+	go logShedStats()
+
+	if tproxyAddr != "" {
+		go runTransparentServer(tproxyAddr)
+	}
+
+	acceptLoop(listener, "代理", handleConnection, admit.reject)
+}
+
+// acceptLoop 接受连接并经准入控制后交给 handle 处理，超出限制的连接交给 reject
+func acceptLoop(listener net.Listener, tag string, handle, reject func(net.Conn)) {
+	var tempDelay time.Duration
+	for {
+		conn, err := listener.Accept()
+		if err != nil {
+			// 文件描述符耗尽等临时错误时退避，避免空转刷日志
+			if tempDelay == 0 {
+				tempDelay = 5 * time.Millisecond
+			} else if tempDelay *= 2; tempDelay > time.Second {
+				tempDelay = time.Second
+			}
+			log.Printf("[%s] 接受连接失败: %v，%v 后重试", tag, err, tempDelay)
+			time.Sleep(tempDelay)
+			continue
+		}
+		tempDelay = 0
+		proxyStats.accepted.Add(1)
+
+		clientIP := clientHost(conn.RemoteAddr())
+		if !admit.acquire(clientIP) {
+			reject(conn)
+			continue
+		}
+
+		go func() {
+			defer admit.release(clientIP)
+			handle(conn)
+		}()
+	}
+}
+
+func handleConnection(conn net.Conn) {
+	defer conn.Close()
+
+	clientAddr := conn.RemoteAddr().String()
+	conn.SetDeadline(time.Now().Add(30 * time.Second))
+
+	// 读取第一个字节判断协议
+	buf := make([]byte, 1)
+	n, err := conn.Read(buf)
+	if err != nil || n == 0 {
+		return
+	}
+
+	firstByte := buf[0]
+
+	// 使用 switch 判断协议类型
+	switch firstByte {
+	case 0x05:
+		// SOCKS5 协议
+		handleSOCKS5(conn, clientAddr, firstByte)
+	case 'C', 'G', 'P', 'H', 'D', 'O', 'T':
+		// HTTP 协议 (CONNECT, GET, POST, HEAD, DELETE, OPTIONS, TRACE, PUT, PATCH)
+		handleHTTP(conn, clientAddr, firstByte)
+	default:
+		log.Printf("[代理] %s 未知协议: 0x%02x", clientAddr, firstByte)
+	}
+}
+
+// ======================== 监听套接字选项 ========================
+
+// 套接字选项的常量和 setsockopt 的句柄类型随平台不同，实现见 sockopt_linux.go（其他平台为 sockopt_other.go）
+
+// listenConfig 按命令行参数设置监听套接字：-reuseport 时开启 SO_REUSEPORT，
+// 透明代理监听还需开启 IP_TRANSPARENT，才能接受 TPROXY 转来的、目标地址不属于本机的连接
+func listenConfig(transparent bool) net.ListenConfig {
+	return net.ListenConfig{
+		Control: func(network, address string, c syscall.RawConn) error {
+			var serr error
+			err := c.Control(func(fd uintptr) {
+				if reusePort {
+					if serr = enableReusePort(fd); serr != nil {
+						return
+					}
+				}
+				if transparent {
+					serr = enableTransparent(fd)
+				}
+			})
+			if err != nil {
+				return err
+			}
+			return serr
+		},
+	}
+}
+
+// ======================== 连接准入控制 ========================
+
+const (
+	// dialQueueTimeout 等待握手名额的最长时间，超时即拒绝
+	dialQueueTimeout = 5 * time.Second
+	// maxRejecters 同时进行协议级拒绝的连接数，超出时直接关闭
+	maxRejecters = 64
+	// rejectTimeout 拒绝过程中等待客户端请求的时间
+	rejectTimeout = time.Second
+)
+
+var errDialQueueTimeout = errors.New("等待服务端握手名额超时，连接已拒绝")
+
+// proxyStats 运行计数器
+var proxyStats struct {
+	accepted      atomic.Int64
+	active        atomic.Int64
+	shedGlobal    atomic.Int64 // 超过总连接数被拒绝
+	shedPerClient atomic.Int64 // 超过单客户端连接数被拒绝
+	shedDialQueue atomic.Int64 // 排队等待握手超时被拒绝
+}
+
+// admission 并发连接准入控制，限制为 0 表示不限制
+type admission struct {
+	maxConns     int
+	maxPerClient int
+
+	mu        sync.Mutex
+	active    int
+	perClient map[string]int
+
+	dialSlots chan struct{} // 握手信号量，nil 表示不限制
+	rejecters chan struct{}
+}
+
+// admit 由 runProxyServer 按命令行参数重建；默认值不做任何限制
+var admit = newAdmission(0, 0, 0)
+
+func newAdmission(maxConns, maxPerClient, maxDials int) *admission {
+	a := &admission{
+		maxConns:     maxConns,
+		maxPerClient: maxPerClient,
+		perClient:    make(map[string]int),
+		rejecters:    make(chan struct{}, maxRejecters),
+	}
+	if maxDials > 0 {
+		a.dialSlots = make(chan struct{}, maxDials)
+	}
+	return a
+}
+
+// acquire 为新连接占用名额，超限时返回 false
+func (a *admission) acquire(clientIP string) bool {
+	a.mu.Lock()
+	defer a.mu.Unlock()
+
+	if a.maxConns > 0 && a.active >= a.maxConns {
+		proxyStats.shedGlobal.Add(1)
+		return false
+	}
+	if a.maxPerClient > 0 && a.perClient[clientIP] >= a.maxPerClient {
+		proxyStats.shedPerClient.Add(1)
+		return false
+	}
+	a.active++
+	a.perClient[clientIP]++
+	proxyStats.active.Add(1)
+	return true
+}
+
+func (a *admission) release(clientIP string) {
+	a.mu.Lock()
+	defer a.mu.Unlock()
+
+	a.active--
+	if a.perClient[clientIP] <= 1 {
+		delete(a.perClient, clientIP)
+	} else {
+		a.perClient[clientIP]--
+	}
+	proxyStats.active.Add(-1)
+}
+
+// acquireDial 排队等待服务端握手名额
+func (a *admission) acquireDial() bool {
+	if a.dialSlots == nil {
+		return true
+	}
+	select {
+	case a.dialSlots <- struct{}{}:
+		return true
+	default:
+	}
+
+	timer := time.NewTimer(dialQueueTimeout)
+	defer timer.Stop()
+	select {
+	case a.dialSlots <- struct{}{}:
+		return true
+	case <-timer.C:
+		proxyStats.shedDialQueue.Add(1)
+		return false
+	}
+}
+
+func (a *admission) releaseDial() {
+	if a.dialSlots != nil {
+		<-a.dialSlots
+	}
+}
+
+// reject 按客户端协议快速返回错误后关闭连接；拒绝本身也有并发上限
+func (a *admission) reject(conn net.Conn) {
+	select {
+	case a.rejecters <- struct{}{}:
+	default:
+		conn.Close()
+		return
+	}
+
+	go func() {
+		defer func() { <-a.rejecters }()
+		defer conn.Close()
+
+		conn.SetDeadline(time.Now().Add(rejectTimeout))
+		buf := make([]byte, 512)
+		n, err := conn.Read(buf)
+		if err != nil || n == 0 {
+			return
+		}
+
+		if buf[0] == 0x05 {
+			// 完成方法协商后读取请求，回复一般性失败
+			if _, err := conn.Write([]byte{0x05, 0x00}); err != nil {
+				return
+			}
+			if _, err := conn.Read(buf); err != nil {
+				return
+			}
+			sendOverloadResponse(conn, modeSOCKS5)
+			return
+		}
+		sendOverloadResponse(conn, modeHTTPProxy)
+	}()
+}
+
+// clientHost 取客户端 IP，用于单客户端限流
+func clientHost(addr net.Addr) string {
+	host, _, err := net.SplitHostPort(addr.String())
+	if err != nil {
+		return addr.String()
+	}
+	return host
+}
+
+// logShedStats 有新的拒绝时每分钟输出一次计数
+func logShedStats() {
+	ticker := time.NewTicker(time.Minute)
+	defer ticker.Stop()
+
+	var last int64
+	for range ticker.C {
+		global := proxyStats.shedGlobal.Load()
+		perClient := proxyStats.shedPerClient.Load()
+		dialQueue := proxyStats.shedDialQueue.Load()
+		total := global + perClient + dialQueue
+		if total == last {
+			continue
+		}
+		last = total
+		log.Printf("[代理] 过载保护: 活动连接 %d, 已接受 %d, 拒绝 总数超限 %d / 单客户端超限 %d / 握手排队超时 %d",
+			proxyStats.active.Load(), proxyStats.accepted.Load(), global, perClient, dialQueue)
+	}
+}
+
+// statsInterval 运行统计快照的写入间隔
+const statsInterval = 5 * time.Second
+
+// instanceStats 写入 -stats-file 的运行统计快照，多实例运行时由 LuCI 读取汇总
+type instanceStats struct {
+	PID       int   `json:"pid"`
+	Start     int64 `json:"start"`
+	Updated   int64 `json:"updated"`
+	Accepted  int64 `json:"accepted"`
+	Active    int64 `json:"active"`
+	Shed      int64 `json:"shed"`
+	Tunnels   int64 `json:"tunnels"`
+	Direct    int64 `json:"direct"`
+	BytesUp   int64 `json:"bytes_up"`
+	BytesDown int64 `json:"bytes_down"`
+	Failures  int64 `json:"failures"`
+}
+
+func writeStatsLoop(path string) {
+	ticker := time.NewTicker(statsInterval)
+	defer ticker.Stop()
+
+	for {
+		st := instanceStats{
+			PID:       os.Getpid(),
+			Start:     startTime.Unix(),
+			Updated:   time.Now().Unix(),
+			Accepted:  proxyStats.accepted.Load(),
+			Active:    proxyStats.active.Load(),
+			Shed:      proxyStats.shedGlobal.Load() + proxyStats.shedPerClient.Load() + proxyStats.shedDialQueue.Load(),
+			Tunnels:   metrics.tunnelsTotal.Load(),
+			Direct:    metrics.directTotal.Load(),
+			BytesUp:   metrics.tunnelBytesUp.Load() + metrics.directBytesUp.Load(),
+			BytesDown: metrics.tunnelBytesDown.Load() + metrics.directBytesDown.Load(),
+		}
+		for i := range metrics.failures {
+			st.Failures += metrics.failures[i].Load()
+		}
+		data, _ := json.Marshal(st)
+		if err := writeFileAtomic(path, data); err != nil {
+			log.Printf("[统计] 写入 %s 失败: %v", path, err)
+		}
+		<-ticker.C
 	}
 }
 
@@ -591,7 +1647,7 @@ func handleSOCKS5(conn net.Conn, clientAddr string, firstByte byte) {
 
 		log.Printf("[SOCKS5] %s -> %s", clientAddr, target)
 
-		if err := handleTunnel(conn, target, clientAddr, modeSOCKS5, ""); err != nil {
+		if err := handleTunnel(conn, target, clientAddr, modeSOCKS5, nil); err != nil {
 			if !isNormalCloseError(err) {
 				log.Printf("[SOCKS5] %s 代理失败: %v", clientAddr, err)
 			}
@@ -639,407 +1695,2194 @@ func handleUDPAssociate(tcpConn net.Conn, clientAddr string) {
 	}
 
 	// 启动 UDP 处理
-	stopChan := make(chan struct{})
-	go handleUDPRelay(udpConn, clientAddr, stopChan)
+	assoc := newUDPAssociation(udpConn, clientAddr)
+	go assoc.serve()
 
 	// 保持 TCP 连接，直到客户端关闭
+	tcpConn.SetDeadline(time.Time{})
 	buf := make([]byte, 1)
 	tcpConn.Read(buf)
 
-	close(stopChan)
-	udpConn.Close()
+	// 关闭 UDP 套接字会让 serve 的读取立即返回，无需轮询
+	assoc.close()
 	log.Printf("[UDP] %s UDP ASSOCIATE 连接关闭", clientAddr)
 }
 
-func handleUDPRelay(udpConn *net.UDPConn, clientAddr string, stopChan chan struct{}) {
-	buf := make([]byte, 65535)
-	for {
-		select {
-		case <-stopChan:
-			return
-		default:
-		}
+// ======================== UDP 转发 ========================
 
-		udpConn.SetReadDeadline(time.Now().Add(1 * time.Second))
-		n, addr, err := udpConn.ReadFromUDP(buf)
-		if err != nil {
-			if netErr, ok := err.(net.Error); ok && netErr.Timeout() {
-				continue
-			}
-			return
+const (
+	// udpMaxInflightDNS 每个关联同时进行的 DoH 查询数，超出的查询被丢弃（由客户端重试）
+	udpMaxInflightDNS = 64
+	// udpSessionIdle 直连会话无响应后的回收时间
+	udpSessionIdle = 60 * time.Second
+	// udpSessionPending 直连会话建立（解析目标、创建套接字）期间缓存的数据报数，超出的丢弃
+	udpSessionPending = 16
+	// udpTunnelQueueLen 经 Worker 的 UDP 通道发送队列长度，满时丢包
+	udpTunnelQueueLen = 256
+	// udpTunnelRetry UDP 通道建立失败后的重试间隔
+	udpTunnelRetry = 30 * time.Second
+)
+
+// udpAssociation 一个 SOCKS5 UDP ASSOCIATE 关联：
+// DNS 查询并发走 DoH，直连目标各自维护一个 UDP 会话，其余目标共用一条经 Worker 的 WebSocket 通道。
+// Workers 只有 TCP 出站，通道中的数据报会被服务端拒绝（回复 ERROR:UDP），QUIC 等只能回落到 TCP
+type udpAssociation struct {
+	conn       *net.UDPConn
+	clientAddr string
+	dnsSlots   chan struct{}
+
+	mu            sync.Mutex
+	peer          *net.UDPAddr // 最近一次发送数据报的客户端地址，响应发往这里
+	sessions      map[string]*udpDirectSession
+	tunnel        *udpTunnel
+	tunnelRetryAt time.Time
+	closed        bool
+}
+
+func newUDPAssociation(conn *net.UDPConn, clientAddr string) *udpAssociation {
+	return &udpAssociation{
+		conn:       conn,
+		clientAddr: clientAddr,
+		dnsSlots:   make(chan struct{}, udpMaxInflightDNS),
+		sessions:   make(map[string]*udpDirectSession),
+	}
+}
+
+// parseSOCKS5UDPHeader 解析 SOCKS5 UDP 请求头，返回头部长度、目标主机和端口
+//
+//	+----+------+------+----------+----------+----------+
+//	|RSV | FRAG | ATYP | DST.ADDR | DST.PORT |   DATA   |
+//	+----+------+------+----------+----------+----------+
+//	| 2  |  1   |  1   | Variable |    2     | Variable |
+//	+----+------+------+----------+----------+----------+
+func parseSOCKS5UDPHeader(data []byte) (headerLen int, host string, port int, ok bool) {
+	n := len(data)
+	if n < 10 || data[2] != 0x00 { // FRAG 必须为 0
+		return 0, "", 0, false
+	}
+
+	switch data[3] {
+	case 0x01: // IPv4
+		host = net.IP(data[4:8]).String()
+		port = int(data[8])<<8 | int(data[9])
+		headerLen = 10
+
+	case 0x03: // 域名
+		domainLen := int(data[4])
+		if n < 7+domainLen {
+			return 0, "", 0, false
 		}
+		host = string(data[5 : 5+domainLen])
+		port = int(data[5+domainLen])<<8 | int(data[6+domainLen])
+		headerLen = 7 + domainLen
 
-		// 解析 SOCKS5 UDP 请求头
-		if n < 10 {
-			continue
+	case 0x04: // IPv6
+		if n < 22 {
+			return 0, "", 0, false
 		}
+		host = net.IP(data[4:20]).String()
+		port = int(data[20])<<8 | int(data[21])
+		headerLen = 22
 
-		// SOCKS5 UDP 请求格式:
-		// +----+------+------+----------+----------+----------+
-		// |RSV | FRAG | ATYP | DST.ADDR | DST.PORT |   DATA   |
-		// +----+------+------+----------+----------+----------+
-		// | 2  |  1   |  1   | Variable |    2     | Variable |
-		// +----+------+------+----------+----------+----------+
+	default:
+		return 0, "", 0, false
+	}
+	return headerLen, host, port, true
+}
 
-		data := buf[:n]
+// serve 读取客户端数据报并分发；DNS 查询、直连会话的建立和 UDP 通道的握手都在其他协程中进行，
+// 读取循环不会被某个目标的解析或连接阻塞
+func (a *udpAssociation) serve() {
+	buf := make([]byte, 65535)
+	for {
+		n, addr, err := a.conn.ReadFromUDP(buf)
+		if err != nil {
+			return
+		}
 
-		if data[2] != 0x00 { // FRAG 必须为 0
+		headerLen, dstHost, dstPort, ok := parseSOCKS5UDPHeader(buf[:n])
+		if !ok {
 			continue
 		}
 
-		atyp := data[3]
-		var headerLen int
-		var dstHost string
-		var dstPort int
+		a.mu.Lock()
+		a.peer = addr
+		a.mu.Unlock()
 
-		switch atyp {
-		case 0x01: // IPv4
-			if n < 10 {
-				continue
-			}
-			dstHost = net.IP(data[4:8]).String()
-			dstPort = int(data[8])<<8 | int(data[9])
-			headerLen = 10
+		// buf 会被下一次读取覆盖，交给其他 goroutine 的数据需要复制
+		datagram := append([]byte(nil), buf[:n]...)
+		target := net.JoinHostPort(dstHost, strconv.Itoa(dstPort))
 
-		case 0x03: // 域名
-			if n < 5 {
-				continue
-			}
-			domainLen := int(data[4])
-			if n < 7+domainLen {
-				continue
+		switch {
+		case dstPort == 53:
+			select {
+			case a.dnsSlots <- struct{}{}:
+				go func() {
+					defer func() { <-a.dnsSlots }()
+					handleDNSQuery(a.conn, addr, datagram[headerLen:], datagram[:headerLen])
+				}()
+			default:
+				log.Printf("[UDP-DNS] %s 并发查询过多，丢弃 -> %s", a.clientAddr, target)
 			}
-			dstHost = string(data[5 : 5+domainLen])
-			dstPort = int(data[5+domainLen])<<8 | int(data[6+domainLen])
-			headerLen = 7 + domainLen
 
-		case 0x04: // IPv6
-			if n < 22 {
-				continue
-			}
-			dstHost = net.IP(data[4:20]).String()
-			dstPort = int(data[20])<<8 | int(data[21])
-			headerLen = 22
+		case routes.Load().isDirect(target):
+			a.sendDirect(target, datagram[:headerLen], datagram[headerLen:])
 
 		default:
-			continue
+			// 去掉 RSV/FRAG，ATYP|ADDR|PORT|DATA 原样作为通道帧
+			a.sendTunnel(datagram[3:])
 		}
+	}
+}
 
-		udpData := data[headerLen:]
-		target := fmt.Sprintf("%s:%d", dstHost, dstPort)
-
-		// 检查是否是 DNS 查询（端口 53）
-		if dstPort == 53 {
-			log.Printf("[UDP-DNS] %s -> %s (DoH 查询)", clientAddr, target)
-			go handleDNSQuery(udpConn, addr, udpData, data[:headerLen])
-		} else {
-			log.Printf("[UDP] %s -> %s (暂不支持非 DNS UDP)", clientAddr, target)
-			// 这里可以扩展支持其他 UDP 流量
-		}
+// reply 把响应数据报（已含 SOCKS5 UDP 头）发回客户端
+func (a *udpAssociation) reply(datagram []byte) {
+	a.mu.Lock()
+	peer := a.peer
+	a.mu.Unlock()
+	if peer == nil {
+		return
+	}
+	if _, err := a.conn.WriteToUDP(datagram, peer); err != nil && !isNormalCloseError(err) {
+		log.Printf("[UDP] %s 发送响应失败: %v", a.clientAddr, err)
 	}
 }
 
-func handleDNSQuery(udpConn *net.UDPConn, clientAddr *net.UDPAddr, dnsQuery []byte, socks5Header []byte) {
-	// 通过 DoH 查询（使用重命名后的函数）
-	dnsResponse, err := queryDoHForProxy(dnsQuery)
-	if err != nil {
-		log.Printf("[UDP-DNS] DoH 查询失败: %v", err)
+// sendDirect 经直连会话发送；会话尚未建立时先建立（在单独的协程中）并缓存数据报
+func (a *udpAssociation) sendDirect(target string, header, payload []byte) {
+	a.mu.Lock()
+	if a.closed {
+		a.mu.Unlock()
+		return
+	}
+	sess := a.sessions[target]
+	if sess == nil {
+		sess = &udpDirectSession{assoc: a, target: target, header: header}
+		a.sessions[target] = sess
+		go sess.open()
+	}
+	conn := sess.conn
+	if conn == nil {
+		if len(sess.pending) < udpSessionPending {
+			sess.pending = append(sess.pending, payload)
+		}
+		a.mu.Unlock()
 		return
 	}
+	a.mu.Unlock()
 
-	// 构建 SOCKS5 UDP 响应
-	response := make([]byte, 0, len(socks5Header)+len(dnsResponse))
-	response = append(response, socks5Header...)
-	response = append(response, dnsResponse...)
+	conn.Write(payload)
+}
 
-	// 发送响应
-	_, err = udpConn.WriteToUDP(response, clientAddr)
-	if err != nil {
-		log.Printf("[UDP-DNS] 发送响应失败: %v", err)
+func (a *udpAssociation) sendTunnel(frame []byte) {
+	a.mu.Lock()
+	if a.closed {
+		a.mu.Unlock()
 		return
 	}
+	t := a.tunnel
+	if t == nil {
+		if time.Now().Before(a.tunnelRetryAt) {
+			a.mu.Unlock()
+			return
+		}
+		t = newUDPTunnel(a)
+		a.tunnel = t
+		go t.run()
+	}
+	a.mu.Unlock()
 
-	log.Printf("[UDP-DNS] DoH 查询成功，响应 %d 字节", len(dnsResponse))
+	select {
+	case t.out <- frame:
+	case <-t.done:
+	default:
+		// 队列已满，按 UDP 语义丢弃
+	}
 }
 
-// ======================== HTTP 处理 ========================
+// tunnelClosed 通道结束后允许在 retryAt 之后重新建立
+func (a *udpAssociation) tunnelClosed(t *udpTunnel, retryAt time.Time) {
+	a.mu.Lock()
+	if a.tunnel == t {
+		a.tunnel = nil
+		a.tunnelRetryAt = retryAt
+	}
+	a.mu.Unlock()
+}
 
-func handleHTTP(conn net.Conn, clientAddr string, firstByte byte) {
-	// 将第一个字节放回缓冲区
-	reader := bufio.NewReader(io.MultiReader(
-		strings.NewReader(string(firstByte)),
-		conn,
-	))
+func (a *udpAssociation) close() {
+	a.mu.Lock()
+	a.closed = true
+	sessions := a.sessions
+	a.sessions = make(map[string]*udpDirectSession)
+	t := a.tunnel
+	a.mu.Unlock()
+
+	a.conn.Close()
+	for _, sess := range sessions {
+		if sess.conn != nil {
+			sess.conn.Close()
+		}
+	}
+	if t != nil {
+		t.close()
+	}
+}
 
-	// 读取 HTTP 请求行
-	requestLine, err := reader.ReadString('\n')
-	if err != nil {
-		return
+// udpDirectSession 直连目标的 UDP 会话；conn 和 pending 由 assoc.mu 保护
+type udpDirectSession struct {
+	assoc   *udpAssociation
+	target  string
+	header  []byte       // 该目标的 SOCKS5 UDP 头，响应时原样回填
+	conn    *net.UDPConn // 建立完成前为 nil
+	pending [][]byte     // 建立期间收到的数据报
+}
+
+// open 在锁外解析目标并创建套接字，发出缓存的数据报后开始接收响应
+func (s *udpDirectSession) open() {
+	a := s.assoc
+	raddr, err := net.ResolveUDPAddr("udp", s.target)
+	var conn *net.UDPConn
+	if err == nil {
+		conn, err = net.DialUDP("udp", nil, raddr)
 	}
 
-	parts := strings.Fields(requestLine)
-	if len(parts) < 3 {
+	a.mu.Lock()
+	if err != nil || a.closed || a.sessions[s.target] != s {
+		if a.sessions[s.target] == s {
+			delete(a.sessions, s.target)
+		}
+		a.mu.Unlock()
+		if conn != nil {
+			conn.Close()
+		}
+		if err != nil {
+			log.Printf("[UDP] %s 直连 %s 失败: %v", a.clientAddr, s.target, err)
+		}
 		return
 	}
+	// 在锁内发出缓存的数据报，之后到达的数据报不会抢在它们前面（UDP 写不会长时间阻塞）
+	for _, payload := range s.pending {
+		conn.Write(payload)
+	}
+	s.conn, s.pending = conn, nil
+	a.mu.Unlock()
+
+	log.Printf("[UDP] %s -> %s (直连)", a.clientAddr, s.target)
+	s.readLoop()
+}
 
-	method := parts[0]
-	requestURL := parts[1]
-	httpVersion := parts[2]
+func (s *udpDirectSession) readLoop() {
+	defer func() {
+		s.conn.Close()
+		s.assoc.mu.Lock()
+		if s.assoc.sessions[s.target] == s {
+			delete(s.assoc.sessions, s.target)
+		}
+		s.assoc.mu.Unlock()
+	}()
 
-	// 读取所有 headers
-	headers := make(map[string]string)
-	var headerLines []string
+	buf := make([]byte, 65535)
+	copy(buf, s.header)
 	for {
-		line, err := reader.ReadString('\n')
+		s.conn.SetReadDeadline(time.Now().Add(udpSessionIdle))
+		n, err := s.conn.Read(buf[len(s.header):])
 		if err != nil {
 			return
 		}
-		line = strings.TrimRight(line, "\r\n")
-		if line == "" {
-			break
-		}
-		headerLines = append(headerLines, line)
-		if idx := strings.Index(line, ":"); idx > 0 {
-			key := strings.TrimSpace(line[:idx])
-			value := strings.TrimSpace(line[idx+1:])
-			headers[strings.ToLower(key)] = value
-		}
+		s.assoc.reply(buf[:len(s.header)+n])
 	}
+}
 
-	switch method {
-	case "CONNECT":
-		// HTTPS 隧道代理 - 需要发送 200 响应
-		log.Printf("[HTTP-CONNECT] %s -> %s", clientAddr, requestURL)
-		if err := handleTunnel(conn, requestURL, clientAddr, modeHTTPConnect, ""); err != nil {
-			if !isNormalCloseError(err) {
-				log.Printf("[HTTP-CONNECT] %s 代理失败: %v", clientAddr, err)
-			}
-		}
+// udpTunnel 经 Worker 转发 UDP 的 WebSocket 通道。
+// 握手发送文本帧 "UDP"，之后每个二进制帧承载一个数据报：ATYP|ADDR|PORT|DATA
+type udpTunnel struct {
+	assoc *udpAssociation
+	out   chan []byte
+	done  chan struct{}
+	once  sync.Once
+}
 
-	case "GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH", "TRACE":
-		// HTTP 代理 - 直接转发，不发送 200 响应
-		log.Printf("[HTTP-%s] %s -> %s", method, clientAddr, requestURL)
+func newUDPTunnel(a *udpAssociation) *udpTunnel {
+	return &udpTunnel{
+		assoc: a,
+		out:   make(chan []byte, udpTunnelQueueLen),
+		done:  make(chan struct{}),
+	}
+}
 
-		var target string
-		var path string
-
-		if strings.HasPrefix(requestURL, "http://") {
-			// 解析完整 URL
-			urlWithoutScheme := strings.TrimPrefix(requestURL, "http://")
-			idx := strings.Index(urlWithoutScheme, "/")
-			if idx > 0 {
-				target = urlWithoutScheme[:idx]
-				path = urlWithoutScheme[idx:]
-			} else {
-				target = urlWithoutScheme
-				path = "/"
+func (t *udpTunnel) close() {
+	t.once.Do(func() { close(t.done) })
+}
+
+// run 建立通道并作为唯一的写协程发送数据报和保活帧
+func (t *udpTunnel) run() {
+	retryAt := time.Now().Add(udpTunnelRetry)
+	defer func() {
+		t.close()
+		t.assoc.tunnelClosed(t, retryAt)
+	}()
+
+	if !admit.acquireDial() {
+		return
+	}
+	// UDP 通道承载发往所有目标的数据报，固定使用默认服务端
+	wsConn, _, err := dialWebSocketWithECH(routes.Load().proxy, 2)
+	admit.releaseDial()
+	if err != nil {
+		log.Printf("[UDP] %s 建立 UDP 通道失败: %v", t.assoc.clientAddr, err)
+		return
+	}
+	defer wsConn.Close()
+
+	if err := wsConn.WriteMessage(websocket.TextMessage, []byte("UDP")); err != nil {
+		return
+	}
+	_, msg, err := wsConn.ReadMessage()
+	if err != nil {
+		return
+	}
+	if string(msg) != "CONNECTED" {
+		log.Printf("[UDP] %s 服务端不支持 UDP 通道: %s", t.assoc.clientAddr, msg)
+		return
+	}
+	log.Printf("[UDP] %s UDP 通道已建立", t.assoc.clientAddr)
+	retryAt = time.Time{}
+
+	go t.readLoop(wsConn)
+
+	ticker := time.NewTicker(10 * time.Second)
+	defer ticker.Stop()
+	for {
+		select {
+		case frame := <-t.out:
+			if err := wsConn.WriteMessage(websocket.BinaryMessage, frame); err != nil {
+				return
 			}
-		} else {
-			// 相对路径，从 Host header 获取
-			target = headers["host"]
-			path = requestURL
+		case <-ticker.C:
+			if err := wsConn.WriteMessage(websocket.PingMessage, nil); err != nil {
+				return
+			}
+		case <-t.done:
+			return
 		}
+	}
+}
 
-		if target == "" {
-			conn.Write([]byte("HTTP/1.1 400 Bad Request\r\n\r\n"))
+func (t *udpTunnel) readLoop(wsConn *websocket.Conn) {
+	defer t.close()
+	for {
+		mt, msg, err := wsConn.ReadMessage()
+		if err != nil {
 			return
 		}
-
-		// 添加默认端口
-		if !strings.Contains(target, ":") {
-			target += ":80"
+		if mt == websocket.TextMessage {
+			// 例如 "ERROR:..."：Worker 无法转发该目标，记录后继续
+			log.Printf("[UDP] %s 服务端: %s", t.assoc.clientAddr, msg)
+			continue
 		}
+		datagram := make([]byte, 3+len(msg))
+		copy(datagram[3:], msg)
+		t.assoc.reply(datagram)
+	}
+}
 
-		// 重构 HTTP 请求（去掉完整 URL，使用相对路径）
-		var requestBuilder strings.Builder
-		requestBuilder.WriteString(fmt.Sprintf("%s %s %s\r\n", method, path, httpVersion))
+func handleDNSQuery(udpConn *net.UDPConn, clientAddr *net.UDPAddr, dnsQuery []byte, socks5Header []byte) {
+	// 通过 DoH 查询（使用重命名后的函数）
+	dnsResponse, err := queryDoHForProxy(dnsQuery)
+	if err != nil {
+		log.Printf("[UDP-DNS] DoH 查询失败: %v", err)
+		return
+	}
 
-		// 写入 headers（过滤掉 Proxy-Connection）
-		for _, line := range headerLines {
-			key := strings.Split(line, ":")[0]
-			keyLower := strings.ToLower(strings.TrimSpace(key))
-			if keyLower != "proxy-connection" && keyLower != "proxy-authorization" {
-				requestBuilder.WriteString(line)
-				requestBuilder.WriteString("\r\n")
-			}
+	// 构建 SOCKS5 UDP 响应
+	response := make([]byte, 0, len(socks5Header)+len(dnsResponse))
+	response = append(response, socks5Header...)
+	response = append(response, dnsResponse...)
+
+	// 发送响应
+	_, err = udpConn.WriteToUDP(response, clientAddr)
+	if err != nil {
+		log.Printf("[UDP-DNS] 发送响应失败: %v", err)
+		return
+	}
+
+	log.Printf("[UDP-DNS] DoH 查询成功，响应 %d 字节", len(dnsResponse))
+}
+
+// ======================== HTTP 处理 ========================
+
+func handleHTTP(conn net.Conn, clientAddr string, firstByte byte) {
+	// 将第一个字节放回缓冲区
+	reader := bufio.NewReader(io.MultiReader(
+		strings.NewReader(string(firstByte)),
+		conn,
+	))
+
+	// 同一客户端连接上的请求按顺序逐个处理：上一个响应完整写回后才读取下一个请求，
+	// 流水线发来的请求留在读缓冲中等待，响应不会交错
+	for {
+		req, err := http.ReadRequest(reader)
+		if err != nil {
+			return
 		}
-		requestBuilder.WriteString("\r\n")
 
-		// 如果有请求体，需要读取并附加
-		if contentLength := headers["content-length"]; contentLength != "" {
-			var length int
-			fmt.Sscanf(contentLength, "%d", &length)
-			if length > 0 && length < 10*1024*1024 { // 限制 10MB
-				body := make([]byte, length)
-				if _, err := io.ReadFull(reader, body); err == nil {
-					requestBuilder.Write(body)
+		switch req.Method {
+		case "CONNECT":
+			// HTTPS 隧道代理 - 需要发送 200 响应
+			log.Printf("[HTTP-CONNECT] %s -> %s", clientAddr, req.Host)
+			// 客户端可能已把后续数据紧跟请求发出，读缓冲中有数据时先交还给隧道
+			var tunnelConn net.Conn = conn
+			if reader.Buffered() > 0 {
+				tunnelConn = &bufferedConn{Conn: conn, r: reader}
+			}
+			if err := handleTunnel(tunnelConn, req.Host, clientAddr, modeHTTPConnect, nil); err != nil {
+				if !isNormalCloseError(err) {
+					log.Printf("[HTTP-CONNECT] %s 代理失败: %v", clientAddr, err)
 				}
 			}
-		}
-
-		firstFrame := requestBuilder.String()
+			return
 
-		// 使用 modeHTTPProxy 模式（不发送 200 响应）
-		if err := handleTunnel(conn, target, clientAddr, modeHTTPProxy, firstFrame); err != nil {
-			if !isNormalCloseError(err) {
-				log.Printf("[HTTP-%s] %s 代理失败: %v", method, clientAddr, err)
+		case "GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH", "TRACE":
+			// HTTP 代理 - 直接转发，不发送 200 响应
+			log.Printf("[HTTP-%s] %s -> %s", req.Method, clientAddr, req.RequestURI)
+			keepAlive, err := proxyHTTPRequest(conn, reader, req, clientAddr)
+			if err != nil {
+				if !isNormalCloseError(err) {
+					log.Printf("[HTTP-%s] %s 代理失败: %v", req.Method, clientAddr, err)
+				}
+				return
 			}
-		}
+			if !keepAlive {
+				return
+			}
+			conn.SetReadDeadline(time.Now().Add(httpClientIdleTimeout))
 
-	default:
-		log.Printf("[HTTP] %s 不支持的方法: %s", clientAddr, method)
-		conn.Write([]byte("HTTP/1.1 405 Method Not Allowed\r\n\r\n"))
+		default:
+			log.Printf("[HTTP] %s 不支持的方法: %s", clientAddr, req.Method)
+			conn.Write([]byte("HTTP/1.1 405 Method Not Allowed\r\n\r\n"))
+			return
+		}
 	}
 }
 
-// ======================== 通用隧道处理 ========================
+// bufferedConn 先读出 bufio.Reader 中已缓冲的数据，再读底层连接
+type bufferedConn struct {
+	net.Conn
+	r *bufio.Reader
+}
+
+func (c *bufferedConn) Read(p []byte) (int, error) {
+	return c.r.Read(p)
+}
+
+// ======================== HTTP 代理连接复用 ========================
 
-// 代理模式常量
 const (
-	modeSOCKS5      = 1 // SOCKS5 代理
-	modeHTTPConnect = 2 // HTTP CONNECT 隧道
-	modeHTTPProxy   = 3 // HTTP 普通代理（GET/POST等）
+	// httpIdleTimeout 到源站的空闲连接在池中保留的时长
+	httpIdleTimeout = 30 * time.Second
+	// httpMaxIdlePerOrigin 每个源站最多保留的空闲连接数
+	httpMaxIdlePerOrigin = 4
+	// httpClientIdleTimeout 客户端连接在两个请求之间允许空闲的时长
+	httpClientIdleTimeout = 60 * time.Second
 )
 
-func handleTunnel(conn net.Conn, target, clientAddr string, mode int, firstFrame string) error {
-	wsConn, err := dialWebSocketWithECH(2)
-	if err != nil {
-		sendErrorResponse(conn, mode)
-		return err
+// originConn 到源站的一条可复用连接：经 Worker 的隧道，或分流规则命中时的直连 TCP。
+// 读写经过它时按当前请求累加字节数
+type originConn struct {
+	target string
+	direct bool
+	rw     io.ReadWriteCloser
+	br     *bufio.Reader
+	bw     *bufio.Writer
+	stat   *connStat // 当前占用这条连接的请求
+	idle   time.Time
+}
+
+func (oc *originConn) Read(p []byte) (int, error) {
+	n, err := oc.rw.Read(p)
+	if n > 0 {
+		oc.stat.down.Add(int64(n))
+		if oc.direct {
+			metrics.directBytesDown.Add(int64(n))
+		} else {
+			metrics.tunnelBytesDown.Add(int64(n))
+		}
 	}
-	defer wsConn.Close()
+	return n, err
+}
 
-	var mu sync.Mutex
+func (oc *originConn) Write(p []byte) (int, error) {
+	n, err := oc.rw.Write(p)
+	oc.countUp(n)
+	return n, err
+}
 
-	// 保活
-	stopPing := make(chan bool)
-	go func() {
-		ticker := time.NewTicker(10 * time.Second)
-		defer ticker.Stop()
-		for {
-			select {
-			case <-ticker.C:
-				mu.Lock()
-				wsConn.WriteMessage(websocket.PingMessage, nil)
-				mu.Unlock()
-			case <-stopPing:
-				return
-			}
+func (oc *originConn) countUp(n int) {
+	if n > 0 {
+		oc.stat.up.Add(int64(n))
+		if oc.direct {
+			metrics.directBytesUp.Add(int64(n))
+		} else {
+			metrics.tunnelBytesUp.Add(int64(n))
 		}
-	}()
-	defer close(stopPing)
+	}
+}
 
-	conn.SetDeadline(time.Time{})
+func (oc *originConn) close() {
+	oc.rw.Close()
+	if oc.direct {
+		metrics.directActive.Add(-1)
+	} else {
+		metrics.tunnelsActive.Add(-1)
+	}
+}
 
-	// 如果没有预设的 firstFrame，尝试读取第一帧数据（仅 SOCKS5）
-	if firstFrame == "" && mode == modeSOCKS5 {
-		_ = conn.SetReadDeadline(time.Now().Add(100 * time.Millisecond))
-		buffer := make([]byte, 32768)
-		n, _ := conn.Read(buffer)
-		_ = conn.SetReadDeadline(time.Time{})
-		if n > 0 {
-			firstFrame = string(buffer[:n])
+// dialOrigin 建立到源站的新连接。first 是已序列化的完整请求（可为空），
+// 经隧道时随连接请求一起发出，省去一次往返
+func dialOrigin(target string, first []byte, stat *connStat) (*originConn, error) {
+	up := routes.Load().resolve(target)
+	oc := &originConn{target: target, direct: up == nil, stat: stat}
+	if oc.direct {
+		remote, err := net.DialTimeout("tcp", target, 10*time.Second)
+		if err != nil {
+			metrics.fail(failDirectDial)
+			return nil, err
 		}
+		metrics.directTotal.Add(1)
+		metrics.directActive.Add(1)
+		oc.rw = remote
+	} else {
+		t, err := dialTunnel(up)
+		if err != nil {
+			return nil, err
+		}
+		if err := t.connect(target, first, nil); err != nil {
+			t.Close()
+			return nil, err
+		}
+		up.tunnels.Add(1)
+		metrics.tunnelsTotal.Add(1)
+		metrics.tunnelsActive.Add(1)
+		oc.rw = &tunnelStream{wsTunnel: t}
 	}
+	oc.br = bufio.NewReaderSize(oc, relayBufSize)
+	oc.bw = bufio.NewWriterSize(oc, relayBufSize)
 
-	// 发送连接请求
-	connectMsg := fmt.Sprintf("CONNECT:%s|%s", target, firstFrame)
-	mu.Lock()
-	err = wsConn.WriteMessage(websocket.TextMessage, []byte(connectMsg))
-	mu.Unlock()
-	if err != nil {
-		sendErrorResponse(conn, mode)
-		return err
+	if oc.direct && len(first) > 0 {
+		if _, err := oc.Write(first); err != nil {
+			oc.close()
+			return nil, err
+		}
+	} else {
+		oc.countUp(len(first))
 	}
+	return oc, nil
+}
 
-	// 等待响应
-	_, msg, err := wsConn.ReadMessage()
-	if err != nil {
-		sendErrorResponse(conn, mode)
-		return err
+// originPool 按源站保存空闲连接，优先复用最近放回的连接；
+// 有空闲连接时由定时器周期性关闭超过 httpIdleTimeout 的连接
+type originPool struct {
+	mu       sync.Mutex
+	idle     map[string][]*originConn
+	sweeping bool
+}
+
+var httpPool = &originPool{idle: make(map[string][]*originConn)}
+
+// get 取出一条到 target 的空闲连接，没有时返回 nil
+func (p *originPool) get(target string) *originConn {
+	var expired []*originConn
+	var oc *originConn
+
+	p.mu.Lock()
+	conns := p.idle[target]
+	for len(conns) > 0 {
+		last := conns[len(conns)-1]
+		conns = conns[:len(conns)-1]
+		if time.Since(last.idle) < httpIdleTimeout {
+			oc = last
+			break
+		}
+		expired = append(expired, last)
 	}
+	if len(conns) == 0 {
+		delete(p.idle, target)
+	} else {
+		p.idle[target] = conns
+	}
+	p.mu.Unlock()
 
-	response := string(msg)
-	if strings.HasPrefix(response, "ERROR:") {
-		sendErrorResponse(conn, mode)
-		return errors.New(response)
+	for _, c := range expired {
+		c.close()
 	}
-	if response != "CONNECTED" {
-		sendErrorResponse(conn, mode)
-		return fmt.Errorf("意外响应: %s", response)
+	return oc
+}
+
+// put 把完成一次请求的连接放回池中，超出每个源站的上限时关闭最旧的一条
+func (p *originPool) put(oc *originConn) {
+	oc.stat = nil
+	oc.idle = time.Now()
+
+	var evicted *originConn
+	p.mu.Lock()
+	conns := append(p.idle[oc.target], oc)
+	if len(conns) > httpMaxIdlePerOrigin {
+		evicted = conns[0]
+		conns = conns[1:]
+	}
+	p.idle[oc.target] = conns
+	if !p.sweeping {
+		p.sweeping = true
+		time.AfterFunc(httpIdleTimeout, p.sweep)
 	}
+	p.mu.Unlock()
 
-	// 发送成功响应（根据模式不同而不同）
-	if err := sendSuccessResponse(conn, mode); err != nil {
-		return err
+	if evicted != nil {
+		evicted.close()
 	}
+}
 
-	log.Printf("[代理] %s 已连接: %s", clientAddr, target)
+// closeIdle 关闭所有空闲连接，用于服务端或分流规则变化后不再复用按旧配置建立的连接
+func (p *originPool) closeIdle() {
+	p.mu.Lock()
+	idle := p.idle
+	p.idle = make(map[string][]*originConn)
+	p.mu.Unlock()
 
-	// 双向转发
-	done := make(chan bool, 2)
+	for _, conns := range idle {
+		for _, c := range conns {
+			c.close()
+		}
+	}
+}
 
-	// Client -> Server
-	go func() {
-		buf := make([]byte, 32768)
-		for {
-			n, err := conn.Read(buf)
-			if err != nil {
-				mu.Lock()
-				wsConn.WriteMessage(websocket.TextMessage, []byte("CLOSE"))
-				mu.Unlock()
-				done <- true
-				return
-			}
+func (p *originPool) sweep() {
+	var expired []*originConn
 
-			mu.Lock()
-			err = wsConn.WriteMessage(websocket.BinaryMessage, buf[:n])
-			mu.Unlock()
-			if err != nil {
-				done <- true
-				return
+	p.mu.Lock()
+	for target, conns := range p.idle {
+		kept := conns[:0]
+		for _, c := range conns {
+			if time.Since(c.idle) < httpIdleTimeout {
+				kept = append(kept, c)
+			} else {
+				expired = append(expired, c)
 			}
 		}
-	}()
+		if len(kept) == 0 {
+			delete(p.idle, target)
+		} else {
+			p.idle[target] = kept
+		}
+	}
+	if len(p.idle) > 0 {
+		time.AfterFunc(httpIdleTimeout, p.sweep)
+	} else {
+		p.sweeping = false
+	}
+	p.mu.Unlock()
 
-	// Server -> Client
-	go func() {
-		for {
-			mt, msg, err := wsConn.ReadMessage()
-			if err != nil {
-				done <- true
-				return
-			}
+	for _, c := range expired {
+		c.close()
+	}
+}
 
-			if mt == websocket.TextMessage {
-				if string(msg) == "CLOSE" {
-					done <- true
-					return
-				}
+// tunnelStream 把已连接的隧道包装成字节流，供按 HTTP 报文边界读写
+type tunnelStream struct {
+	*wsTunnel
+	r   io.Reader // 正在读取的消息
+	eof bool
+}
+
+func (s *tunnelStream) Read(p []byte) (int, error) {
+	for !s.eof {
+		if s.r != nil {
+			n, err := s.r.Read(p)
+			if err == io.EOF {
+				s.r = nil
+				err = nil
+			}
+			if n > 0 || err != nil {
+				return n, err
 			}
+			continue
+		}
 
-			if _, err := conn.Write(msg); err != nil {
-				done <- true
-				return
+		mt, r, err := s.ws.NextReader()
+		if err != nil {
+			return 0, err
+		}
+		if mt == websocket.TextMessage {
+			// 文本帧只用于控制消息，体积很小
+			msg, _ := io.ReadAll(io.LimitReader(r, int64(len("CLOSE")+1)))
+			if string(msg) == "CLOSE" {
+				s.eof = true
+				break
 			}
+			r = bytes.NewReader(msg)
 		}
-	}()
+		s.r = r
+	}
+	return 0, io.EOF
+}
 
-	<-done
-	log.Printf("[代理] %s 已断开: %s", clientAddr, target)
+// Write 把数据拷贝进池化缓冲区后交给写协程，调用方可以立即复用 p
+func (s *tunnelStream) Write(p []byte) (int, error) {
+	written := 0
+	for written < len(p) {
+		buf := getRelayBuf()
+		n := copy(*buf, p[written:])
+		if err := s.writer.WriteFrame(wsFrame{messageType: websocket.BinaryMessage, data: (*buf)[:n], buf: buf}); err != nil {
+			return written, err
+		}
+		written += n
+	}
+	return written, nil
+}
+
+func (s *tunnelStream) Close() error {
+	s.writer.WriteFrame(wsFrame{messageType: websocket.TextMessage, data: []byte("CLOSE")})
+	s.wsTunnel.Close()
 	return nil
 }
 
-// ======================== 响应辅助函数 ========================
+// proxyHTTPRequest 把一个普通代理请求转发给源站，并把完整响应写回客户端；
+// 返回客户端连接能否继续发送下一个请求
+func proxyHTTPRequest(conn net.Conn, reader *bufio.Reader, req *http.Request, clientAddr string) (bool, error) {
+	// 绝对 URL 时 req.Host 取自 URL，否则取自 Host 头
+	if req.Host == "" {
+		conn.Write([]byte("HTTP/1.1 400 Bad Request\r\n\r\n"))
+		return false, nil
+	}
+	hostURL := url.URL{Host: req.Host}
+	port := hostURL.Port()
+	if port == "" {
+		port = "80"
+	}
+	target := net.JoinHostPort(hostURL.Hostname(), port)
 
-func sendErrorResponse(conn net.Conn, mode int) {
-	switch mode {
-	case modeSOCKS5:
-		conn.Write([]byte{0x05, 0x04, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00})
-	case modeHTTPConnect, modeHTTPProxy:
-		conn.Write([]byte("HTTP/1.1 502 Bad Gateway\r\n\r\n"))
+	// 请求头和请求体已经读完，后续读写不再受握手阶段的超时限制
+	conn.SetDeadline(time.Time{})
+
+	req.Header.Del("Proxy-Connection")
+	req.Header.Del("Proxy-Authorization")
+	if _, ok := req.Header["User-Agent"]; !ok {
+		// 客户端没带 User-Agent 时不要让 req.Write 补上 Go 的默认值
+		req.Header["User-Agent"] = []string{""}
+	}
+	if req.ProtoAtLeast(1, 1) && strings.EqualFold(req.Header.Get("Expect"), "100-continue") {
+		// 由代理直接应答 100 Continue，请求体随请求头一起转发
+		req.Header.Del("Expect")
+		if _, err := conn.Write([]byte("HTTP/1.1 100 Continue\r\n\r\n")); err != nil {
+			return false, err
+		}
 	}
-}
+
+	stat := trackConn(clientAddr, target, modeHTTPProxy, routes.Load().resolve(target))
+	defer stat.done()
+
+	oc, resp, err := roundTripOrigin(req, target, stat)
+	if err == errDialQueueTimeout {
+		sendOverloadResponse(conn, modeHTTPProxy)
+		return false, err
+	}
+	if err != nil {
+		sendErrorResponse(conn, modeHTTPProxy)
+		return false, err
+	}
+
+	// 1xx 中间响应原样转发，继续读取最终响应
+	for resp.StatusCode >= 100 && resp.StatusCode < 200 && resp.StatusCode != http.StatusSwitchingProtocols {
+		if err := writeResponseHead(conn, resp, nil); err != nil {
+			oc.close()
+			return false, err
+		}
+		if resp, err = http.ReadResponse(oc.br, req); err != nil {
+			oc.close()
+			return false, err
+		}
+	}
+
+	if resp.StatusCode == http.StatusSwitchingProtocols {
+		// 协议升级（如 WebSocket）后连接不再是 HTTP，改为双向原样转发
+		defer oc.close()
+		if err := writeResponseHead(conn, resp, nil); err != nil {
+			return false, err
+		}
+		done := make(chan bool, 2)
+		go func() {
+			io.Copy(oc, reader)
+			done <- true
+		}()
+		go func() {
+			io.Copy(writerOnly{conn}, oc.br)
+			done <- true
+		}()
+		<-done
+		return false, nil
+	}
+
+	keepAlive, reusable, err := writeProxyResponse(conn, resp, req)
+	resp.Body.Close()
+	if err != nil || !reusable {
+		oc.close()
+	} else {
+		httpPool.put(oc)
+	}
+	return keepAlive, err
+}
+
+// roundTripOrigin 发出请求并读取响应头，优先复用到该源站的空闲连接。
+// 复用的连接可能已被对端关闭，没有请求体的请求此时换一条新连接重试
+func roundTripOrigin(req *http.Request, target string, stat *connStat) (*originConn, *http.Response, error) {
+	for {
+		oc := httpPool.get(target)
+		reused := oc != nil
+		if reused {
+			metrics.httpReused.Add(1)
+			oc.stat = stat
+			if err := writeRequest(oc, req); err != nil {
+				oc.close()
+				if req.Body == http.NoBody {
+					continue
+				}
+				return nil, nil, err
+			}
+		} else {
+			metrics.httpDialed.Add(1)
+			// 没有请求体时整个请求随连接请求一起发出
+			var first []byte
+			if req.Body == http.NoBody {
+				var buf bytes.Buffer
+				if err := req.Write(&buf); err != nil {
+					return nil, nil, err
+				}
+				first = buf.Bytes()
+			}
+			var err error
+			if oc, err = dialOrigin(target, first, stat); err != nil {
+				return nil, nil, err
+			}
+			if first == nil {
+				if err := writeRequest(oc, req); err != nil {
+					oc.close()
+					return nil, nil, err
+				}
+			}
+		}
+
+		resp, err := http.ReadResponse(oc.br, req)
+		if err != nil {
+			oc.close()
+			if reused && req.Body == http.NoBody {
+				continue
+			}
+			return nil, nil, err
+		}
+		return oc, resp, nil
+	}
+}
+
+func writeRequest(oc *originConn, req *http.Request) error {
+	if err := req.Write(oc.bw); err != nil {
+		return err
+	}
+	return oc.bw.Flush()
+}
+
+// writeResponseHead 写出状态行和响应头；extra 为追加的逐跳头
+func writeResponseHead(w io.Writer, resp *http.Response, extra []string) error {
+	bw := bufio.NewWriter(w)
+	fmt.Fprintf(bw, "%s %s\r\n", resp.Proto, resp.Status)
+	resp.Header.Write(bw)
+	for _, line := range extra {
+		bw.WriteString(line)
+		bw.WriteString("\r\n")
+	}
+	bw.WriteString("\r\n")
+	return bw.Flush()
+}
+
+// writeProxyResponse 把最终响应写回客户端。响应体边读边写，流式响应不会积压在缓冲区里。
+// 返回客户端连接能否继续使用、到源站的连接能否放回池中
+func writeProxyResponse(conn net.Conn, resp *http.Response, req *http.Request) (keepAlive, reusable bool, err error) {
+	bodyless := req.Method == "HEAD" || resp.StatusCode == http.StatusNoContent || resp.StatusCode == http.StatusNotModified
+	originChunked := len(resp.TransferEncoding) > 0 && resp.TransferEncoding[0] == "chunked"
+
+	// 没有长度也不分块的响应体以源站关闭连接为结束，两端连接都不能复用；
+	// HTTP/1.0 客户端不认识分块编码，同样改为以关闭连接结束
+	reusable = !resp.Close && !req.Close && (bodyless || resp.ContentLength >= 0 || originChunked)
+	chunked := !bodyless && resp.ContentLength < 0 && originChunked && req.ProtoAtLeast(1, 1)
+	keepAlive = !resp.Close && !req.Close && req.ProtoAtLeast(1, 1) && (bodyless || resp.ContentLength >= 0 || chunked)
+
+	resp.Header.Del("Connection")
+	resp.Header.Del("Keep-Alive")
+	var extra []string
+	if chunked {
+		extra = append(extra, "Transfer-Encoding: chunked")
+	}
+	if !keepAlive {
+		extra = append(extra, "Connection: close")
+	}
+	if err := writeResponseHead(conn, resp, extra); err != nil {
+		return false, false, err
+	}
+	if bodyless {
+		return keepAlive, reusable, nil
+	}
+
+	buf := getRelayBuf()
+	defer putRelayBuf(buf)
+	if !chunked {
+		_, err = io.CopyBuffer(writerOnly{conn}, resp.Body, *buf)
+		return keepAlive, reusable, err
+	}
+
+	cw := httputil.NewChunkedWriter(conn)
+	if _, err = io.CopyBuffer(cw, resp.Body, *buf); err != nil {
+		return false, false, err
+	}
+	cw.Close()
+	bw := bufio.NewWriter(conn)
+	resp.Trailer.Write(bw)
+	bw.WriteString("\r\n")
+	return keepAlive, reusable, bw.Flush()
+}
+
+// ======================== 分流规则 ========================
+
+// routeCacheSize 每个主机的分流结果缓存上限，满后整体清空
+const routeCacheSize = 4096
+
+// defaultDirectDomains bypass_cn 模式下直连的域名后缀，与 gui.py 系统代理绕过列表一致
+var defaultDirectDomains = []string{
+	"cn", "com.cn", "net.cn", "org.cn", "gov.cn", "edu.cn",
+	"baidu.com", "qq.com", "taobao.com", "tmall.com", "alipay.com",
+	"weibo.com", "sina.com", "163.com", "126.com", "sohu.com",
+	"youku.com", "iqiyi.com", "bilibili.com", "douyin.com", "douban.com",
+	"zhihu.com", "jd.com", "alibaba.com", "1688.com",
+	"tencent.com", "weixin.qq.com", "qzone.com",
+	"localhost", "local",
+}
+
+// privateRanges 本地和内网地址，bypass_cn 模式下始终直连
+var privateRanges = []string{
+	"0.0.0.0/8", "10.0.0.0/8", "100.64.0.0/10", "127.0.0.0/8",
+	"169.254.0.0/16", "172.16.0.0/12", "192.168.0.0/16",
+}
+
+// ipRange IPv4 闭区间
+type ipRange struct {
+	start, end uint32
+}
+
+// routeTable 编译后的分流规则：IPv4 区间有序数组二分查找，域名按后缀逐级查集合。
+// 策略规则（见 compilePolicy）先于分流模式匹配，结果按主机缓存
+type routeTable struct {
+	mode    string
+	ranges  []ipRange
+	domains map[string]bool
+
+	proxy         *upstream   // 默认服务端
+	upstreams     []*upstream // 默认服务端在前，其余按名称排序
+	policyDomains *domainTrie
+	policyRanges  []policyRange
+	policyTargets []*upstream // 规则序号 -> 服务端，nil 表示直连
+
+	cacheMu sync.Mutex
+	cache   map[string]*upstream
+}
+
+// routes 当前生效的分流规则，由 main 加载并在重新加载配置时整体替换；默认全部经服务端
+var routes atomic.Pointer[routeTable]
+
+func init() {
+	routes.Store(&routeTable{mode: "global"})
+}
+
+// loadRouteTable 按 s 中的分流模式、中国大陆 IP 列表、服务端和策略规则编译路由表
+func loadRouteTable(s *proxySettings) (*routeTable, error) {
+	mode, cnIPFile := s.Routing, s.CNIPList
+	t := &routeTable{
+		mode:    mode,
+		domains: make(map[string]bool),
+		cache:   make(map[string]*upstream),
+	}
+	if err := t.compilePolicy(s); err != nil {
+		return nil, err
+	}
+
+	switch mode {
+	case "global", "direct":
+		return t, nil
+	case "bypass_cn":
+	default:
+		return nil, fmt.Errorf("未知的分流模式: %s", mode)
+	}
+
+	for _, d := range defaultDirectDomains {
+		t.domains[d] = true
+	}
+	for _, cidr := range privateRanges {
+		if r, ok := parseIPRange(cidr); ok {
+			t.ranges = append(t.ranges, r)
+		}
+	}
+
+	if cnIPFile == "" {
+		log.Printf("[分流] 未指定中国大陆 IP 列表，仅按域名后缀和内网地址直连")
+	} else {
+		data, err := os.ReadFile(cnIPFile)
+		if err != nil {
+			return nil, err
+		}
+		for _, line := range strings.Split(string(data), "\n") {
+			if r, ok := parseIPRange(line); ok {
+				t.ranges = append(t.ranges, r)
+			}
+		}
+	}
+	t.ranges = mergeIPRanges(t.ranges)
+
+	log.Printf("[分流] 跳过中国大陆: %d 个 IP 区间, %d 个域名后缀", len(t.ranges), len(t.domains))
+	return t, nil
+}
+
+// parseIPRange 解析 "起始IP 结束IP"、CIDR 或单个 IPv4 地址，忽略注释和空行
+func parseIPRange(line string) (ipRange, bool) {
+	line = strings.TrimSpace(line)
+	if line == "" || strings.HasPrefix(line, "#") {
+		return ipRange{}, false
+	}
+
+	fields := strings.Fields(line)
+	if len(fields) >= 2 {
+		start, ok1 := ipv4ToUint(net.ParseIP(fields[0]))
+		end, ok2 := ipv4ToUint(net.ParseIP(fields[1]))
+		if !ok1 || !ok2 || start > end {
+			return ipRange{}, false
+		}
+		return ipRange{start, end}, true
+	}
+
+	if _, ipNet, err := net.ParseCIDR(fields[0]); err == nil {
+		start, ok := ipv4ToUint(ipNet.IP)
+		ones, bits := ipNet.Mask.Size()
+		if !ok || bits != 32 {
+			return ipRange{}, false
+		}
+		return ipRange{start, start | (1<<(32-ones) - 1)}, true
+	}
+
+	ip, ok := ipv4ToUint(net.ParseIP(fields[0]))
+	return ipRange{ip, ip}, ok
+}
+
+func ipv4ToUint(ip net.IP) (uint32, bool) {
+	ip4 := ip.To4()
+	if ip4 == nil {
+		return 0, false
+	}
+	return binary.BigEndian.Uint32(ip4), true
+}
+
+func uintToIPv4(v uint32) net.IP {
+	ip := make(net.IP, 4)
+	binary.BigEndian.PutUint32(ip, v)
+	return ip
+}
+
+// mergeIPRanges 排序并合并重叠或相邻的区间
+func mergeIPRanges(ranges []ipRange) []ipRange {
+	sort.Slice(ranges, func(i, j int) bool { return ranges[i].start < ranges[j].start })
+
+	merged := ranges[:0]
+	for _, r := range ranges {
+		if n := len(merged); n > 0 && uint64(r.start) <= uint64(merged[n-1].end)+1 {
+			if r.end > merged[n-1].end {
+				merged[n-1].end = r.end
+			}
+			continue
+		}
+		merged = append(merged, r)
+	}
+	return merged
+}
+
+// isDirect 判断目标（host:port）是否直连，结果按主机缓存
+func (t *routeTable) isDirect(target string) bool {
+	return t.resolve(target) == nil
+}
+
+// resolve 返回连接 target 使用的服务端，nil 表示直连
+func (t *routeTable) resolve(target string) *upstream {
+	if len(t.policyTargets) == 0 {
+		switch t.mode {
+		case "direct":
+			return nil
+		case "bypass_cn":
+		default:
+			return t.proxy
+		}
+	}
+
+	host, _, err := net.SplitHostPort(target)
+	if err != nil {
+		host = target
+	}
+	host = strings.ToLower(strings.TrimSuffix(host, "."))
+
+	t.cacheMu.Lock()
+	up, ok := t.cache[host]
+	t.cacheMu.Unlock()
+	if ok {
+		return up
+	}
+
+	up = t.proxy
+	if rule := t.matchPolicy(host); rule >= 0 {
+		up = t.policyTargets[rule]
+	} else if t.mode == "direct" || (t.mode == "bypass_cn" && t.match(host)) {
+		up = nil
+	}
+
+	t.cacheMu.Lock()
+	if len(t.cache) >= routeCacheSize {
+		t.cache = make(map[string]*upstream)
+	}
+	t.cache[host] = up
+	t.cacheMu.Unlock()
+	return up
+}
+
+func (t *routeTable) match(host string) bool {
+	if ip := net.ParseIP(host); ip != nil {
+		v, ok := ipv4ToUint(ip)
+		if !ok {
+			return ip.IsLoopback() || ip.IsPrivate() || ip.IsLinkLocalUnicast()
+		}
+		i := sort.Search(len(t.ranges), func(i int) bool { return t.ranges[i].end >= v })
+		return i < len(t.ranges) && t.ranges[i].start <= v
+	}
+
+	// 由长到短依次检查域名后缀：a.b.example.com -> b.example.com -> example.com -> com
+	for suffix := host; suffix != ""; {
+		if t.domains[suffix] {
+			return true
+		}
+		idx := strings.IndexByte(suffix, '.')
+		if idx < 0 {
+			break
+		}
+		suffix = suffix[idx+1:]
+	}
+	return false
+}
+
+// handleDirect 直接连接目标，不经过 Worker
+func handleDirect(conn net.Conn, target, clientAddr string, mode int, firstFrame []byte) error {
+	remote, err := net.DialTimeout("tcp", target, 10*time.Second)
+	if err != nil {
+		metrics.fail(failDirectDial)
+		sendErrorResponse(conn, mode)
+		return err
+	}
+	defer remote.Close()
+
+	conn.SetDeadline(time.Time{})
+	if err := sendSuccessResponse(conn, mode); err != nil {
+		return err
+	}
+	if len(firstFrame) > 0 {
+		if _, err := remote.Write(firstFrame); err != nil {
+			return err
+		}
+	}
+
+	log.Printf("[直连] %s 已连接: %s", clientAddr, target)
+	metrics.directTotal.Add(1)
+	metrics.directActive.Add(1)
+	defer metrics.directActive.Add(-1)
+	stat := trackConn(clientAddr, target, mode, nil)
+	defer stat.done()
+
+	done := make(chan bool, 2)
+	go func() {
+		copyCounted(remote, conn, &stat.up, &metrics.directBytesUp)
+		if tc, ok := remote.(*net.TCPConn); ok {
+			tc.CloseWrite()
+		}
+		done <- true
+	}()
+	go func() {
+		copyCounted(conn, remote, &stat.down, &metrics.directBytesDown)
+		done <- true
+	}()
+
+	<-done
+	log.Printf("[直连] %s 已断开: %s", clientAddr, target)
+	return nil
+}
+
+// ======================== 策略路由 ========================
+
+// 规则目标中的保留名：直连 / 默认服务端；其余名称须在 upstreams 中定义
+const (
+	policyDirect = "DIRECT"
+	policyProxy  = "PROXY"
+)
+
+// upstreamConfig -conf 中 upstreams 的一项，规则按 Name 引用
+type upstreamConfig struct {
+	Name   string `json:"name"`
+	Server string `json:"server"`
+	Token  string `json:"token"`
+	IP     string `json:"ip"`
+}
+
+// upstream 一个服务端（Worker）；随路由表一起在重新加载配置时整体替换
+type upstream struct {
+	name    string
+	server  string
+	token   string
+	edges   []string     // 解析后的优选 IP
+	tunnels atomic.Int64 // 经该服务端建立的隧道数
+}
+
+func newUpstream(name string, c upstreamConfig) (*upstream, error) {
+	if c.Server == "" {
+		return nil, fmt.Errorf("服务端 %s 的地址为空", name)
+	}
+	if _, _, _, err := parseServerAddr(c.Server); err != nil {
+		return nil, fmt.Errorf("服务端 %s: %w", name, err)
+	}
+	return &upstream{name: name, server: c.Server, token: c.Token, edges: parseEdgeCandidates(c.IP)}, nil
+}
+
+// domainTrie 域名后缀树，按标签从右到左逐级向下（example.com -> com -> example）；
+// rule 为在该节点结束的规则序号，-1 表示没有
+type domainTrie struct {
+	children map[string]*domainTrie
+	rule     int
+}
+
+func newDomainTrie() *domainTrie {
+	return &domainTrie{children: make(map[string]*domainTrie), rule: -1}
+}
+
+// insert 登记后缀规则；同一后缀出现在多条规则中时保留靠前的一条
+func (d *domainTrie) insert(suffix string, rule int) {
+	node := d
+	for suffix != "" {
+		label := suffix
+		if idx := strings.LastIndexByte(suffix, '.'); idx >= 0 {
+			label, suffix = suffix[idx+1:], suffix[:idx]
+		} else {
+			suffix = ""
+		}
+		child := node.children[label]
+		if child == nil {
+			child = newDomainTrie()
+			node.children[label] = child
+		}
+		node = child
+	}
+	if node.rule < 0 {
+		node.rule = rule
+	}
+}
+
+// lookup 返回与 host 匹配的最长后缀规则序号，没有时返回 -1
+func (d *domainTrie) lookup(host string) int {
+	rule := -1
+	node := d
+	for host != "" {
+		label := host
+		if idx := strings.LastIndexByte(host, '.'); idx >= 0 {
+			label, host = host[idx+1:], host[:idx]
+		} else {
+			host = ""
+		}
+		if node = node.children[label]; node == nil {
+			break
+		}
+		if node.rule >= 0 {
+			rule = node.rule
+		}
+	}
+	return rule
+}
+
+// policyRange 一个 IPv4 区间及其规则序号
+type policyRange struct {
+	ipRange
+	rule int
+}
+
+// policyHeap 按规则序号排列的最小堆，供 compilePolicyRanges 扫描时取优先级最高的区间
+type policyHeap []policyRange
+
+func (h policyHeap) Len() int           { return len(h) }
+func (h policyHeap) Less(i, j int) bool { return h[i].rule < h[j].rule }
+func (h policyHeap) Swap(i, j int)      { h[i], h[j] = h[j], h[i] }
+func (h *policyHeap) Push(x any)        { *h = append(*h, x.(policyRange)) }
+func (h *policyHeap) Pop() any {
+	old := *h
+	x := old[len(old)-1]
+	*h = old[:len(old)-1]
+	return x
+}
+
+// compilePolicyRanges 把各规则的区间展开成互不重叠、按起点排序的数组，供二分查找；
+// 区间重叠时序号小（靠前）的规则优先，相邻且属于同一规则的区间合并
+func compilePolicyRanges(in []policyRange) []policyRange {
+	if len(in) == 0 {
+		return nil
+	}
+	sort.Slice(in, func(i, j int) bool { return in[i].start < in[j].start })
+	points := make([]uint64, 0, 2*len(in))
+	for _, r := range in {
+		points = append(points, uint64(r.start), uint64(r.end)+1)
+	}
+	sort.Slice(points, func(i, j int) bool { return points[i] < points[j] })
+
+	var out []policyRange
+	active := &policyHeap{}
+	next := 0
+	for k := 0; k+1 < len(points); k++ {
+		p := points[k]
+		if p == points[k+1] {
+			continue
+		}
+		for next < len(in) && uint64(in[next].start) <= p {
+			heap.Push(active, in[next])
+			next++
+		}
+		// 已结束的区间只在到达堆顶时移除，堆顶之外的不影响结果
+		for active.Len() > 0 && uint64((*active)[0].end) < p {
+			heap.Pop(active)
+		}
+		if active.Len() == 0 {
+			continue
+		}
+		rule, end := (*active)[0].rule, uint32(points[k+1]-1)
+		if n := len(out); n > 0 && out[n-1].rule == rule && uint64(out[n-1].end)+1 == p {
+			out[n-1].end = end
+		} else {
+			out = append(out, policyRange{ipRange{uint32(p), end}, rule})
+		}
+	}
+	return out
+}
+
+// parsePolicyRule 解析一条规则 "类型,值,目标"：类型为 DOMAIN-SUFFIX 或 IP-CIDR，
+// 目标为 DIRECT、PROXY（默认服务端）或 upstreams 中的名称。
+// 与 bypass_cn 一样不解析域名，IP-CIDR 只匹配以 IPv4 地址请求的连接
+func parsePolicyRule(line string) (kind, value, target string, err error) {
+	parts := strings.Split(line, ",")
+	if len(parts) != 3 {
+		return "", "", "", fmt.Errorf("规则格式应为 \"类型,值,目标\": %s", line)
+	}
+	kind = strings.ToUpper(strings.TrimSpace(parts[0]))
+	value = strings.ToLower(strings.TrimSuffix(strings.TrimSpace(parts[1]), "."))
+	target = strings.TrimSpace(parts[2])
+	if value == "" || target == "" {
+		return "", "", "", fmt.Errorf("规则不完整: %s", line)
+	}
+	switch kind {
+	case "DOMAIN-SUFFIX":
+		value = strings.TrimPrefix(value, ".")
+	case "IP-CIDR":
+		if _, ok := parseIPRange(value); !ok {
+			return "", "", "", fmt.Errorf("无效的 IPv4 CIDR: %s", line)
+		}
+	default:
+		return "", "", "", fmt.Errorf("未知的规则类型 %s（支持 DOMAIN-SUFFIX、IP-CIDR）", kind)
+	}
+	return kind, value, target, nil
+}
+
+// compilePolicy 建立服务端列表，并把规则编译成域名后缀树和 IPv4 区间数组
+func (t *routeTable) compilePolicy(s *proxySettings) error {
+	name := s.Name
+	if name == "" {
+		name = "default"
+	}
+	proxy, err := newUpstream(name, upstreamConfig{Server: s.Server, Token: s.Token, IP: s.IP})
+	if err != nil {
+		return err
+	}
+	t.proxy = proxy
+	t.upstreams = []*upstream{proxy}
+
+	named := make(map[string]*upstream, len(s.Upstreams))
+	for _, c := range s.Upstreams {
+		switch {
+		case c.Name == "":
+			return fmt.Errorf("服务端 %s 缺少名称", c.Server)
+		case c.Name == policyDirect || c.Name == policyProxy:
+			return fmt.Errorf("服务端名称 %s 为保留名", c.Name)
+		case named[c.Name] != nil || c.Name == name:
+			return fmt.Errorf("服务端名称 %s 重复", c.Name)
+		}
+		up, err := newUpstream(c.Name, c)
+		if err != nil {
+			return err
+		}
+		named[c.Name] = up
+		t.upstreams = append(t.upstreams, up)
+	}
+
+	if len(s.Rules) == 0 {
+		return nil
+	}
+	t.policyDomains = newDomainTrie()
+	var ranges []policyRange
+	for _, line := range s.Rules {
+		kind, value, target, err := parsePolicyRule(line)
+		if err != nil {
+			return err
+		}
+		var up *upstream
+		switch target {
+		case policyDirect:
+		case policyProxy:
+			up = proxy
+		default:
+			if up = named[target]; up == nil {
+				return fmt.Errorf("规则引用了未定义的服务端 %s: %s", target, line)
+			}
+		}
+		rule := len(t.policyTargets)
+		t.policyTargets = append(t.policyTargets, up)
+		if kind == "DOMAIN-SUFFIX" {
+			t.policyDomains.insert(value, rule)
+		} else {
+			r, _ := parseIPRange(value)
+			ranges = append(ranges, policyRange{r, rule})
+		}
+	}
+	t.policyRanges = compilePolicyRanges(ranges)
+	log.Printf("[策略] %d 条规则（%d 个 IP 区间），%d 个服务端", len(t.policyTargets), len(t.policyRanges), len(t.upstreams))
+	return nil
+}
+
+// matchPolicy 返回与 host 匹配的规则序号，没有时返回 -1
+func (t *routeTable) matchPolicy(host string) int {
+	if len(t.policyTargets) == 0 {
+		return -1
+	}
+	if ip := net.ParseIP(host); ip != nil {
+		v, ok := ipv4ToUint(ip)
+		if !ok {
+			return -1
+		}
+		i := sort.Search(len(t.policyRanges), func(i int) bool { return t.policyRanges[i].end >= v })
+		if i < len(t.policyRanges) && t.policyRanges[i].start <= v {
+			return t.policyRanges[i].rule
+		}
+		return -1
+	}
+	return t.policyDomains.lookup(host)
+}
+
+// ======================== 透明代理 ========================
+
+// nftTable 透明代理规则所在的 nftables 表（inet 族）
+const nftTable = "ech_wk"
+
+// tproxyBypassRanges 透明代理不接管的目标：内网、组播和保留地址
+var tproxyBypassRanges = append(append([]string{}, privateRanges...), "224.0.0.0/3")
+
+// runTransparentServer 接受 nftables tproxy 规则转来的 TCP 连接：
+// 连接的本地地址就是客户端原本要访问的目标
+func runTransparentServer(addr string) {
+	lc := listenConfig(true)
+	listener, err := lc.Listen(context.Background(), "tcp", addr)
+	if err != nil {
+		log.Printf("[透明代理] 监听失败（需要 Linux 和 CAP_NET_ADMIN）: %v", err)
+		return
+	}
+	defer listener.Close()
+
+	port := listener.Addr().(*net.TCPAddr).Port
+	log.Printf("[透明代理] 监听 %s", listener.Addr())
+	acceptLoop(listener, "透明代理", func(conn net.Conn) {
+		handleTransparent(conn, port)
+	}, func(conn net.Conn) {
+		conn.Close()
+	})
+}
+
+func handleTransparent(conn net.Conn, listenPort int) {
+	defer conn.Close()
+
+	clientAddr := conn.RemoteAddr().String()
+	local := conn.LocalAddr().(*net.TCPAddr)
+	// 直接连到透明代理端口的连接没有经过 tproxy，转发给自己只会形成环路
+	if local.Port == listenPort && isLocalIP(local.IP) {
+		log.Printf("[透明代理] %s 直接连接了透明代理端口，已关闭", clientAddr)
+		return
+	}
+
+	target := local.String()
+	if err := handleTunnel(conn, target, clientAddr, modeTransparent, nil); err != nil {
+		if !isNormalCloseError(err) {
+			log.Printf("[透明代理] %s -> %s 代理失败: %v", clientAddr, target, err)
+		}
+	}
+}
+
+func isLocalIP(ip net.IP) bool {
+	if ip.IsLoopback() || ip.IsUnspecified() {
+		return true
+	}
+	addrs, err := net.InterfaceAddrs()
+	if err != nil {
+		return false
+	}
+	for _, a := range addrs {
+		if ipNet, ok := a.(*net.IPNet); ok && ipNet.IP.Equal(ip) {
+			return true
+		}
+	}
+	return false
+}
+
+// loadIPRangeFile 读取 IP 列表文件并合并为有序区间，路径为空时返回空列表
+func loadIPRangeFile(path string) ([]ipRange, error) {
+	if path == "" {
+		return nil, nil
+	}
+	data, err := os.ReadFile(path)
+	if err != nil {
+		return nil, err
+	}
+	var ranges []ipRange
+	for _, line := range strings.Split(string(data), "\n") {
+		if r, ok := parseIPRange(line); ok {
+			ranges = append(ranges, r)
+		}
+	}
+	return mergeIPRanges(ranges), nil
+}
+
+// nftElement 把区间写成 nftables 集合元素：恰好是一个网段时用 CIDR，否则用 起始-结束
+func nftElement(r ipRange) string {
+	start := uintToIPv4(r.start)
+	if r.start == r.end {
+		return start.String()
+	}
+	size := uint64(r.end) - uint64(r.start) + 1
+	if size&(size-1) == 0 && uint64(r.start)%size == 0 {
+		return fmt.Sprintf("%s/%d", start, 32-bits.TrailingZeros64(size))
+	}
+	return start.String() + "-" + uintToIPv4(r.end).String()
+}
+
+func appendNftElements(b *bytes.Buffer, indent string, ranges []ipRange) {
+	for i, r := range ranges {
+		b.WriteString(indent)
+		b.WriteString(nftElement(r))
+		if i < len(ranges)-1 {
+			b.WriteByte(',')
+		}
+		b.WriteByte('\n')
+	}
+}
+
+// generateNftables 生成供 nft -f 加载的脚本。
+// 完整规则先建后删再重建整张表，整个文件在一个事务中原子生效；
+// 指定 -nft-update 时只生成中国大陆集合的元素增量，列表刷新后无需重载规则。
+// 两者都应先用 nft -c -f 校验
+func generateNftables(path string) error {
+	cnRanges, err := loadIPRangeFile(cnIPFile)
+	if err != nil {
+		return err
+	}
+
+	var b bytes.Buffer
+	if nftUpdateFrom != "" {
+		oldRanges, err := loadIPRangeFile(nftUpdateFrom)
+		if err != nil {
+			return err
+		}
+		removed, added := diffIPRanges(oldRanges, cnRanges)
+		fmt.Fprintf(&b, "# %s -> %s: 删除 %d 个区间，新增 %d 个区间\n", nftUpdateFrom, cnIPFile, len(removed), len(added))
+		if len(removed) > 0 {
+			fmt.Fprintf(&b, "delete element inet %s cn_v4 {\n", nftTable)
+			appendNftElements(&b, "\t", removed)
+			b.WriteString("}\n")
+		}
+		if len(added) > 0 {
+			fmt.Fprintf(&b, "add element inet %s cn_v4 {\n", nftTable)
+			appendNftElements(&b, "\t", added)
+			b.WriteString("}\n")
+		}
+		log.Printf("[透明代理] 集合增量: 删除 %d 个区间，新增 %d 个区间", len(removed), len(added))
+		return writeFileAtomic(path, b.Bytes())
+	}
+
+	if tproxyAddr == "" {
+		return errors.New("需要用 -tproxy 指定透明代理监听地址")
+	}
+	port := targetPort(tproxyAddr)
+	if port == 0 {
+		return fmt.Errorf("无效的透明代理地址: %s", tproxyAddr)
+	}
+	var bypass []ipRange
+	for _, cidr := range tproxyBypassRanges {
+		if r, ok := parseIPRange(cidr); ok {
+			bypass = append(bypass, r)
+		}
+	}
+	bypass = mergeIPRanges(bypass)
+
+	fmt.Fprintf(&b, "# 由 ech-wk -nft-gen 生成，routing=%s\n", routeMode)
+	fmt.Fprintf(&b, "table inet %s\ndelete table inet %s\n\n", nftTable, nftTable)
+	fmt.Fprintf(&b, "table inet %s {\n", nftTable)
+	b.WriteString("\tset bypass_v4 {\n\t\ttype ipv4_addr\n\t\tflags interval\n\t\telements = {\n")
+	appendNftElements(&b, "\t\t\t", bypass)
+	b.WriteString("\t\t}\n\t}\n\n")
+	// cn_v4 在全局模式下也保留（可为空），列表刷新时统一按增量更新
+	b.WriteString("\tset cn_v4 {\n\t\ttype ipv4_addr\n\t\tflags interval\n")
+	if len(cnRanges) > 0 {
+		b.WriteString("\t\telements = {\n")
+		appendNftElements(&b, "\t\t\t", cnRanges)
+		b.WriteString("\t\t}\n")
+	}
+	b.WriteString("\t}\n\n")
+	b.WriteString("\tchain prerouting {\n\t\ttype filter hook prerouting priority mangle; policy accept;\n")
+	fmt.Fprintf(&b, "\t\tiifname != %q return\n", nftIface)
+	b.WriteString("\t\tmeta nfproto != ipv4 return\n")
+	b.WriteString("\t\tmeta l4proto != tcp return\n")
+	b.WriteString("\t\tip daddr @bypass_v4 return\n")
+	if routeMode == "bypass_cn" {
+		b.WriteString("\t\tip daddr @cn_v4 return\n")
+	}
+	fmt.Fprintf(&b, "\t\tmeta l4proto tcp tproxy ip to :%d meta mark set 0x%x accept\n", port, nftMark)
+	b.WriteString("\t}\n}\n")
+
+	log.Printf("[透明代理] 规则已生成: %s（中国大陆 %d 个区间）", path, len(cnRanges))
+	return writeFileAtomic(path, b.Bytes())
+}
+
+// diffIPRanges 比较两组合并后的有序区间，返回需要删除和新增的区间
+func diffIPRanges(old, cur []ipRange) (removed, added []ipRange) {
+	i, j := 0, 0
+	for i < len(old) || j < len(cur) {
+		switch {
+		case j == len(cur) || (i < len(old) && old[i].start < cur[j].start):
+			removed = append(removed, old[i])
+			i++
+		case i == len(old) || cur[j].start < old[i].start:
+			added = append(added, cur[j])
+			j++
+		case old[i].end == cur[j].end:
+			i++
+			j++
+		default:
+			removed = append(removed, old[i])
+			added = append(added, cur[j])
+			i++
+			j++
+		}
+	}
+	return removed, added
+}
+
+// ======================== 通用隧道处理 ========================
+
+// 代理模式常量
+const (
+	modeSOCKS5      = 1 // SOCKS5 代理
+	modeHTTPConnect = 2 // HTTP CONNECT 隧道
+	modeHTTPProxy   = 3 // HTTP 普通代理（GET/POST等）
+	modeTransparent = 4 // 透明代理（TPROXY），无需应答客户端
+)
+
+// wsTunnel 一条到 Worker 的 WebSocket 会话：写协程独占所有写操作，另有保活协程定时 ping
+type wsTunnel struct {
+	ws       *websocket.Conn
+	writer   *wsWriter
+	binary   bool      // 服务端支持二进制握手帧
+	start    time.Time // 开始建立 WebSocket 的时间，用于统计建连耗时
+	stopPing chan bool
+}
+
+// dialTunnel 排队获取握手名额后建立到服务端 up 的 WebSocket；排队超时返回 errDialQueueTimeout
+func dialTunnel(up *upstream) (*wsTunnel, error) {
+	if !admit.acquireDial() {
+		metrics.fail(failOverload)
+		return nil, errDialQueueTimeout
+	}
+	start := time.Now()
+	wsConn, resp, err := dialWebSocketWithECH(up, 2)
+	admit.releaseDial()
+	if err != nil {
+		metrics.fail(failDial)
+		return nil, err
+	}
+
+	// 所有写操作都交给写协程，保活 ping 与数据帧不再争抢同一把锁
+	t := &wsTunnel{
+		ws:       wsConn,
+		writer:   newWSWriter(wsConn),
+		binary:   supportsBinaryHandshake(resp),
+		start:    start,
+		stopPing: make(chan bool),
+	}
+
+	// 保活
+	go func() {
+		ticker := time.NewTicker(10 * time.Second)
+		defer ticker.Stop()
+		for {
+			select {
+			case <-ticker.C:
+				t.writer.Ping()
+			case <-t.stopPing:
+				return
+			}
+		}
+	}()
+	return t, nil
+}
+
+// connect 发送连接请求并等待服务端应答（firstBuf 的所有权转交给写协程）
+func (t *wsTunnel) connect(target string, firstFrame []byte, firstBuf *[]byte) error {
+	if err := writeConnectFrame(t.writer, target, firstFrame, firstBuf, t.binary); err != nil {
+		metrics.fail(failHandshake)
+		return err
+	}
+
+	_, msg, err := t.ws.ReadMessage()
+	if err != nil {
+		metrics.fail(failHandshake)
+		return err
+	}
+
+	response := string(msg)
+	if strings.HasPrefix(response, "ERROR:") {
+		metrics.fail(failRemote)
+		return errors.New(response)
+	}
+	if response != "CONNECTED" {
+		metrics.fail(failHandshake)
+		return fmt.Errorf("意外响应: %s", response)
+	}
+	metrics.connectLatency.observe(time.Since(t.start))
+	return nil
+}
+
+func (t *wsTunnel) Close() {
+	close(t.stopPing)
+	t.writer.Close()
+	t.ws.Close()
+}
+
+func handleTunnel(conn net.Conn, target, clientAddr string, mode int, firstFrame []byte) error {
+	up := routes.Load().resolve(target)
+	if up == nil {
+		return handleDirect(conn, target, clientAddr, mode, firstFrame)
+	}
+
+	t, err := dialTunnel(up)
+	if err == errDialQueueTimeout {
+		sendOverloadResponse(conn, mode)
+		return err
+	}
+	if err != nil {
+		sendErrorResponse(conn, mode)
+		return err
+	}
+	defer t.Close()
+
+	conn.SetDeadline(time.Time{})
+
+	// SOCKS5 客户端收到成功响应后才会发送数据，先回复再等待第一帧，使其随连接请求一起发出；
+	// 此后 Worker 连接目标失败时只能直接断开客户端连接
+	replied := mode == modeSOCKS5
+	if replied {
+		if err := sendSuccessResponse(conn, mode); err != nil {
+			return err
+		}
+	}
+
+	// 如果没有预设的 firstFrame，按目标端口学到的策略等待客户端的第一帧数据（SOCKS5 和透明代理）
+	var firstBuf *[]byte
+	if len(firstFrame) == 0 && (mode == modeSOCKS5 || mode == modeTransparent) {
+		port := targetPort(target)
+		wait := earlyData.wait(port)
+		if wait > 0 {
+			firstBuf = getRelayBuf()
+			waitStart := time.Now()
+			_ = conn.SetReadDeadline(waitStart.Add(wait))
+			n, err := conn.Read(*firstBuf)
+			_ = conn.SetReadDeadline(time.Time{})
+			waited := time.Since(waitStart)
+			metrics.earlyDataWait.observe(waited)
+			if n > 0 {
+				firstFrame = (*firstBuf)[:n]
+				earlyData.observe(port, true, waited)
+			} else if ne, ok := err.(net.Error); ok && ne.Timeout() {
+				earlyData.observe(port, false, waited)
+			}
+		} else {
+			metrics.earlyDataWait.observe(0)
+		}
+	}
+
+	// 发送连接请求并等待响应
+	if err := t.connect(target, firstFrame, firstBuf); err != nil {
+		if !replied {
+			sendErrorResponse(conn, mode)
+		}
+		return err
+	}
+
+	// 发送成功响应（根据模式不同而不同）
+	if !replied {
+		if err := sendSuccessResponse(conn, mode); err != nil {
+			return err
+		}
+	}
+
+	log.Printf("[代理] %s 已连接: %s (%s)", clientAddr, target, up.name)
+	metrics.tunnelsTotal.Add(1)
+	metrics.tunnelsActive.Add(1)
+	defer metrics.tunnelsActive.Add(-1)
+	up.tunnels.Add(1)
+	stat := trackConn(clientAddr, target, mode, up)
+	defer stat.done()
+
+	// 双向转发
+	done := make(chan bool, 2)
+
+	// Client -> Server
+	go func() {
+		relayConnToWS(conn, t.writer, stat)
+		done <- true
+	}()
+
+	// Server -> Client
+	go func() {
+		relayWSToConn(t.ws, conn, stat)
+		done <- true
+	}()
+
+	<-done
+	log.Printf("[代理] %s 已断开: %s", clientAddr, target)
+	return nil
+}
+
+// ======================== 首帧等待策略 ========================
+
+const (
+	// earlyDataMaxWait 未学到规律时等待首帧的时长（原固定值），也是周期性重新探测时使用的时长
+	earlyDataMaxWait = 100 * time.Millisecond
+	earlyDataMinWait = 5 * time.Millisecond
+	// earlyDataMinSamples 某端口衰减后的观测数达到该值（约 11 个连接）后才按学到的规律调整；
+	// 衰减系数为 0.95 时该值最多趋近 20
+	earlyDataMinSamples = 8
+	// earlyDataSilentRatio 客户端先发数据的比例低于该值时不再等待
+	earlyDataSilentRatio = 0.2
+	// earlyDataProbeEvery 判定为不等待的端口，每隔这么多个连接仍按上限等待一次，以便发现客户端行为变化
+	earlyDataProbeEvery = 16
+	earlyDataDecay      = 0.95
+)
+
+// serverFirstPorts 服务端先发言的协议（FTP、SSH、SMTP、POP3、IMAP、MySQL、VNC），客户端不会先发数据
+var serverFirstPorts = map[int]bool{21: true, 22: true, 25: true, 110: true, 143: true, 587: true, 3306: true, 5900: true}
+
+// earlyDataStat 单个目标端口的首帧观测结果（计数带衰减，跟随近期行为）
+type earlyDataStat struct {
+	sent   float64
+	silent float64
+	delay  time.Duration // 首帧到达耗时的 EWMA
+	conns  int
+}
+
+// earlyDataPolicy 按目标端口学习客户端在连接建立后是否立即发送数据（SOCKS5 在成功响应之后）。
+// 服务端先发言的协议客户端不会先发，对它们等待首帧只会白白增加延迟；
+// 客户端先发时（如 TLS ClientHello）首帧随连接请求一起发出，省去一次往返
+type earlyDataPolicy struct {
+	mu    sync.Mutex
+	ports map[int]*earlyDataStat
+}
+
+var earlyData = &earlyDataPolicy{ports: make(map[int]*earlyDataStat)}
+
+func targetPort(target string) int {
+	_, portStr, err := net.SplitHostPort(target)
+	if err != nil {
+		return 0
+	}
+	port, _ := strconv.Atoi(portStr)
+	return port
+}
+
+// wait 返回等待首帧的时长，0 表示直接发送连接请求
+func (p *earlyDataPolicy) wait(port int) time.Duration {
+	if serverFirstPorts[port] {
+		return 0
+	}
+	p.mu.Lock()
+	defer p.mu.Unlock()
+
+	st := p.ports[port]
+	if st == nil || st.sent+st.silent < earlyDataMinSamples {
+		return earlyDataMaxWait
+	}
+	st.conns++
+	if st.sent < (st.sent+st.silent)*earlyDataSilentRatio {
+		if st.conns%earlyDataProbeEvery == 0 {
+			return earlyDataMaxWait
+		}
+		return 0
+	}
+	// 客户端通常先发：等待观测耗时的两倍，留出抖动余量
+	wait := 2 * st.delay
+	if wait < earlyDataMinWait {
+		wait = earlyDataMinWait
+	}
+	if wait > earlyDataMaxWait {
+		wait = earlyDataMaxWait
+	}
+	return wait
+}
+
+// observe 记录一次等待的结果：sent 表示等到了首帧，waited 为实际等待时长
+func (p *earlyDataPolicy) observe(port int, sent bool, waited time.Duration) {
+	p.mu.Lock()
+	defer p.mu.Unlock()
+
+	st := p.ports[port]
+	if st == nil {
+		st = &earlyDataStat{}
+		p.ports[port] = st
+	}
+	st.sent *= earlyDataDecay
+	st.silent *= earlyDataDecay
+	if !sent {
+		st.silent++
+		return
+	}
+	st.sent++
+	if st.delay == 0 {
+		st.delay = waited
+	} else {
+		st.delay = (st.delay*7 + waited) / 8
+	}
+}
+
+// ======================== 转发核心 ========================
+
+// relayBufSize 单次读取的缓冲区大小
+const relayBufSize = 32 * 1024
+
+// relayBufPool 所有隧道共享的转发缓冲区，避免每个连接分配 32 KiB
+var relayBufPool = sync.Pool{
+	New: func() interface{} {
+		buf := make([]byte, relayBufSize)
+		return &buf
+	},
+}
+
+func getRelayBuf() *[]byte {
+	return relayBufPool.Get().(*[]byte)
+}
+
+func putRelayBuf(buf *[]byte) {
+	relayBufPool.Put(buf)
+}
+
+// writerOnly 隐藏 net.Conn 的 ReadFrom，使 io.CopyBuffer 使用池化缓冲区而不是另行分配
+type writerOnly struct {
+	io.Writer
+}
+
+// ======================== 连接握手 ========================
+
+const (
+	// protoHeader 客户端在 WebSocket 升级请求中声明支持的握手协议，Worker 在 101 响应中回显表示接受
+	protoHeader   = "X-ECH-Proto"
+	protoBinaryV1 = "bin1"
+
+	handshakeMagic   = 0xEC
+	handshakeVersion = 0x01
+
+	// handshakeFlagEarlyData 握手帧在地址之后携带首帧数据
+	handshakeFlagEarlyData = 0x01
+)
+
+// supportsBinaryHandshake 判断 Worker 是否接受二进制握手；旧版 Worker 不回显该头，回退到文本 CONNECT
+func supportsBinaryHandshake(resp *http.Response) bool {
+	return resp != nil && resp.Header.Get(protoHeader) == protoBinaryV1
+}
+
+// appendBinaryConnect 追加二进制握手帧：
+//
+//	+-------+---------+-------+------+----------+----------+------------+
+//	| MAGIC | VERSION | FLAGS | ATYP | DST.ADDR | DST.PORT | EARLY DATA |
+//	+-------+---------+-------+------+----------+----------+------------+
+//	|   1   |    1    |   1   |  1   | Variable |    2     |  Variable  |
+//	+-------+---------+-------+------+----------+----------+------------+
+//
+// ATYP/DST.ADDR/DST.PORT 与 SOCKS5 相同；首帧原样附在末尾，无需任何编码转换
+func appendBinaryConnect(dst []byte, target string, earlyData []byte) ([]byte, error) {
+	host, portStr, err := net.SplitHostPort(target)
+	if err != nil {
+		return nil, err
+	}
+	port, err := strconv.Atoi(portStr)
+	if err != nil || port < 0 || port > 0xFFFF {
+		return nil, fmt.Errorf("无效的目标端口: %s", portStr)
+	}
+
+	var flags byte
+	if len(earlyData) > 0 {
+		flags |= handshakeFlagEarlyData
+	}
+	dst = append(dst, handshakeMagic, handshakeVersion, flags)
+
+	if ip := net.ParseIP(host); ip != nil {
+		if ip4 := ip.To4(); ip4 != nil {
+			dst = append(dst, 0x01)
+			dst = append(dst, ip4...)
+		} else {
+			dst = append(dst, 0x04)
+			dst = append(dst, ip.To16()...)
+		}
+	} else {
+		if len(host) > 255 {
+			return nil, fmt.Errorf("域名过长: %s", host)
+		}
+		dst = append(dst, 0x03, byte(len(host)))
+		dst = append(dst, host...)
+	}
+
+	dst = append(dst, byte(port>>8), byte(port))
+	return append(dst, earlyData...), nil
+}
+
+// writeConnectFrame 发送连接请求及首帧数据。
+// Worker 支持时使用单个二进制握手帧；否则沿用 "CONNECT:host:port|payload" 文本帧，
+// 此时非 UTF-8 首帧（如 TLS ClientHello）会被文本帧按 UTF-8 破坏，改为紧随其后的二进制帧发送。
+// firstBuf 非空时为 firstFrame 所在的池化缓冲区，由本函数负责归还
+func writeConnectFrame(w *wsWriter, target string, firstFrame []byte, firstBuf *[]byte, binaryHandshake bool) error {
+	msgBuf := getRelayBuf()
+
+	if binaryHandshake {
+		msg, err := appendBinaryConnect((*msgBuf)[:0], target, firstFrame)
+		if firstBuf != nil {
+			putRelayBuf(firstBuf)
+		}
+		if err != nil {
+			putRelayBuf(msgBuf)
+			return err
+		}
+		return w.WriteFrame(wsFrame{messageType: websocket.BinaryMessage, data: msg, buf: msgBuf})
+	}
+
+	inline := utf8.Valid(firstFrame)
+	msg := append((*msgBuf)[:0], "CONNECT:"...)
+	msg = append(msg, target...)
+	msg = append(msg, '|')
+	if inline {
+		msg = append(msg, firstFrame...)
+		if firstBuf != nil {
+			putRelayBuf(firstBuf)
+			firstBuf = nil
+		}
+	}
+	if err := w.WriteFrame(wsFrame{messageType: websocket.TextMessage, data: msg, buf: msgBuf}); err != nil {
+		if firstBuf != nil {
+			putRelayBuf(firstBuf)
+		}
+		return err
+	}
+
+	if !inline {
+		return w.WriteFrame(wsFrame{messageType: websocket.BinaryMessage, data: firstFrame, buf: firstBuf})
+	}
+	return nil
+}
+
+// relayConnToWS 将客户端数据转发到 WebSocket，结束时通知服务端关闭
+// 每次读取使用新的池化缓冲区，写协程写完后归还
+func relayConnToWS(conn net.Conn, w *wsWriter, stat *connStat) error {
+	for {
+		buf := getRelayBuf()
+		n, err := conn.Read(*buf)
+		if n > 0 {
+			metrics.tunnelBytesUp.Add(int64(n))
+			stat.up.Add(int64(n))
+			if werr := w.WriteFrame(wsFrame{messageType: websocket.BinaryMessage, data: (*buf)[:n], buf: buf}); werr != nil {
+				return werr
+			}
+		} else {
+			putRelayBuf(buf)
+		}
+		if err != nil {
+			w.WriteFrame(wsFrame{messageType: websocket.TextMessage, data: []byte("CLOSE")})
+			return err
+		}
+	}
+}
+
+// relayWSToConn 将 WebSocket 消息直接流式写入客户端，不把整条消息读入内存
+func relayWSToConn(wsConn *websocket.Conn, conn net.Conn, stat *connStat) error {
+	buf := getRelayBuf()
+	defer putRelayBuf(buf)
+
+	for {
+		mt, r, err := wsConn.NextReader()
+		if err != nil {
+			return err
+		}
+
+		if mt == websocket.TextMessage {
+			// 文本帧只用于控制消息，体积很小
+			n, _ := io.ReadFull(r, (*buf)[:len("CLOSE")+1])
+			if string((*buf)[:n]) == "CLOSE" {
+				return io.EOF
+			}
+			if _, err := conn.Write((*buf)[:n]); err != nil {
+				return err
+			}
+		}
+
+		n, err := io.CopyBuffer(writerOnly{conn}, r, *buf)
+		metrics.tunnelBytesDown.Add(n)
+		stat.down.Add(n)
+		if err != nil {
+			return err
+		}
+	}
+}
+
+// ======================== 响应辅助函数 ========================
+
+func sendErrorResponse(conn net.Conn, mode int) {
+	switch mode {
+	case modeSOCKS5:
+		conn.Write([]byte{0x05, 0x04, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00})
+	case modeHTTPConnect, modeHTTPProxy:
+		conn.Write([]byte("HTTP/1.1 502 Bad Gateway\r\n\r\n"))
+	}
+}
+
+// sendOverloadResponse 代理过载时的快速拒绝：SOCKS5 一般性失败 / HTTP 503
+func sendOverloadResponse(conn net.Conn, mode int) {
+	switch mode {
+	case modeSOCKS5:
+		conn.Write([]byte{0x05, 0x01, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00})
+	case modeHTTPConnect, modeHTTPProxy:
+		conn.Write([]byte("HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"))
+	}
+}
 
 func sendSuccessResponse(conn net.Conn, mode int) error {
 	switch mode {
@@ -1057,3 +3900,497 @@ func sendSuccessResponse(conn net.Conn, mode int) error {
 	}
 	return nil
 }
+
+// ======================== WebSocket 写协程 ========================
+
+const (
+	// wsWriteQueueLen 每条隧道排队等待写出的数据帧上限（背压）
+	wsWriteQueueLen = 16
+	// wsCoalesceLimit 合并排队中的小数据帧时单个 WebSocket 帧的上限
+	wsCoalesceLimit = 64 * 1024
+	// wsWriteTimeout 单次写出的最长时间：对端停止读取或链路中断时写操作返回错误，而不是等到 TCP 超时
+	wsWriteTimeout = 30 * time.Second
+	// wsFlushTimeout 关闭写协程时冲刷剩余数据的最长时间，超时后关闭连接使仍阻塞的写操作返回
+	wsFlushTimeout = 5 * time.Second
+)
+
+var errWSWriterClosed = errors.New("WebSocket 写协程已关闭")
+
+// wsFrame 交给写协程的一帧数据
+type wsFrame struct {
+	messageType int
+	data        []byte
+	buf         *[]byte // 非空时写出后归还到 relayBufPool
+}
+
+func (f wsFrame) release() {
+	if f.buf != nil {
+		putRelayBuf(f.buf)
+	}
+}
+
+// wsWriter 每个 WebSocket 独占一个写协程：
+// 控制帧（ping）走独立通道优先写出，数据帧和文本帧按顺序排队，
+// 写出时把已排队的连续二进制帧合并成一个较大的帧
+type wsWriter struct {
+	conn    *websocket.Conn
+	control chan wsFrame
+	data    chan wsFrame
+	stop    chan struct{}
+	done    chan struct{}
+	once    sync.Once
+	err     error
+}
+
+func newWSWriter(conn *websocket.Conn) *wsWriter {
+	w := &wsWriter{
+		conn:    conn,
+		control: make(chan wsFrame, 1),
+		data:    make(chan wsFrame, wsWriteQueueLen),
+		stop:    make(chan struct{}),
+		done:    make(chan struct{}),
+	}
+	go w.loop()
+	return w
+}
+
+// WriteFrame 按顺序排队一帧数据，队列满时阻塞；无论成功与否都会接管 f.buf
+func (w *wsWriter) WriteFrame(f wsFrame) error {
+	select {
+	case w.data <- f:
+		return nil
+	case <-w.done:
+		f.release()
+		if w.err != nil {
+			return w.err
+		}
+		return errWSWriterClosed
+	}
+}
+
+// Ping 请求发送保活帧；已有 ping 在排队时直接丢弃
+func (w *wsWriter) Ping() {
+	select {
+	case w.control <- wsFrame{messageType: websocket.PingMessage}:
+	default:
+	}
+}
+
+// Close 冲刷已排队的数据后停止写协程，最多等待 wsFlushTimeout
+func (w *wsWriter) Close() {
+	w.once.Do(func() { close(w.stop) })
+	timer := time.NewTimer(wsFlushTimeout)
+	select {
+	case <-w.done:
+		timer.Stop()
+	case <-timer.C:
+		// 写协程仍阻塞在写操作上（例如正在写一个数据帧时对端停止读取）
+		w.conn.Close()
+		<-w.done
+	}
+
+	for {
+		select {
+		case f := <-w.data:
+			f.release()
+		default:
+			return
+		}
+	}
+}
+
+func (w *wsWriter) loop() {
+	defer close(w.done)
+
+	for {
+		select {
+		case f := <-w.control:
+			w.conn.SetWriteDeadline(time.Now().Add(wsWriteTimeout))
+			if w.err = w.writeFrame(f); w.err != nil {
+				return
+			}
+			continue
+		default:
+		}
+
+		select {
+		case f := <-w.control:
+			w.conn.SetWriteDeadline(time.Now().Add(wsWriteTimeout))
+			w.err = w.writeFrame(f)
+		case f := <-w.data:
+			w.conn.SetWriteDeadline(time.Now().Add(wsWriteTimeout))
+			w.err = w.writeData(f)
+		case <-w.stop:
+			w.flush()
+			return
+		}
+		if w.err != nil {
+			return
+		}
+	}
+}
+
+// flush 停止前写出仍在排队的数据（例如 CLOSE 通知）
+func (w *wsWriter) flush() {
+	w.conn.SetWriteDeadline(time.Now().Add(wsFlushTimeout))
+	for {
+		select {
+		case f := <-w.data:
+			if err := w.writeData(f); err != nil {
+				return
+			}
+		default:
+			return
+		}
+	}
+}
+
+func (w *wsWriter) writeFrame(f wsFrame) error {
+	defer f.release()
+	return w.conn.WriteMessage(f.messageType, f.data)
+}
+
+// writeData 写出一个数据帧，并把队列中紧随其后的二进制帧合并进同一个 WebSocket 帧
+func (w *wsWriter) writeData(f wsFrame) error {
+	if f.messageType != websocket.BinaryMessage {
+		return w.writeFrame(f)
+	}
+
+	mw, err := w.conn.NextWriter(websocket.BinaryMessage)
+	if err != nil {
+		f.release()
+		return err
+	}
+	size := len(f.data)
+	_, err = mw.Write(f.data)
+	f.release()
+
+	var next *wsFrame
+coalesce:
+	for err == nil && size < wsCoalesceLimit {
+		select {
+		case nf := <-w.data:
+			if nf.messageType != websocket.BinaryMessage {
+				next = &nf
+				break coalesce
+			}
+			size += len(nf.data)
+			_, err = mw.Write(nf.data)
+			nf.release()
+		default:
+			break coalesce
+		}
+	}
+
+	if cerr := mw.Close(); err == nil {
+		err = cerr
+	}
+	if next != nil {
+		if err != nil {
+			next.release()
+			return err
+		}
+		return w.writeFrame(*next)
+	}
+	return err
+}
+
+// ======================== 指标导出 ========================
+
+// 连接失败原因
+const (
+	failOverload   = iota // 握手排队超时
+	failDial              // WebSocket/ECH 连接失败
+	failHandshake         // 发送连接请求或等待响应失败
+	failRemote            // Worker 返回 ERROR（目标不可达等）
+	failDirectDial        // 直连目标失败
+	failReasonCount
+)
+
+var failReasonNames = [failReasonCount]string{"overload", "dial", "handshake", "remote", "direct_dial"}
+
+// latencyBuckets 连接耗时直方图的桶上限（秒）
+var latencyBuckets = []float64{0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10}
+
+// earlyWaitBuckets 首帧等待时长直方图的桶上限（秒）
+var earlyWaitBuckets = []float64{0.001, 0.005, 0.01, 0.025, 0.05, 0.1}
+
+// histogram 固定桶直方图，全部使用原子计数，观测无锁
+type histogram struct {
+	buckets []float64
+	counts  [16]atomic.Int64 // 前 len(buckets) 个对应各桶，下一个为 +Inf
+	sumNs   atomic.Int64
+}
+
+func (h *histogram) observe(d time.Duration) {
+	sec := d.Seconds()
+	i := sort.SearchFloat64s(h.buckets, sec)
+	h.counts[i].Add(1)
+	h.sumNs.Add(int64(d))
+}
+
+// proxyMetrics 导出给 Prometheus 的计数器；连接准入相关计数见 proxyStats
+type proxyMetrics struct {
+	tunnelsActive   atomic.Int64
+	tunnelsTotal    atomic.Int64
+	tunnelBytesUp   atomic.Int64
+	tunnelBytesDown atomic.Int64
+	directActive    atomic.Int64
+	directTotal     atomic.Int64
+	directBytesUp   atomic.Int64
+	directBytesDown atomic.Int64
+
+	connectLatency histogram
+	earlyDataWait  histogram
+	failures       [failReasonCount]atomic.Int64
+
+	echRefreshes    atomic.Int64
+	dohECHQueries   atomic.Int64
+	dohECHErrors    atomic.Int64
+	dohProxyQueries atomic.Int64
+	dohProxyErrors  atomic.Int64
+
+	tlsHandshakes atomic.Int64
+	tlsResumed    atomic.Int64
+
+	httpDialed atomic.Int64 // 普通 HTTP 代理请求新建源站连接的次数
+	httpReused atomic.Int64 // 普通 HTTP 代理请求复用空闲连接的次数
+
+	reloads      atomic.Int64
+	reloadErrors atomic.Int64
+}
+
+var (
+	metrics = proxyMetrics{
+		connectLatency: histogram{buckets: latencyBuckets},
+		earlyDataWait:  histogram{buckets: earlyWaitBuckets},
+	}
+	startTime = time.Now()
+)
+
+func (m *proxyMetrics) fail(reason int) {
+	m.failures[reason].Add(1)
+}
+
+// serveMetrics 提供 /metrics（Prometheus 文本格式）、/connections（活动连接快照，JSON）
+// 和 /reload（重新加载配置）；前两者只读原子计数，适合路由器上高频抓取
+func serveMetrics(addr string) {
+	mux := http.NewServeMux()
+	mux.HandleFunc("/metrics", func(w http.ResponseWriter, r *http.Request) {
+		w.Header().Set("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		w.Write(appendMetrics(make([]byte, 0, 4096)))
+	})
+	mux.HandleFunc("/connections", serveConnections)
+	mux.HandleFunc("/reload", serveReload)
+	log.Printf("[指标] 监听 http://%s/metrics", addr)
+	if err := http.ListenAndServe(addr, mux); err != nil {
+		log.Printf("[指标] 监听失败: %v", err)
+	}
+}
+
+func appendMetricHeader(b []byte, name, typ, help string) []byte {
+	b = append(b, "# HELP "...)
+	b = append(b, name...)
+	b = append(b, ' ')
+	b = append(b, help...)
+	b = append(b, "\n# TYPE "...)
+	b = append(b, name...)
+	b = append(b, ' ')
+	b = append(b, typ...)
+	return append(b, '\n')
+}
+
+func appendMetricValue(b []byte, name, labels string, v int64) []byte {
+	b = append(b, name...)
+	if labels != "" {
+		b = append(b, '{')
+		b = append(b, labels...)
+		b = append(b, '}')
+	}
+	b = append(b, ' ')
+	b = strconv.AppendInt(b, v, 10)
+	return append(b, '\n')
+}
+
+func appendHistogram(b []byte, name, help string, h *histogram) []byte {
+	b = appendMetricHeader(b, name, "histogram", help)
+	var cumulative int64
+	for i := 0; i <= len(h.buckets); i++ {
+		cumulative += h.counts[i].Load()
+		le := "+Inf"
+		if i < len(h.buckets) {
+			le = strconv.FormatFloat(h.buckets[i], 'g', -1, 64)
+		}
+		b = appendMetricValue(b, name+"_bucket", `le="`+le+`"`, cumulative)
+	}
+	b = append(b, name+"_sum "...)
+	b = strconv.AppendFloat(b, time.Duration(h.sumNs.Load()).Seconds(), 'g', -1, 64)
+	b = append(b, '\n')
+	return appendMetricValue(b, name+"_count", "", cumulative)
+}
+
+func appendMetrics(b []byte) []byte {
+	m := &metrics
+
+	b = appendMetricHeader(b, "ech_wk_start_time_seconds", "gauge", "进程启动时间（Unix 秒），变化即表示进程重启")
+	b = appendMetricValue(b, "ech_wk_start_time_seconds", "", startTime.Unix())
+
+	b = appendMetricHeader(b, "ech_wk_connections_accepted_total", "counter", "接受的客户端连接数")
+	b = appendMetricValue(b, "ech_wk_connections_accepted_total", "", proxyStats.accepted.Load())
+	b = appendMetricHeader(b, "ech_wk_connections_active", "gauge", "当前客户端连接数")
+	b = appendMetricValue(b, "ech_wk_connections_active", "", proxyStats.active.Load())
+	b = appendMetricHeader(b, "ech_wk_connections_shed_total", "counter", "因过载被拒绝的连接数")
+	b = appendMetricValue(b, "ech_wk_connections_shed_total", `reason="global"`, proxyStats.shedGlobal.Load())
+	b = appendMetricValue(b, "ech_wk_connections_shed_total", `reason="per_client"`, proxyStats.shedPerClient.Load())
+	b = appendMetricValue(b, "ech_wk_connections_shed_total", `reason="dial_queue"`, proxyStats.shedDialQueue.Load())
+
+	b = appendMetricHeader(b, "ech_wk_tunnels_active", "gauge", "当前转发中的连接数")
+	b = appendMetricValue(b, "ech_wk_tunnels_active", `path="tunnel"`, m.tunnelsActive.Load())
+	b = appendMetricValue(b, "ech_wk_tunnels_active", `path="direct"`, m.directActive.Load())
+	b = appendMetricHeader(b, "ech_wk_tunnels_total", "counter", "建立成功的转发连接数")
+	b = appendMetricValue(b, "ech_wk_tunnels_total", `path="tunnel"`, m.tunnelsTotal.Load())
+	b = appendMetricValue(b, "ech_wk_tunnels_total", `path="direct"`, m.directTotal.Load())
+	b = appendMetricHeader(b, "ech_wk_bytes_total", "counter", "转发的字节数")
+	b = appendMetricValue(b, "ech_wk_bytes_total", `path="tunnel",direction="up"`, m.tunnelBytesUp.Load())
+	b = appendMetricValue(b, "ech_wk_bytes_total", `path="tunnel",direction="down"`, m.tunnelBytesDown.Load())
+	b = appendMetricValue(b, "ech_wk_bytes_total", `path="direct",direction="up"`, m.directBytesUp.Load())
+	b = appendMetricValue(b, "ech_wk_bytes_total", `path="direct",direction="down"`, m.directBytesDown.Load())
+
+	b = appendMetricHeader(b, "ech_wk_failures_total", "counter", "连接失败数（按原因）")
+	for i, name := range failReasonNames {
+		b = appendMetricValue(b, "ech_wk_failures_total", `reason="`+name+`"`, m.failures[i].Load())
+	}
+
+	b = appendHistogram(b, "ech_wk_connect_duration_seconds", "从建立 WebSocket 到收到 CONNECTED 的耗时", &m.connectLatency)
+	b = appendHistogram(b, "ech_wk_early_data_wait_seconds", "SOCKS5 隧道发送连接请求前等待客户端首帧的耗时", &m.earlyDataWait)
+
+	b = appendMetricHeader(b, "ech_wk_ech_refreshes_total", "counter", "ECH 配置刷新次数")
+	b = appendMetricValue(b, "ech_wk_ech_refreshes_total", "", m.echRefreshes.Load())
+	b = appendMetricHeader(b, "ech_wk_doh_queries_total", "counter", "DoH 查询数（ech: 获取 ECH 配置, proxy: 代理 UDP DNS）")
+	b = appendMetricValue(b, "ech_wk_doh_queries_total", `kind="ech",result="ok"`, m.dohECHQueries.Load())
+	b = appendMetricValue(b, "ech_wk_doh_queries_total", `kind="ech",result="error"`, m.dohECHErrors.Load())
+	b = appendMetricValue(b, "ech_wk_doh_queries_total", `kind="proxy",result="ok"`, m.dohProxyQueries.Load())
+	b = appendMetricValue(b, "ech_wk_doh_queries_total", `kind="proxy",result="error"`, m.dohProxyErrors.Load())
+
+	resumed := m.tlsResumed.Load()
+	b = appendMetricHeader(b, "ech_wk_tls_handshakes_total", "counter", "到边缘节点的 TLS 握手次数（resumed: 是否复用会话票据）")
+	b = appendMetricValue(b, "ech_wk_tls_handshakes_total", `resumed="true"`, resumed)
+	b = appendMetricValue(b, "ech_wk_tls_handshakes_total", `resumed="false"`, m.tlsHandshakes.Load()-resumed)
+
+	b = appendMetricHeader(b, "ech_wk_http_requests_total", "counter", "普通 HTTP 代理请求数（reused: 是否复用到源站的空闲连接）")
+	b = appendMetricValue(b, "ech_wk_http_requests_total", `reused="true"`, m.httpReused.Load())
+	b = appendMetricValue(b, "ech_wk_http_requests_total", `reused="false"`, m.httpDialed.Load())
+
+	b = appendMetricHeader(b, "ech_wk_upstream_tunnels_total", "counter", "经各服务端建立的隧道数（重新加载配置后从 0 开始）")
+	for _, up := range routes.Load().upstreams {
+		b = appendMetricValue(b, "ech_wk_upstream_tunnels_total", "upstream="+strconv.Quote(up.name), up.tunnels.Load())
+	}
+
+	b = appendMetricHeader(b, "ech_wk_config_reloads_total", "counter", "运行中重新加载配置的次数")
+	b = appendMetricValue(b, "ech_wk_config_reloads_total", `result="ok"`, m.reloads.Load())
+	b = appendMetricValue(b, "ech_wk_config_reloads_total", `result="error"`, m.reloadErrors.Load())
+	return b
+}
+
+// ======================== 活动连接表 ========================
+
+// directCopyChunk 直连转发每轮拷贝的上限：io.CopyN 包装的 LimitedReader 仍走 splice，
+// 按块拷贝只是为了让字节计数在连接进行中也能更新
+const directCopyChunk = 128 * 1024
+
+// connStat 单个转发连接的信息，字节数由转发协程原子累加
+type connStat struct {
+	id     uint64
+	client string
+	target string
+	mode   int
+	via    *upstream // 经过的服务端，nil 表示直连
+	start  time.Time
+	up     atomic.Int64
+	down   atomic.Int64
+}
+
+var connTable struct {
+	mu     sync.Mutex
+	nextID uint64
+	conns  map[uint64]*connStat
+}
+
+// trackConn 登记一个已建立的转发连接（via 为 nil 表示直连），结束时调用 done
+func trackConn(client, target string, mode int, via *upstream) *connStat {
+	s := &connStat{client: client, target: target, mode: mode, via: via, start: time.Now()}
+	connTable.mu.Lock()
+	if connTable.conns == nil {
+		connTable.conns = make(map[uint64]*connStat)
+	}
+	connTable.nextID++
+	s.id = connTable.nextID
+	connTable.conns[s.id] = s
+	connTable.mu.Unlock()
+	return s
+}
+
+func (s *connStat) done() {
+	connTable.mu.Lock()
+	delete(connTable.conns, s.id)
+	connTable.mu.Unlock()
+}
+
+// copyCounted 按块拷贝并累加连接和全局字节数
+func copyCounted(dst io.Writer, src io.Reader, counters ...*atomic.Int64) {
+	for {
+		n, err := io.CopyN(dst, src, directCopyChunk)
+		for _, c := range counters {
+			c.Add(n)
+		}
+		if err != nil {
+			return
+		}
+	}
+}
+
+var modeNames = map[int]string{modeSOCKS5: "socks5", modeHTTPConnect: "connect", modeHTTPProxy: "http", modeTransparent: "tproxy"}
+
+type connSnapshot struct {
+	ID       uint64 `json:"id"`
+	Client   string `json:"client"`
+	Target   string `json:"target"`
+	Mode     string `json:"mode"`
+	Path     string `json:"path"`
+	Upstream string `json:"upstream,omitempty"`
+	Start    int64  `json:"start"`
+	Up       int64  `json:"up"`
+	Down     int64  `json:"down"`
+}
+
+// serveConnections 返回活动连接快照，按连接建立顺序排列；时间均为 Unix 毫秒
+func serveConnections(w http.ResponseWriter, r *http.Request) {
+	connTable.mu.Lock()
+	list := make([]connSnapshot, 0, len(connTable.conns))
+	for _, s := range connTable.conns {
+		path, name := "direct", ""
+		if s.via != nil {
+			path, name = "tunnel", s.via.name
+		}
+		list = append(list, connSnapshot{
+			ID: s.id, Client: s.client, Target: s.target, Mode: modeNames[s.mode], Path: path, Upstream: name,
+			Start: s.start.UnixMilli(), Up: s.up.Load(), Down: s.down.Load(),
+		})
+	}
+	connTable.mu.Unlock()
+	sort.Slice(list, func(i, j int) bool { return list[i].ID < list[j].ID })
+
+	w.Header().Set("Content-Type", "application/json")
+	// up/down 为进程累计字节数（含已关闭连接），用于计算总带宽
+	json.NewEncoder(w).Encode(struct {
+		Now         int64          `json:"now"`
+		Up          int64          `json:"up"`
+		Down        int64          `json:"down"`
+		Connections []connSnapshot `json:"connections"`
+	}{
+		time.Now().UnixMilli(),
+		metrics.tunnelBytesUp.Load() + metrics.directBytesUp.Load(),
+		metrics.tunnelBytesDown.Load() + metrics.directBytesDown.Load(),
+		list,
+	})
+}
@@ -0,0 +1,2098 @@
+package main
+
+// 基准测试在本地回环上运行，不需要服务端和 ECH。ech-wk-package/src 中有 go.mod：
+//
+//	cp ech-workers.go sockopt_*.go ech-workers_test.go ech-wk-package/src/ && cd ech-wk-package/src
+//	go mod tidy && go test -run '^$' -bench . -benchmem
+//
+// 端到端负载测试 TestLoad 默认跳过，需要 -load，见“负载测试”一节
+
+import (
+	"bufio"
+	"bytes"
+	"context"
+	"crypto/ecdh"
+	"crypto/ecdsa"
+	"crypto/elliptic"
+	"crypto/rand"
+	"crypto/tls"
+	"crypto/x509"
+	"crypto/x509/pkix"
+	"encoding/base64"
+	"encoding/binary"
+	"encoding/hex"
+	"encoding/json"
+	"encoding/pem"
+	"errors"
+	"flag"
+	"fmt"
+	"io"
+	"math/big"
+	"net"
+	"net/http"
+	"net/http/httptest"
+	"os"
+	"os/exec"
+	"path/filepath"
+	"reflect"
+	"runtime"
+	"sort"
+	"strconv"
+	"strings"
+	"sync"
+	"sync/atomic"
+	"testing"
+	"time"
+
+	"github.com/gorilla/websocket"
+)
+
+// ======================== 模拟 Worker ========================
+
+// benchWorker 回环上的模拟 Worker：/up 丢弃上行数据直到收到 CLOSE，/down?bytes=N 推送 N 字节后发送 CLOSE
+type benchWorker struct {
+	addr     string
+	finished chan struct{} // 每个会话结束时发送一次
+	srv      *http.Server
+}
+
+func startBenchWorker(b *testing.B) *benchWorker {
+	upgrader := websocket.Upgrader{ReadBufferSize: relayBufSize, WriteBufferSize: relayBufSize}
+	payload := make([]byte, relayBufSize)
+	bw := &benchWorker{finished: make(chan struct{}, 1024)}
+
+	bw.srv = &http.Server{Handler: http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		ws, err := upgrader.Upgrade(w, r, nil)
+		if err != nil {
+			return
+		}
+		defer ws.Close()
+		defer func() { bw.finished <- struct{}{} }()
+
+		if r.URL.Path == "/down" {
+			downBytes, _ := strconv.Atoi(r.URL.Query().Get("bytes"))
+			for sent := 0; sent < downBytes; sent += len(payload) {
+				if err := ws.WriteMessage(websocket.BinaryMessage, payload[:min(len(payload), downBytes-sent)]); err != nil {
+					return
+				}
+			}
+			ws.WriteMessage(websocket.TextMessage, []byte("CLOSE"))
+			return
+		}
+		for {
+			mt, r, err := ws.NextReader()
+			if err != nil || mt == websocket.TextMessage {
+				return
+			}
+			io.Copy(io.Discard, r)
+		}
+	})}
+
+	ln, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		b.Fatal(err)
+	}
+	bw.addr = ln.Addr().String()
+	go bw.srv.Serve(ln)
+	b.Cleanup(func() { bw.srv.Close() })
+	return bw
+}
+
+func (bw *benchWorker) dial(b *testing.B, path string) *websocket.Conn {
+	dialer := websocket.Dialer{ReadBufferSize: relayBufSize, WriteBufferSize: relayBufSize}
+	wsConn, _, err := dialer.Dial("ws://"+bw.addr+path, nil)
+	if err != nil {
+		b.Fatal(err)
+	}
+	return wsConn
+}
+
+// ======================== 配置热加载 ========================
+
+func TestServeReloadLocalOnly(t *testing.T) {
+	lan := &net.TCPAddr{IP: net.ParseIP("192.168.1.1"), Port: 9464}
+	cases := []struct {
+		name   string
+		method string
+		remote string
+		local  net.Addr
+		want   int
+	}{
+		{"IPv4 回环", http.MethodPost, "127.0.0.1:50000", nil, http.StatusUnprocessableEntity},
+		{"IPv6 回环", http.MethodPost, "[::1]:50000", nil, http.StatusUnprocessableEntity},
+		{"按局域网 IP 访问本机", http.MethodPost, "192.168.1.1:50000", lan, http.StatusUnprocessableEntity},
+		{"局域网其他主机", http.MethodPost, "192.168.1.2:50000", lan, http.StatusForbidden},
+		{"局域网其他主机 GET", http.MethodGet, "192.168.1.2:50000", lan, http.StatusForbidden},
+		{"无效的来源地址", http.MethodPost, "@", nil, http.StatusForbidden},
+		{"本机 GET", http.MethodGet, "127.0.0.1:50000", nil, http.StatusMethodNotAllowed},
+	}
+	// 未设置服务端地址：通过检查的请求会执行重新加载并失败（422），配置不会被替换
+	for _, c := range cases {
+		req := httptest.NewRequest(c.method, "/reload", nil)
+		req.RemoteAddr = c.remote
+		if c.local != nil {
+			req = req.WithContext(context.WithValue(req.Context(), http.LocalAddrContextKey, c.local))
+		}
+		rec := httptest.NewRecorder()
+		serveReload(rec, req)
+		if rec.Code != c.want {
+			t.Errorf("%s: 状态码 %d, 期望 %d", c.name, rec.Code, c.want)
+		}
+	}
+}
+
+// ======================== 转发核心 ========================
+
+// BenchmarkRelay 测量转发核心单个方向的吞吐量与内存分配，每次操作转发一个 relayBufSize 的块；
+// 分配数包含回环对端（模拟 Worker）自身的少量分配
+func BenchmarkRelay(b *testing.B) {
+	bw := startBenchWorker(b)
+	for _, dir := range []string{"up", "down"} {
+		b.Run(dir, func(b *testing.B) { benchRelay(b, bw, dir) })
+	}
+}
+
+func benchRelay(b *testing.B, bw *benchWorker, dir string) {
+	total := b.N * relayBufSize
+	wsConn := bw.dial(b, fmt.Sprintf("/%s?bytes=%d", dir, total))
+	defer wsConn.Close()
+
+	// 本地 TCP 连接对，模拟代理客户端
+	ln, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		b.Fatal(err)
+	}
+	defer ln.Close()
+	client, err := net.Dial("tcp", ln.Addr().String())
+	if err != nil {
+		b.Fatal(err)
+	}
+	defer client.Close()
+	conn, err := ln.Accept()
+	if err != nil {
+		b.Fatal(err)
+	}
+	defer conn.Close()
+
+	payload := make([]byte, relayBufSize)
+	b.SetBytes(relayBufSize)
+	b.ReportAllocs()
+	b.ResetTimer()
+
+	if dir == "up" {
+		go func() {
+			for sent := 0; sent < total; sent += len(payload) {
+				if _, err := client.Write(payload); err != nil {
+					break
+				}
+			}
+			client.(*net.TCPConn).CloseWrite()
+		}()
+		writer := newWSWriter(wsConn)
+		relayConnToWS(conn, writer, new(connStat))
+		writer.Close()
+	} else {
+		go func() {
+			relayWSToConn(wsConn, conn, new(connStat))
+			conn.Close()
+		}()
+		io.Copy(io.Discard, client)
+	}
+	<-bw.finished
+}
+
+// ======================== WebSocket 写协程 ========================
+
+const (
+	benchUploadConns        = 64
+	benchUploadChunk        = 4096 // 模拟交互式客户端的小块写入
+	benchUploadPingInterval = time.Millisecond
+)
+
+// BenchmarkUpload 比较旧的互斥锁写路径与写协程在大量并发上传下的总吞吐量，
+// 每次操作写出一个小块，分摊到 benchUploadConns 条隧道；ping 间隔被刻意缩短以放大保活与数据写入之间的争用
+func BenchmarkUpload(b *testing.B) {
+	bw := startBenchWorker(b)
+	for _, variant := range []string{"mutex", "writer"} {
+		b.Run(variant, func(b *testing.B) {
+			chunk := make([]byte, benchUploadChunk)
+			conns := make([]*websocket.Conn, benchUploadConns)
+			for i := range conns {
+				conns[i] = bw.dial(b, "/up")
+			}
+			b.SetBytes(benchUploadChunk)
+			b.ResetTimer()
+
+			var wg sync.WaitGroup
+			errs := make(chan error, benchUploadConns)
+			for i, wsConn := range conns {
+				count := b.N / benchUploadConns
+				if i < b.N%benchUploadConns {
+					count++
+				}
+				wg.Add(1)
+				go func(wsConn *websocket.Conn) {
+					defer wg.Done()
+					defer wsConn.Close()
+					if err := benchUploadOnce(wsConn, variant, chunk, count); err != nil {
+						errs <- err
+					}
+				}(wsConn)
+			}
+			wg.Wait()
+			select {
+			case err := <-errs:
+				b.Fatal(err)
+			default:
+			}
+			for range conns {
+				<-bw.finished
+			}
+		})
+	}
+}
+
+func benchUploadOnce(wsConn *websocket.Conn, variant string, chunk []byte, count int) error {
+	stopPing := make(chan struct{})
+	defer close(stopPing)
+
+	if variant == "mutex" {
+		var mu sync.Mutex
+		go func() {
+			ticker := time.NewTicker(benchUploadPingInterval)
+			defer ticker.Stop()
+			for {
+				select {
+				case <-ticker.C:
+					mu.Lock()
+					wsConn.WriteMessage(websocket.PingMessage, nil)
+					mu.Unlock()
+				case <-stopPing:
+					return
+				}
+			}
+		}()
+		for i := 0; i < count; i++ {
+			mu.Lock()
+			err := wsConn.WriteMessage(websocket.BinaryMessage, chunk)
+			mu.Unlock()
+			if err != nil {
+				return err
+			}
+		}
+		mu.Lock()
+		defer mu.Unlock()
+		return wsConn.WriteMessage(websocket.TextMessage, []byte("CLOSE"))
+	}
+
+	writer := newWSWriter(wsConn)
+	defer writer.Close()
+	go func() {
+		ticker := time.NewTicker(benchUploadPingInterval)
+		defer ticker.Stop()
+		for {
+			select {
+			case <-ticker.C:
+				writer.Ping()
+			case <-stopPing:
+				return
+			}
+		}
+	}()
+	for i := 0; i < count; i++ {
+		buf := getRelayBuf()
+		n := copy(*buf, chunk)
+		if err := writer.WriteFrame(wsFrame{messageType: websocket.BinaryMessage, data: (*buf)[:n], buf: buf}); err != nil {
+			return err
+		}
+	}
+	return writer.WriteFrame(wsFrame{messageType: websocket.TextMessage, data: []byte("CLOSE")})
+}
+
+// ======================== 监听套接字选项 ========================
+
+// TestListenReusePort 开启 -reuseport 后两个监听套接字可以绑定同一端口（选项编号错误时第二次绑定会失败）
+func TestListenReusePort(t *testing.T) {
+	if runtime.GOOS != "linux" {
+		t.Skip("SO_REUSEPORT 仅在 Linux 上使用")
+	}
+	saved := reusePort
+	reusePort = true
+	defer func() { reusePort = saved }()
+
+	lc := listenConfig(false)
+	first, err := lc.Listen(context.Background(), "tcp", "127.0.0.1:0")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer first.Close()
+	second, err := lc.Listen(context.Background(), "tcp", first.Addr().String())
+	if err != nil {
+		t.Fatalf("第二个监听套接字绑定失败: %v", err)
+	}
+	second.Close()
+}
+
+// ======================== 连接准入控制 ========================
+
+func TestAdmissionLimits(t *testing.T) {
+	a := newAdmission(3, 2, 0)
+	shedGlobal, shedPerClient := proxyStats.shedGlobal.Load(), proxyStats.shedPerClient.Load()
+	steps := []struct {
+		release bool
+		ip      string
+		want    bool
+	}{
+		{false, "10.0.0.1", true},
+		{false, "10.0.0.1", true},
+		{false, "10.0.0.1", false}, // 超过单客户端上限
+		{false, "10.0.0.2", true},
+		{false, "10.0.0.3", false}, // 超过总数上限
+		{true, "10.0.0.2", true},
+		{false, "10.0.0.3", true},
+		{true, "10.0.0.1", true},
+		{false, "10.0.0.1", true}, // 释放后单客户端名额恢复
+		{false, "10.0.0.4", false},
+		{true, "10.0.0.1", true},
+		{true, "10.0.0.1", true},
+	}
+	for i, s := range steps {
+		if s.release {
+			a.release(s.ip)
+			continue
+		}
+		if got := a.acquire(s.ip); got != s.want {
+			t.Fatalf("第 %d 步 acquire(%s) = %v, 期望 %v", i+1, s.ip, got, s.want)
+		}
+	}
+
+	if n := proxyStats.shedGlobal.Load() - shedGlobal; n != 2 {
+		t.Errorf("超过总数被拒绝 %d 次, 期望 2", n)
+	}
+	if n := proxyStats.shedPerClient.Load() - shedPerClient; n != 1 {
+		t.Errorf("超过单客户端上限被拒绝 %d 次, 期望 1", n)
+	}
+	// 客户端的连接全部释放后不再占用计数表
+	if a.active != 1 || !reflect.DeepEqual(a.perClient, map[string]int{"10.0.0.3": 1}) {
+		t.Errorf("active = %d, perClient = %v", a.active, a.perClient)
+	}
+	a.release("10.0.0.3")
+	if a.active != 0 || len(a.perClient) != 0 {
+		t.Errorf("全部释放后 active = %d, perClient = %v", a.active, a.perClient)
+	}
+}
+
+func TestAdmissionDial(t *testing.T) {
+	if a := newAdmission(0, 0, 0); !a.acquireDial() || !a.acquireDial() {
+		t.Fatal("不限制握手数时不应排队")
+	}
+
+	a := newAdmission(0, 0, 2)
+	if !a.acquireDial() || !a.acquireDial() {
+		t.Fatal("未满时应立即获得名额")
+	}
+	// 名额用尽时排队，释放后获得
+	time.AfterFunc(20*time.Millisecond, a.releaseDial)
+	start := time.Now()
+	if !a.acquireDial() {
+		t.Fatal("释放名额后应结束排队")
+	}
+	if waited := time.Since(start); waited < 20*time.Millisecond || waited >= dialQueueTimeout {
+		t.Errorf("排队 %v", waited)
+	}
+
+	if testing.Short() {
+		t.Skip("排队超时需要等待 dialQueueTimeout")
+	}
+	shed := proxyStats.shedDialQueue.Load()
+	if a.acquireDial() {
+		t.Fatal("名额用尽时应排队超时")
+	}
+	if n := proxyStats.shedDialQueue.Load() - shed; n != 1 {
+		t.Errorf("排队超时计数增加 %d, 期望 1", n)
+	}
+}
+
+func TestAdmissionReject(t *testing.T) {
+	cases := []struct {
+		name     string
+		exchange [][2]string // 客户端发送的字节 -> 期望收到的字节
+	}{
+		{"SOCKS5", [][2]string{
+			{"\x05\x01\x00", "\x05\x00"},
+			{"\x05\x01\x00\x03\x0bexample.com\x01\xbb", "\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00"},
+		}},
+		{"HTTP", [][2]string{
+			{"GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n",
+				"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"},
+		}},
+	}
+	a := newAdmission(0, 0, 0)
+	for _, c := range cases {
+		client, server := net.Pipe()
+		client.SetDeadline(time.Now().Add(2 * time.Second))
+		a.reject(server)
+		for _, ex := range c.exchange {
+			if _, err := client.Write([]byte(ex[0])); err != nil {
+				t.Fatalf("%s: %v", c.name, err)
+			}
+			got := make([]byte, len(ex[1]))
+			if _, err := io.ReadFull(client, got); err != nil || string(got) != ex[1] {
+				t.Fatalf("%s: 收到 %q (%v), 期望 %q", c.name, got, err, ex[1])
+			}
+		}
+		// 拒绝后服务端关闭连接
+		if _, err := client.Read(make([]byte, 1)); err != io.EOF {
+			t.Errorf("%s: 拒绝后连接未关闭: %v", c.name, err)
+		}
+		client.Close()
+	}
+}
+
+// ======================== UDP 转发 ========================
+
+const (
+	benchUDPWindow = 64 // 吞吐测试时在途数据报数量
+	benchUDPSize   = 512
+)
+
+// BenchmarkUDP 通过本地 UDP 回显服务测量 SOCKS5 UDP 转发（直连会话）：
+// latency 每次操作为一次往返并报告 p50/p99，throughput 保持 benchUDPWindow 个数据报在途
+func BenchmarkUDP(b *testing.B) {
+	echo, err := net.ListenUDP("udp", &net.UDPAddr{IP: net.IPv4(127, 0, 0, 1)})
+	if err != nil {
+		b.Fatal(err)
+	}
+	defer echo.Close()
+	go func() {
+		buf := make([]byte, 65535)
+		for {
+			n, addr, err := echo.ReadFromUDP(buf)
+			if err != nil {
+				return
+			}
+			echo.WriteToUDP(buf[:n], addr)
+		}
+	}()
+
+	saved := routes.Load()
+	routes.Store(&routeTable{mode: "direct"})
+	defer routes.Store(saved)
+
+	relayConn, err := net.ListenUDP("udp", &net.UDPAddr{IP: net.IPv4(127, 0, 0, 1)})
+	if err != nil {
+		b.Fatal(err)
+	}
+	assoc := newUDPAssociation(relayConn, "bench")
+	go assoc.serve()
+	defer assoc.close()
+
+	client, err := net.DialUDP("udp", nil, relayConn.LocalAddr().(*net.UDPAddr))
+	if err != nil {
+		b.Fatal(err)
+	}
+	defer client.Close()
+
+	echoAddr := echo.LocalAddr().(*net.UDPAddr)
+	packet := make([]byte, 10+benchUDPSize)
+	packet[3] = 0x01
+	copy(packet[4:8], echoAddr.IP.To4())
+	packet[8], packet[9] = byte(echoAddr.Port>>8), byte(echoAddr.Port)
+	resp := make([]byte, 65535)
+
+	b.Run("latency", func(b *testing.B) {
+		rtts := make([]time.Duration, 0, b.N)
+		for i := 0; i < b.N; i++ {
+			start := time.Now()
+			if _, err := client.Write(packet); err != nil {
+				b.Fatal(err)
+			}
+			client.SetReadDeadline(time.Now().Add(time.Second))
+			if _, err := client.Read(resp); err != nil {
+				b.Fatalf("等待回显超时: %v", err)
+			}
+			rtts = append(rtts, time.Since(start))
+		}
+		sort.Slice(rtts, func(i, j int) bool { return rtts[i] < rtts[j] })
+		b.ReportMetric(float64(rtts[len(rtts)/2].Microseconds()), "p50-us")
+		b.ReportMetric(float64(rtts[len(rtts)*99/100].Microseconds()), "p99-us")
+	})
+
+	b.Run("throughput", func(b *testing.B) {
+		b.SetBytes(benchUDPSize)
+		sent, recv := 0, 0
+		for ; sent < min(benchUDPWindow, b.N); sent++ {
+			client.Write(packet)
+		}
+		for recv < sent {
+			client.SetReadDeadline(time.Now().Add(time.Second))
+			if _, err := client.Read(resp); err != nil {
+				break
+			}
+			recv++
+			if sent < b.N {
+				client.Write(packet)
+				sent++
+			}
+		}
+		b.ReportMetric(float64(sent-recv), "lost")
+		b.ReportMetric(float64(recv)/b.Elapsed().Seconds(), "packets/s")
+	})
+}
+
+// ======================== HTTP 代理连接复用 ========================
+
+// recordConn 记录写入的字节，代替客户端连接
+type recordConn struct {
+	net.Conn
+	out bytes.Buffer
+}
+
+func (c *recordConn) Write(p []byte) (int, error) { return c.out.Write(p) }
+func (c *recordConn) SetDeadline(time.Time) error { return nil }
+
+func readTestRequest(t *testing.T, raw string) *http.Request {
+	t.Helper()
+	req, err := http.ReadRequest(bufio.NewReader(strings.NewReader(raw)))
+	if err != nil {
+		t.Fatal(err)
+	}
+	return req
+}
+
+func TestWriteProxyResponse(t *testing.T) {
+	const (
+		get   = "GET http://origin.test/ HTTP/1.1\r\nHost: origin.test\r\n\r\n"
+		get10 = "GET http://origin.test/ HTTP/1.0\r\nHost: origin.test\r\n\r\n"
+		head  = "HEAD http://origin.test/ HTTP/1.1\r\nHost: origin.test\r\n\r\n"
+	)
+	cases := []struct {
+		name, req, resp     string
+		body                string
+		chunked             bool // 写给客户端的响应使用分块编码
+		keepAlive, reusable bool
+	}{
+		{"定长", get, "HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello", "hello", false, true, true},
+		{"分块", get, "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nhel\r\n2\r\nlo\r\n0\r\n\r\n", "hello", true, true, true},
+		{"分块转给 HTTP/1.0 客户端", get10, "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n", "hello", false, false, false},
+		{"源站 Connection: close", get, "HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 5\r\n\r\nhello", "hello", false, false, false},
+		{"客户端 Connection: close", "GET http://origin.test/ HTTP/1.1\r\nHost: origin.test\r\nConnection: close\r\n\r\n", "HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello", "hello", false, false, false},
+		{"以关闭连接结束", get, "HTTP/1.1 200 OK\r\n\r\nhello", "hello", false, false, false},
+		{"HEAD", head, "HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n", "", false, true, true},
+		{"HEAD 分块", head, "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n", "", false, true, true},
+		{"204", get, "HTTP/1.1 204 No Content\r\n\r\n", "", false, true, true},
+		{"304", get, "HTTP/1.1 304 Not Modified\r\nETag: \"x\"\r\n\r\n", "", false, true, true},
+	}
+	for _, c := range cases {
+		t.Run(c.name, func(t *testing.T) {
+			req := readTestRequest(t, c.req)
+			resp, err := http.ReadResponse(bufio.NewReader(strings.NewReader(c.resp)), req)
+			if err != nil {
+				t.Fatal(err)
+			}
+			conn := &recordConn{}
+			keepAlive, reusable, err := writeProxyResponse(conn, resp, req)
+			if err != nil {
+				t.Fatal(err)
+			}
+			if keepAlive != c.keepAlive || reusable != c.reusable {
+				t.Errorf("keepAlive, reusable = %v, %v, 期望 %v, %v", keepAlive, reusable, c.keepAlive, c.reusable)
+			}
+
+			// 客户端按写出的报文解析，报文之后不应有多余字节
+			br := bufio.NewReader(bytes.NewReader(conn.out.Bytes()))
+			got, err := http.ReadResponse(br, req)
+			if err != nil {
+				t.Fatalf("%v\n%s", err, conn.out.Bytes())
+			}
+			body, err := io.ReadAll(got.Body)
+			if err != nil {
+				t.Fatal(err)
+			}
+			if string(body) != c.body {
+				t.Errorf("响应体 = %q, 期望 %q", body, c.body)
+			}
+			if chunked := len(got.TransferEncoding) > 0; chunked != c.chunked {
+				t.Errorf("分块 = %v, 期望 %v", chunked, c.chunked)
+			}
+			if got.Close == keepAlive {
+				t.Errorf("Connection: close = %v, 与 keepAlive = %v 不符", got.Close, keepAlive)
+			}
+			if keepAlive && br.Buffered() > 0 {
+				t.Errorf("报文之后多出 %d 字节", br.Buffered())
+			}
+		})
+	}
+}
+
+// TestHTTPProxyReuse 经直连的普通代理请求复用到源站的连接；源站关闭空闲连接或声明 Connection: close 后改用新连接
+func TestHTTPProxyReuse(t *testing.T) {
+	var conns, closed atomic.Int32
+	origin := &http.Server{
+		Handler: http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+			if r.URL.Query().Has("close") {
+				w.Header().Set("Connection", "close")
+			}
+			fmt.Fprint(w, r.URL.Path)
+		}),
+		ConnState: func(_ net.Conn, state http.ConnState) {
+			switch state {
+			case http.StateNew:
+				conns.Add(1)
+			case http.StateClosed:
+				closed.Add(1)
+			}
+		},
+	}
+	ln, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		t.Fatal(err)
+	}
+	go origin.Serve(ln)
+	defer origin.Close()
+
+	saved := routes.Load()
+	routes.Store(&routeTable{mode: "direct"})
+	defer routes.Store(saved)
+	httpPool.closeIdle()
+	defer httpPool.closeIdle()
+
+	get := func(path string, wantKeepAlive bool) {
+		t.Helper()
+		req := readTestRequest(t, "GET http://"+ln.Addr().String()+path+" HTTP/1.1\r\nHost: "+ln.Addr().String()+"\r\n\r\n")
+		conn := &recordConn{}
+		keepAlive, err := proxyHTTPRequest(conn, nil, req, "127.0.0.1:1")
+		if err != nil || keepAlive != wantKeepAlive {
+			t.Fatalf("%s: keepAlive = %v, err = %v", path, keepAlive, err)
+		}
+		resp, err := http.ReadResponse(bufio.NewReader(&conn.out), req)
+		if err != nil {
+			t.Fatal(err)
+		}
+		body, _ := io.ReadAll(resp.Body)
+		if string(body) != strings.Split(path, "?")[0] {
+			t.Fatalf("%s: 响应体 = %q", path, body)
+		}
+	}
+	expectConns := func(want int32) {
+		t.Helper()
+		if got := conns.Load(); got != want {
+			t.Fatalf("源站连接数 = %d, 期望 %d", got, want)
+		}
+	}
+
+	reused := metrics.httpReused.Load()
+	get("/a", true)
+	get("/b", true)
+	get("/c", true)
+	expectConns(1)
+	if n := metrics.httpReused.Load() - reused; n != 2 {
+		t.Errorf("复用次数 = %d, 期望 2", n)
+	}
+
+	// 池中的连接已被源站关闭：没有请求体的请求换一条新连接重试
+	origin.SetKeepAlivesEnabled(false)
+	origin.SetKeepAlivesEnabled(true)
+	waitUntil(t, func() bool { return closed.Load() == 1 })
+	get("/d", true)
+	expectConns(2)
+
+	// 源站要求关闭的连接不放回池中
+	get("/e?close", false)
+	get("/f", true)
+	expectConns(3)
+}
+
+// waitUntil 等待 cond 为真，最长 2 秒
+func waitUntil(t *testing.T, cond func() bool) {
+	t.Helper()
+	for deadline := time.Now().Add(2 * time.Second); !cond(); time.Sleep(5 * time.Millisecond) {
+		if time.Now().After(deadline) {
+			t.Fatal("等待超时")
+		}
+	}
+}
+
+// ======================== 分流规则 ========================
+
+func TestParseIPRange(t *testing.T) {
+	cases := []struct {
+		line       string
+		start, end string // 为空表示应忽略该行
+	}{
+		{"1.0.1.0/24", "1.0.1.0", "1.0.1.255"},
+		{"  1.0.2.0 1.0.7.255  ", "1.0.2.0", "1.0.7.255"},
+		{"1.0.2.0\t1.0.2.0", "1.0.2.0", "1.0.2.0"},
+		{"1.0.8.1", "1.0.8.1", "1.0.8.1"},
+		{"0.0.0.0/0", "0.0.0.0", "255.255.255.255"},
+		{"1.0.1.7/24", "1.0.1.0", "1.0.1.255"},
+		{"", "", ""},
+		{"# 1.0.1.0/24", "", ""},
+		{"1.0.2.0 1.0.1.0", "", ""},
+		{"1.0.1.0/33", "", ""},
+		{"2001:db8::/32", "", ""},
+		{"2001:db8:: 2001:db8::ff", "", ""},
+		{"::ffff:1.0.1.0/120", "", ""},
+		{"example.com", "", ""},
+	}
+	for _, c := range cases {
+		r, ok := parseIPRange(c.line)
+		if c.start == "" {
+			if ok {
+				t.Errorf("parseIPRange(%q) = %s, 期望忽略", c.line, nftElement(r))
+			}
+			continue
+		}
+		if !ok || uintToIPv4(r.start).String() != c.start || uintToIPv4(r.end).String() != c.end {
+			t.Errorf("parseIPRange(%q) = %s-%s, %v, 期望 %s-%s", c.line, uintToIPv4(r.start), uintToIPv4(r.end), ok, c.start, c.end)
+		}
+	}
+}
+
+func TestBypassCNResolve(t *testing.T) {
+	cnIPList := filepath.Join(t.TempDir(), "cn_ip.txt")
+	list := "# 中国大陆 IP\n1.0.1.0/24\n\n1.0.2.0 1.0.8.0\nnot-an-ip\n2001:db8::/32\n36.0.0.0/8\n"
+	if err := os.WriteFile(cnIPList, []byte(list), 0600); err != nil {
+		t.Fatal(err)
+	}
+
+	// 分流只按目标的字面值判断，域名交给服务端解析，本地不应发起任何 DNS 查询
+	var lookups atomic.Int32
+	saved := net.DefaultResolver
+	net.DefaultResolver = &net.Resolver{PreferGo: true, Dial: func(ctx context.Context, network, address string) (net.Conn, error) {
+		lookups.Add(1)
+		return nil, errors.New("测试中不应解析域名")
+	}}
+	defer func() { net.DefaultResolver = saved }()
+
+	table, err := loadRouteTable(&proxySettings{
+		Server:   "default.example.com:443",
+		Routing:  "bypass_cn",
+		Name:     "默认",
+		CNIPList: cnIPList,
+	})
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	cases := []struct {
+		target string
+		direct bool
+	}{
+		// 中国大陆列表：CIDR 行与 "起始 结束" 行
+		{"1.0.1.5:443", true},
+		{"1.0.2.0:443", true},
+		{"1.0.8.0:443", true},
+		{"1.0.8.1:443", false},
+		{"36.1.2.3", true},
+		{"8.8.8.8:53", false},
+		// 内网地址
+		{"10.1.2.3:80", true},
+		{"127.0.0.1:8080", true},
+		{"100.64.0.1:80", true},
+		{"169.254.1.1:80", true},
+		{"172.31.255.255:80", true},
+		{"172.32.0.1:80", false},
+		{"192.168.1.1:80", true},
+		{"[::1]:443", true},
+		{"[fd00::1]:443", true},
+		{"[fe80::1]:443", true},
+		{"[2001:db8::1]:443", false},
+		// 域名后缀
+		{"baidu.com:443", true},
+		{"www.BAIDU.com.:443", true},
+		{"notbaidu.com:443", false},
+		{"baidu.com.example.org:443", false},
+		{"example.com.cn:443", true},
+		{"cn.example.com:443", false},
+		{"printer.local:631", true},
+		{"localhost:8080", true},
+	}
+	for _, c := range cases {
+		if got := table.resolve(c.target) == nil; got != c.direct {
+			t.Errorf("%s: 直连 = %v, 期望 %v", c.target, got, c.direct)
+		}
+	}
+	if n := lookups.Load(); n != 0 {
+		t.Errorf("分流时发起了 %d 次 DNS 查询", n)
+	}
+}
+
+// ======================== 策略路由 ========================
+
+// newPolicyTable 以 direct 模式编译规则：未命中任何规则的目标直连，便于区分 PROXY 和未命中
+func newPolicyTable(t *testing.T, rules ...string) *routeTable {
+	t.Helper()
+	table, err := loadRouteTable(&proxySettings{
+		Server:  "default.example.com:443",
+		Routing: "direct",
+		Name:    "默认",
+		Upstreams: []upstreamConfig{
+			{Name: "hk", Server: "hk.example.com:443"},
+			{Name: "us", Server: "us.example.com:443"},
+		},
+		Rules: rules,
+	})
+	if err != nil {
+		t.Fatal(err)
+	}
+	return table
+}
+
+func upstreamName(up *upstream) string {
+	if up == nil {
+		return policyDirect
+	}
+	return up.name
+}
+
+func TestPolicyResolve(t *testing.T) {
+	table := newPolicyTable(t,
+		"DOMAIN-SUFFIX,example.com,hk",
+		"DOMAIN-SUFFIX,video.example.com,us",
+		"domain-suffix, .Cdn.Example.Net. ,DIRECT",
+		"IP-CIDR,10.0.0.0/8,us",
+		"IP-CIDR,10.1.0.0/16,hk",
+		"IP-CIDR,192.168.1.0/24,DIRECT",
+		"IP-CIDR,192.168.0.0/16,hk",
+		"DOMAIN-SUFFIX,example.com,us",
+		"IP-CIDR,172.16.0.1,PROXY",
+		"DOMAIN-SUFFIX,proxy.example.org,PROXY",
+	)
+	cases := []struct {
+		target, want string
+	}{
+		{"example.com:443", "hk"},
+		{"www.example.com:443", "hk"},           // 后缀匹配
+		{"EXAMPLE.COM.:80", "hk"},               // 大小写和末尾的点
+		{"video.example.com:443", "us"},         // 最长后缀优先
+		{"a.video.example.com:443", "us"},       // 最长后缀优先
+		{"notexample.com:443", policyDirect},    // 只按整个标签匹配
+		{"com:443", policyDirect},               // 后缀的上级不匹配
+		{"x.cdn.example.net:443", policyDirect}, // 规则值去掉首尾的点和空白
+		{"10.1.2.3:443", "us"},                  // 重叠时靠前的规则优先
+		{"10.255.255.255:443", "us"},            // 区间末尾
+		{"11.0.0.0:443", policyDirect},          // 区间之外
+		{"192.168.1.9:80", policyDirect},        // 靠前的小区间挖掉靠后的大区间
+		{"192.168.0.255:80", "hk"},              // 小区间之前
+		{"192.168.2.0:80", "hk"},                // 小区间之后
+		{"172.16.0.1:80", "默认"},                 // PROXY 为默认服务端
+		{"a.proxy.example.org:443", "默认"},       // PROXY 为默认服务端
+		{"[2001:db8::1]:443", policyDirect},     // IP-CIDR 只匹配 IPv4
+		{"10.1.2.3", "us"},                      // 没有端口
+	}
+	for _, c := range cases {
+		if got := upstreamName(table.resolve(c.target)); got != c.want {
+			t.Errorf("resolve(%q) = %s, 期望 %s", c.target, got, c.want)
+		}
+	}
+}
+
+func TestCompilePolicyRanges(t *testing.T) {
+	cases := []struct {
+		name    string
+		in, out []policyRange
+	}{
+		{"空", nil, nil},
+		{"靠后的规则部分重叠",
+			[]policyRange{{ipRange{0, 10}, 0}, {ipRange{5, 20}, 1}},
+			[]policyRange{{ipRange{0, 10}, 0}, {ipRange{11, 20}, 1}}},
+		{"靠前的规则部分重叠",
+			[]policyRange{{ipRange{0, 10}, 1}, {ipRange{5, 20}, 0}},
+			[]policyRange{{ipRange{0, 4}, 1}, {ipRange{5, 20}, 0}}},
+		{"靠前的大区间覆盖靠后的小区间",
+			[]policyRange{{ipRange{0, 100}, 0}, {ipRange{10, 20}, 1}},
+			[]policyRange{{ipRange{0, 100}, 0}}},
+		{"靠前的小区间挖开靠后的大区间",
+			[]policyRange{{ipRange{0, 100}, 1}, {ipRange{10, 20}, 0}},
+			[]policyRange{{ipRange{0, 9}, 1}, {ipRange{10, 20}, 0}, {ipRange{21, 100}, 1}}},
+		{"同一规则的相邻区间合并",
+			[]policyRange{{ipRange{5, 9}, 0}, {ipRange{0, 4}, 0}},
+			[]policyRange{{ipRange{0, 9}, 0}}},
+		{"不同规则的相邻区间不合并",
+			[]policyRange{{ipRange{0, 4}, 0}, {ipRange{5, 9}, 1}},
+			[]policyRange{{ipRange{0, 4}, 0}, {ipRange{5, 9}, 1}}},
+		{"有间隔",
+			[]policyRange{{ipRange{0, 1}, 0}, {ipRange{5, 6}, 1}},
+			[]policyRange{{ipRange{0, 1}, 0}, {ipRange{5, 6}, 1}}},
+		{"地址空间末尾",
+			[]policyRange{{ipRange{0xfffffff0, 0xffffffff}, 1}, {ipRange{0xffffff00, 0xfffffff7}, 0}},
+			[]policyRange{{ipRange{0xffffff00, 0xfffffff7}, 0}, {ipRange{0xfffffff8, 0xffffffff}, 1}}},
+	}
+	for _, c := range cases {
+		got := compilePolicyRanges(append([]policyRange(nil), c.in...))
+		if !reflect.DeepEqual(got, c.out) {
+			t.Errorf("%s: compilePolicyRanges(%v) = %v, 期望 %v", c.name, c.in, got, c.out)
+		}
+	}
+}
+
+func TestPolicyHostCache(t *testing.T) {
+	table := newPolicyTable(t, "DOMAIN-SUFFIX,example.com,hk")
+	if got := upstreamName(table.resolve("WWW.Example.com.:443")); got != "hk" {
+		t.Fatalf("resolve = %s, 期望 hk", got)
+	}
+	// 缓存键为去掉端口、转小写后的主机名，命中后不再查规则
+	if _, ok := table.cache["www.example.com"]; !ok || len(table.cache) != 1 {
+		t.Fatalf("缓存内容 = %v", table.cache)
+	}
+	table.policyTargets[0] = nil
+	if got := upstreamName(table.resolve("www.example.com:80")); got != "hk" {
+		t.Errorf("缓存命中时 resolve = %s, 期望 hk", got)
+	}
+	if got := upstreamName(table.resolve("api.example.com:443")); got != policyDirect {
+		t.Errorf("未缓存的主机 resolve = %s, 期望 %s", got, policyDirect)
+	}
+
+	// 超过上限时整体清空
+	for i := len(table.cache); i < routeCacheSize; i++ {
+		table.resolve(fmt.Sprintf("h%d.test:443", i))
+	}
+	if len(table.cache) != routeCacheSize {
+		t.Fatalf("缓存条目 = %d, 期望 %d", len(table.cache), routeCacheSize)
+	}
+	table.resolve("overflow.test:443")
+	if len(table.cache) != 1 {
+		t.Errorf("超过上限后缓存条目 = %d, 期望 1", len(table.cache))
+	}
+}
+
+func TestPolicyInvalid(t *testing.T) {
+	cases := []struct {
+		name      string
+		upstreams []upstreamConfig
+		rules     []string
+	}{
+		{"缺少目标", nil, []string{"DOMAIN-SUFFIX,example.com"}},
+		{"多余字段", nil, []string{"DOMAIN-SUFFIX,example.com,PROXY,x"}},
+		{"值为空", nil, []string{"DOMAIN-SUFFIX, ,PROXY"}},
+		{"目标为空", nil, []string{"DOMAIN-SUFFIX,example.com,"}},
+		{"未知类型", nil, []string{"GEOIP,CN,DIRECT"}},
+		{"无效 CIDR", nil, []string{"IP-CIDR,300.0.0.0/8,DIRECT"}},
+		{"IPv6 CIDR", nil, []string{"IP-CIDR,2001:db8::/32,DIRECT"}},
+		{"未定义的服务端", nil, []string{"DOMAIN-SUFFIX,example.com,jp"}},
+		{"服务端缺少名称", []upstreamConfig{{Server: "hk.example.com:443"}}, nil},
+		{"服务端使用保留名", []upstreamConfig{{Name: policyDirect, Server: "hk.example.com:443"}}, nil},
+		{"服务端与默认服务端重名", []upstreamConfig{{Name: "默认", Server: "hk.example.com:443"}}, nil},
+		{"服务端重名", []upstreamConfig{{Name: "hk", Server: "a.example.com:443"}, {Name: "hk", Server: "b.example.com:443"}}, nil},
+		{"服务端地址为空", []upstreamConfig{{Name: "hk"}}, nil},
+		{"服务端地址无效", []upstreamConfig{{Name: "hk", Server: "hk.example.com"}}, nil},
+	}
+	for _, c := range cases {
+		_, err := loadRouteTable(&proxySettings{
+			Server: "default.example.com:443", Routing: "global", Name: "默认",
+			Upstreams: c.upstreams, Rules: c.rules,
+		})
+		if err == nil {
+			t.Errorf("%s: 期望加载失败", c.name)
+		}
+	}
+}
+
+// ======================== 透明代理 ========================
+
+// parseRanges 按 loadIPRangeFile 的方式解析并合并列表行
+func parseRanges(t *testing.T, lines ...string) []ipRange {
+	t.Helper()
+	var ranges []ipRange
+	for _, line := range lines {
+		r, ok := parseIPRange(line)
+		if !ok {
+			t.Fatalf("无法解析 %q", line)
+		}
+		ranges = append(ranges, r)
+	}
+	return mergeIPRanges(ranges)
+}
+
+// applyNftDelta 按 nftables 区间集合的语义执行增量：删除的元素必须原样存在，新增的元素不能与剩余元素重叠
+func applyNftDelta(t *testing.T, set, removed, added []ipRange) []ipRange {
+	t.Helper()
+	elements := make(map[ipRange]bool, len(set))
+	for _, r := range set {
+		elements[r] = true
+	}
+	for _, r := range removed {
+		if !elements[r] {
+			t.Fatalf("删除不存在的元素 %s", nftElement(r))
+		}
+		delete(elements, r)
+	}
+	for _, r := range added {
+		for e := range elements {
+			if r.start <= e.end && e.start <= r.end {
+				t.Fatalf("新增元素 %s 与 %s 重叠", nftElement(r), nftElement(e))
+			}
+		}
+		elements[r] = true
+	}
+	var result []ipRange
+	for r := range elements {
+		result = append(result, r)
+	}
+	sort.Slice(result, func(i, j int) bool { return result[i].start < result[j].start })
+	return result
+}
+
+func TestDiffIPRanges(t *testing.T) {
+	cases := []struct {
+		name     string
+		old, cur []string
+	}{
+		{"相同", []string{"1.0.1.0/24", "1.0.8.0/21"}, []string{"1.0.8.0/21", "1.0.1.0/24"}},
+		{"旧列表为空", nil, []string{"1.0.1.0/24", "1.0.8.0/21"}},
+		{"新列表为空", []string{"1.0.1.0/24", "1.0.8.0/21"}, nil},
+		{"只有删除", []string{"1.0.1.0/24", "1.0.8.0/21", "36.0.0.0/8"}, []string{"1.0.8.0/21"}},
+		{"只有新增", []string{"1.0.8.0/21"}, []string{"1.0.1.0/24", "1.0.8.0/21", "36.0.0.0/8"}},
+		{"相邻网段合并", []string{"1.0.0.0/24", "1.0.2.0/24"}, []string{"1.0.0.0/24", "1.0.1.0/24", "1.0.2.0/24"}},
+		{"合并后拆开", []string{"1.0.0.0/22"}, []string{"1.0.0.0/24", "1.0.2.0/23"}},
+		{"同起点不同终点", []string{"1.0.0.0/24"}, []string{"1.0.0.0/23"}},
+		{"重叠区间", []string{"1.0.0.0 1.0.5.255", "2.0.0.0/8"}, []string{"1.0.4.0 1.0.9.255", "1.0.0.0/24", "2.0.0.0/9"}},
+		{"整个地址空间", []string{"10.0.0.0/8"}, []string{"0.0.0.0/1", "128.0.0.0/1"}},
+	}
+	for _, c := range cases {
+		t.Run(c.name, func(t *testing.T) {
+			old, cur := parseRanges(t, c.old...), parseRanges(t, c.cur...)
+			removed, added := diffIPRanges(old, cur)
+			got := applyNftDelta(t, old, removed, added)
+			if !reflect.DeepEqual(got, cur) {
+				t.Errorf("增量应用后 = %v, 期望 %v（删除 %v，新增 %v）", got, cur, removed, added)
+			}
+			if reflect.DeepEqual(old, cur) && (len(removed) > 0 || len(added) > 0) {
+				t.Errorf("列表未变化却产生增量: 删除 %v，新增 %v", removed, added)
+			}
+		})
+	}
+}
+
+func TestNftElement(t *testing.T) {
+	cases := []struct {
+		line, want string
+	}{
+		{"1.2.3.4", "1.2.3.4"},
+		{"1.2.3.4/32", "1.2.3.4"},
+		{"1.2.3.0/24", "1.2.3.0/24"},
+		{"1.2.3.4 1.2.3.5", "1.2.3.4/31"},
+		{"1.2.3.5 1.2.3.6", "1.2.3.5-1.2.3.6"},
+		{"1.0.0.0 1.0.2.255", "1.0.0.0-1.0.2.255"},
+		{"1.0.1.0 1.0.2.255", "1.0.1.0-1.0.2.255"},
+		{"0.0.0.0/0", "0.0.0.0/0"},
+		{"128.0.0.0 255.255.255.255", "128.0.0.0/1"},
+		{"255.255.255.255", "255.255.255.255"},
+	}
+	for _, c := range cases {
+		r, ok := parseIPRange(c.line)
+		if !ok {
+			t.Fatalf("无法解析 %q", c.line)
+		}
+		if got := nftElement(r); got != c.want {
+			t.Errorf("nftElement(%q) = %q, 期望 %q", c.line, got, c.want)
+		}
+	}
+}
+
+// ======================== 首帧等待策略 ========================
+
+// observation 一次首帧等待的结果
+type observation struct {
+	sent   bool
+	waited time.Duration
+}
+
+func repeat(n int, sent bool, waited time.Duration) []observation {
+	obs := make([]observation, n)
+	for i := range obs {
+		obs[i] = observation{sent, waited}
+	}
+	return obs
+}
+
+func TestEarlyDataWait(t *testing.T) {
+	cases := []struct {
+		name string
+		port int
+		obs  []observation
+		want time.Duration
+	}{
+		{"未学到规律", 443, nil, earlyDataMaxWait},
+		{"样本不足", 443, repeat(5, false, earlyDataMaxWait), earlyDataMaxWait},
+		{"服务端先发言", 22, repeat(20, true, time.Millisecond), 0},
+		{"客户端先发", 443, repeat(20, true, 10*time.Millisecond), 20 * time.Millisecond},
+		{"首帧很快时不低于下限", 443, repeat(20, true, time.Millisecond), earlyDataMinWait},
+		{"首帧很慢时不超过上限", 443, repeat(20, true, 90*time.Millisecond), earlyDataMaxWait},
+		{"客户端不先发", 80, repeat(20, false, earlyDataMaxWait), 0},
+		{"首帧变慢后等待变长", 443, append(repeat(20, true, 10*time.Millisecond), repeat(20, true, 40*time.Millisecond)...), 76 * time.Millisecond},
+	}
+	for _, c := range cases {
+		p := &earlyDataPolicy{ports: make(map[int]*earlyDataStat)}
+		for _, o := range c.obs {
+			p.observe(c.port, o.sent, o.waited)
+		}
+		// 允许 EWMA 取整带来的 1ms 误差
+		if got := p.wait(c.port); got < c.want-time.Millisecond || got > c.want+time.Millisecond {
+			t.Errorf("%s: wait = %v, 期望 %v", c.name, got, c.want)
+		}
+	}
+}
+
+// TestEarlyDataAdapts 客户端行为改变后等待时长随之增减，且始终为 0 或在 [下限, 上限] 之内
+func TestEarlyDataAdapts(t *testing.T) {
+	const port = 443
+	p := &earlyDataPolicy{ports: make(map[int]*earlyDataStat)}
+	check := func(phase string, sent bool, waited time.Duration, done func(time.Duration) bool) {
+		t.Helper()
+		for i := 0; i < 60; i++ {
+			wait := p.wait(port)
+			if wait != 0 && (wait < earlyDataMinWait || wait > earlyDataMaxWait) {
+				t.Fatalf("%s: wait = %v 超出范围", phase, wait)
+			}
+			if done(wait) {
+				return
+			}
+			p.observe(port, sent, waited)
+		}
+		t.Fatalf("%s: 60 次观测后仍未调整", phase)
+	}
+
+	check("客户端先发", true, 10*time.Millisecond, func(w time.Duration) bool { return w == 20*time.Millisecond })
+	check("客户端改为不先发", false, 20*time.Millisecond, func(w time.Duration) bool { return w == 0 })
+
+	// 判定为不等待后每 earlyDataProbeEvery 个连接仍按上限探测一次
+	probes := 0
+	for i := 0; i < 4*earlyDataProbeEvery; i++ {
+		switch p.wait(port) {
+		case earlyDataMaxWait:
+			probes++
+		case 0:
+		default:
+			t.Fatal("不等待的端口只应返回 0 或上限")
+		}
+	}
+	if probes != 4 {
+		t.Errorf("%d 个连接中探测 %d 次, 期望 4", 4*earlyDataProbeEvery, probes)
+	}
+
+	// 探测到首帧后恢复等待
+	check("客户端恢复先发", true, 10*time.Millisecond, func(w time.Duration) bool { return w > 0 && w < earlyDataMaxWait })
+}
+
+// ======================== 连接握手 ========================
+
+// binaryConnectFixture tests/worker/binary-connect.json 中的一条用例，Worker 测试用同一份字节验证解析
+type binaryConnectFixture struct {
+	Name   string `json:"name"`
+	Target string `json:"target"`
+	Early  string `json:"early"`
+	Frame  string `json:"frame"`
+	Host   string `json:"host"`
+	Port   int    `json:"port"`
+	Error  bool   `json:"error"`
+}
+
+func TestAppendBinaryConnect(t *testing.T) {
+	path := filepath.Join("tests", "worker", "binary-connect.json")
+	if _, err := os.Stat(path); err != nil {
+		// 按 README 复制到 ech-wk-package/src 中运行时
+		path = filepath.Join("..", "..", path)
+	}
+	data, err := os.ReadFile(path)
+	if err != nil {
+		t.Fatal(err)
+	}
+	var fixtures []binaryConnectFixture
+	if err := json.Unmarshal(data, &fixtures); err != nil {
+		t.Fatal(err)
+	}
+
+	for _, f := range fixtures {
+		t.Run(f.Name, func(t *testing.T) {
+			early, err := hex.DecodeString(f.Early)
+			if err != nil {
+				t.Fatal(err)
+			}
+			// 追加到已有内容之后，前缀保持不变
+			prefix := []byte("prefix")
+			got, err := appendBinaryConnect(append([]byte(nil), prefix...), f.Target, early)
+			if f.Error {
+				if err == nil {
+					t.Fatalf("期望失败，得到 %x", got)
+				}
+				return
+			}
+			if err != nil {
+				t.Fatal(err)
+			}
+			if !bytes.HasPrefix(got, prefix) {
+				t.Fatalf("前缀被覆盖: %x", got)
+			}
+			frame := got[len(prefix):]
+			if want := f.Frame; hex.EncodeToString(frame) != want {
+				t.Fatalf("握手帧 = %x, 期望 %s", frame, want)
+			}
+
+			target, gotEarly, err := parseLoadConnect(websocket.BinaryMessage, frame)
+			if err != nil {
+				t.Fatal(err)
+			}
+			if target != f.Target {
+				t.Errorf("解析出的目标 = %s, 期望 %s", target, f.Target)
+			}
+			if !bytes.Equal(gotEarly, early) {
+				t.Errorf("解析出的首帧 = %x, 期望 %x", gotEarly, early)
+			}
+		})
+	}
+}
+
+// ======================== TLS 握手 ========================
+
+// BenchmarkTLS 在回环 TLS 1.3 服务上比较完整握手与复用会话票据的握手，每次操作为一次 TCP 建连加握手。
+// 运行时支持时双方启用 ECH（服务端需要 Go 1.24+），否则为普通 TLS 1.3
+func BenchmarkTLS(b *testing.B) {
+	_, cert, err := newBenchCertificate(loadBenchHost)
+	if err != nil {
+		b.Fatal(err)
+	}
+	leaf, err := x509.ParseCertificate(cert.Certificate[0])
+	if err != nil {
+		b.Fatal(err)
+	}
+	echConfig, echKey, err := newBenchECHKey(loadBenchHost)
+	if err != nil {
+		b.Fatal(err)
+	}
+	echConfigList := append([]byte{byte(len(echConfig) >> 8), byte(len(echConfig))}, echConfig...)
+	srvCfg := &tls.Config{MinVersion: tls.VersionTLS13, Certificates: []tls.Certificate{cert}}
+	useECH := setECHServerKey(srvCfg, echConfig, echKey) == nil
+	if !useECH {
+		b.Log("运行时不支持服务端 ECH，测量普通 TLS 1.3 握手")
+	}
+
+	ln, err := tls.Listen("tcp", "127.0.0.1:0", srvCfg)
+	if err != nil {
+		b.Fatal(err)
+	}
+	defer ln.Close()
+	go func() {
+		for {
+			conn, err := ln.Accept()
+			if err != nil {
+				return
+			}
+			go func() {
+				defer conn.Close()
+				conn.Write([]byte{0x01})
+				io.Copy(io.Discard, conn)
+			}()
+		}
+	}()
+
+	roots := x509.NewCertPool()
+	roots.AddCert(leaf)
+	for _, variant := range []string{"full", "resumed"} {
+		b.Run(variant, func(b *testing.B) {
+			cfg := &tls.Config{MinVersion: tls.VersionTLS13, ServerName: loadBenchHost, RootCAs: roots}
+			if useECH {
+				if err := setECHConfig(cfg, echConfigList); err != nil {
+					b.Fatal(err)
+				}
+			}
+			if variant == "resumed" {
+				cfg.ClientSessionCache = (&tlsSessionCache{sessions: make(map[string]*tls.ClientSessionState)}).forECH(echConfigList)
+				// 先完整握手一次取得会话票据
+				if _, err := benchTLSHandshake(ln.Addr().String(), cfg); err != nil {
+					b.Fatal(err)
+				}
+			}
+
+			resumed := 0
+			b.ResetTimer()
+			for i := 0; i < b.N; i++ {
+				didResume, err := benchTLSHandshake(ln.Addr().String(), cfg)
+				if err != nil {
+					b.Fatal(err)
+				}
+				if didResume {
+					resumed++
+				}
+			}
+			b.ReportMetric(float64(resumed)/float64(b.N), "resumed/op")
+		})
+	}
+}
+
+// benchTLSHandshake 建立一条 TLS 连接，读取服务端的首字节（顺带处理握手后下发的会话票据）后关闭
+func benchTLSHandshake(addr string, cfg *tls.Config) (bool, error) {
+	raw, err := net.Dial("tcp", addr)
+	if err != nil {
+		return false, err
+	}
+	conn := tls.Client(raw, cfg)
+	defer conn.Close()
+	if err := conn.Handshake(); err != nil {
+		return false, err
+	}
+	_, err = io.ReadFull(conn, make([]byte, 1))
+	return conn.ConnectionState().DidResume, err
+}
+
+// ======================== 负载测试 ========================
+
+// 负载测试拉起被测代理进程（默认为测试程序自身，经 TestMain 进入 main），压测客户端经它访问本机源站：
+//
+//	压测客户端 --SOCKS5/HTTP CONNECT--> 被测代理 --wss+ECH--> 模拟 Worker --TCP--> 回显/吸收/发送源站
+//
+// 模拟 Worker 同时提供 DoH 并返回自己生成的 ECH 配置，被测代理通过 SSL_CERT_FILE 信任自签名证书，
+// 所以 DoH、ECH 握手和转发走的都是线上路径，只是把 Cloudflare 换成了回环。
+// 模拟 Worker 的服务端 ECH 需要 Go 1.24+。基线与机器相关，只在本地生成和比较，不提交到仓库：
+//
+//	go test -run TestLoad -load -load-update   # 生成本地基线
+//	go test -run TestLoad -load                # 与本地基线比较
+
+var (
+	loadEnabled        = flag.Bool("load", false, "运行负载测试 TestLoad")
+	loadClients        = flag.Int("load-conns", 64, "负载测试的并发客户端数")
+	loadPhaseDuration  = flag.Duration("load-duration", 5*time.Second, "负载测试每个阶段的时长")
+	loadBackendPath    = flag.String("load-backend", "", "被测代理可执行文件（默认为测试程序自身，需兼容本程序的命令行参数）")
+	loadBaselineFile   = flag.String("load-baseline", "load_baseline.json", "本地基线文件")
+	loadUpdateBaseline = flag.Bool("load-update", false, "用本次结果写入本地基线")
+)
+
+// loadBackendEnv 设置后测试程序不运行测试，而是作为被测代理执行 main
+const loadBackendEnv = "ECH_WK_LOAD_BACKEND"
+
+func TestMain(m *testing.M) {
+	if os.Getenv(loadBackendEnv) == "1" {
+		main()
+		return
+	}
+	os.Exit(m.Run())
+}
+
+const (
+	loadBenchPayload   = 32        // 建连测试每个连接往返的字节数
+	loadBenchChunk     = 32 * 1024 // 吞吐测试的读写块大小
+	loadBenchTolerance = 1.25      // 与基线比较时允许的退化倍数
+	loadBenchSlackMs   = 20        // 延迟比较额外允许的毫秒数，避免延迟很低时抖动误报
+	loadBenchReadyWait = 15 * time.Second
+)
+
+// loadPhaseResult 单个压测阶段的结果；建连阶段填写连接速率和延迟，吞吐阶段填写 MB/s
+type loadPhaseResult struct {
+	Conns       int     `json:"conns,omitempty"`
+	ConnsPerSec float64 `json:"conns_per_sec,omitempty"`
+	P50Ms       float64 `json:"connect_p50_ms,omitempty"`
+	P99Ms       float64 `json:"connect_p99_ms,omitempty"`
+	MBPerSec    float64 `json:"mb_per_sec,omitempty"`
+	Errors      int64   `json:"errors"`
+	RSSKB       int64   `json:"rss_kb,omitempty"` // 阶段结束时被测进程的常驻内存
+}
+
+type loadReport struct {
+	Backend    string                      `json:"backend"`
+	Platform   string                      `json:"platform"`
+	Go         string                      `json:"go"`
+	Clients    int                         `json:"clients"`
+	DurationMs int64                       `json:"duration_ms"`
+	Results    map[string]*loadPhaseResult `json:"results"`
+	PeakRSSKB  int64                       `json:"peak_rss_kb,omitempty"`
+	CPUMs      int64                       `json:"cpu_ms,omitempty"` // 被测进程的 user+sys CPU 时间
+}
+
+// TestLoad 压测被测代理的建连速率、建连延迟、吞吐量和内存占用，以 JSON 输出并与本地基线比较
+func TestLoad(t *testing.T) {
+	if !*loadEnabled {
+		t.Skip("负载测试需要 -load")
+	}
+	dir := t.TempDir()
+
+	lw, err := startLoadWorker(dir)
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer lw.Close()
+
+	var sunk atomic.Int64
+	buf := make([]byte, loadBenchChunk)
+	echo, err := startLoadOrigin(func(c net.Conn) { io.Copy(c, c) })
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer echo.Close()
+	sink, err := startLoadOrigin(func(c net.Conn) {
+		buf := make([]byte, loadBenchChunk)
+		for {
+			n, err := c.Read(buf)
+			sunk.Add(int64(n))
+			if err != nil {
+				return
+			}
+		}
+	})
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer sink.Close()
+	source, err := startLoadOrigin(func(c net.Conn) {
+		for {
+			if _, err := c.Write(buf); err != nil {
+				return
+			}
+		}
+	})
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer source.Close()
+
+	backend, err := startLoadBackend(dir, lw)
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer backend.stop()
+
+	report := &loadReport{
+		Backend:    backend.name,
+		Platform:   runtime.GOOS + "/" + runtime.GOARCH,
+		Go:         runtime.Version(),
+		Clients:    *loadClients,
+		DurationMs: loadPhaseDuration.Milliseconds(),
+		Results:    make(map[string]*loadPhaseResult),
+	}
+	phases := []struct {
+		name string
+		run  func() *loadPhaseResult
+	}{
+		{"socks5", func() *loadPhaseResult { return loadConnectPhase(backend.listen, echo.Addr().String(), "socks5") }},
+		{"http", func() *loadPhaseResult { return loadConnectPhase(backend.listen, echo.Addr().String(), "http") }},
+		{"upload", func() *loadPhaseResult { return loadStreamPhase(backend.listen, sink.Addr().String(), true, &sunk) }},
+		{"download", func() *loadPhaseResult { return loadStreamPhase(backend.listen, source.Addr().String(), false, nil) }},
+	}
+	for _, phase := range phases {
+		t.Logf("load/%s: %d 个并发客户端, %v", phase.name, *loadClients, *loadPhaseDuration)
+		result := phase.run()
+		result.RSSKB, _ = processRSS(backend.cmd.Process.Pid)
+		report.Results[phase.name] = result
+	}
+	_, report.PeakRSSKB = processRSS(backend.cmd.Process.Pid)
+	report.CPUMs = backend.stop().Milliseconds()
+
+	out, err := json.MarshalIndent(report, "", "  ")
+	if err != nil {
+		t.Fatal(err)
+	}
+	fmt.Println(string(out))
+	if err := compareLoadBaseline(t, report); err != nil {
+		t.Fatal(err)
+	}
+}
+
+// loadConnectPhase 每个客户端循环执行 建连 -> 往返一次 -> 关闭，统计建连速率与握手延迟
+func loadConnectPhase(proxy, target, mode string) *loadPhaseResult {
+	var (
+		mu        sync.Mutex
+		latencies []time.Duration
+		errCount  atomic.Int64
+		wg        sync.WaitGroup
+	)
+	payload := bytes.Repeat([]byte{'x'}, loadBenchPayload)
+	start := time.Now()
+	deadline := start.Add(*loadPhaseDuration)
+
+	for i := 0; i < *loadClients; i++ {
+		wg.Add(1)
+		go func() {
+			defer wg.Done()
+			var local []time.Duration
+			buf := make([]byte, loadBenchPayload)
+			for time.Now().Before(deadline) {
+				dialStart := time.Now()
+				conn, err := loadDial(proxy, target, mode)
+				if err != nil {
+					errCount.Add(1)
+					time.Sleep(10 * time.Millisecond)
+					continue
+				}
+				latency := time.Since(dialStart)
+				_, err = conn.Write(payload)
+				if err == nil {
+					_, err = io.ReadFull(conn, buf)
+				}
+				conn.Close()
+				if err != nil {
+					errCount.Add(1)
+					continue
+				}
+				local = append(local, latency)
+			}
+			mu.Lock()
+			latencies = append(latencies, local...)
+			mu.Unlock()
+		}()
+	}
+	wg.Wait()
+	elapsed := time.Since(start)
+
+	result := &loadPhaseResult{Conns: len(latencies), Errors: errCount.Load()}
+	if len(latencies) > 0 {
+		sort.Slice(latencies, func(i, j int) bool { return latencies[i] < latencies[j] })
+		result.ConnsPerSec = float64(len(latencies)) / elapsed.Seconds()
+		result.P50Ms = float64(latencies[len(latencies)/2].Microseconds()) / 1000
+		result.P99Ms = float64(latencies[len(latencies)*99/100].Microseconds()) / 1000
+	}
+	return result
+}
+
+// loadStreamPhase 每个客户端保持一条 SOCKS5 隧道持续上传（sunk 记录源站实际收到的字节）或下载
+func loadStreamPhase(proxy, target string, upload bool, sunk *atomic.Int64) *loadPhaseResult {
+	result := &loadPhaseResult{}
+	conns := make([]net.Conn, 0, *loadClients)
+	for i := 0; i < *loadClients; i++ {
+		conn, err := loadDial(proxy, target, "socks5")
+		if err != nil {
+			result.Errors++
+			continue
+		}
+		defer conn.Close()
+		conns = append(conns, conn)
+	}
+	result.Conns = len(conns)
+	if len(conns) == 0 {
+		return result
+	}
+
+	var (
+		received atomic.Int64
+		wg       sync.WaitGroup
+	)
+	var base int64
+	if upload {
+		base = sunk.Load()
+	}
+	start := time.Now()
+	deadline := start.Add(*loadPhaseDuration)
+	for _, conn := range conns {
+		wg.Add(1)
+		go func(conn net.Conn) {
+			defer wg.Done()
+			conn.SetDeadline(deadline)
+			buf := make([]byte, loadBenchChunk)
+			for {
+				if upload {
+					if _, err := conn.Write(buf); err != nil {
+						return
+					}
+					continue
+				}
+				n, err := conn.Read(buf)
+				received.Add(int64(n))
+				if err != nil {
+					return
+				}
+			}
+		}(conn)
+	}
+	wg.Wait()
+	elapsed := time.Since(start)
+
+	total := received.Load()
+	if upload {
+		total = sunk.Load() - base
+	}
+	result.MBPerSec = float64(total) / (1 << 20) / elapsed.Seconds()
+	return result
+}
+
+// loadDial 经被测代理建立到 target（IPv4 地址）的隧道，按真实客户端的顺序等待每一步响应
+func loadDial(proxy, target, mode string) (net.Conn, error) {
+	conn, err := net.DialTimeout("tcp", proxy, 10*time.Second)
+	if err != nil {
+		return nil, err
+	}
+	conn.SetDeadline(time.Now().Add(15 * time.Second))
+
+	if mode == "http" {
+		fmt.Fprintf(conn, "CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n", target, target)
+		// 逐字节读取响应头，不预读隧道数据
+		head := make([]byte, 0, 64)
+		b := make([]byte, 1)
+		for !bytes.HasSuffix(head, []byte("\r\n\r\n")) {
+			if _, err := io.ReadFull(conn, b); err != nil || len(head) > 4096 {
+				conn.Close()
+				return nil, fmt.Errorf("读取 CONNECT 响应失败: %v", err)
+			}
+			head = append(head, b[0])
+		}
+		if !bytes.HasPrefix(head, []byte("HTTP/1.1 200")) && !bytes.HasPrefix(head, []byte("HTTP/1.0 200")) {
+			conn.Close()
+			return nil, fmt.Errorf("CONNECT 失败: %s", bytes.TrimSpace(head))
+		}
+		return conn, nil
+	}
+
+	host, portStr, _ := net.SplitHostPort(target)
+	port, _ := strconv.Atoi(portStr)
+	resp := make([]byte, 10)
+	if _, err := conn.Write([]byte{0x05, 0x01, 0x00}); err != nil {
+		conn.Close()
+		return nil, err
+	}
+	if _, err := io.ReadFull(conn, resp[:2]); err != nil {
+		conn.Close()
+		return nil, err
+	}
+	req := append([]byte{0x05, 0x01, 0x00, 0x01}, net.ParseIP(host).To4()...)
+	req = append(req, byte(port>>8), byte(port))
+	if _, err := conn.Write(req); err != nil {
+		conn.Close()
+		return nil, err
+	}
+	if _, err := io.ReadFull(conn, resp); err != nil {
+		conn.Close()
+		return nil, err
+	}
+	if resp[1] != 0x00 {
+		conn.Close()
+		return nil, fmt.Errorf("SOCKS5 连接失败: 0x%02x", resp[1])
+	}
+	return conn, nil
+}
+
+// startLoadOrigin 在回环上启动源站，每个连接交给 handle 处理
+func startLoadOrigin(handle func(net.Conn)) (net.Listener, error) {
+	ln, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		return nil, err
+	}
+	go func() {
+		for {
+			conn, err := ln.Accept()
+			if err != nil {
+				return
+			}
+			go func() {
+				defer conn.Close()
+				handle(conn)
+			}()
+		}
+	}()
+	return ln, nil
+}
+
+// loadBackend 被测代理进程
+type loadBackend struct {
+	name    string
+	cmd     *exec.Cmd
+	listen  string
+	exited  chan struct{}
+	stopped bool
+}
+
+// startLoadBackend 启动被测代理并等待其监听端口可用；-load-backend 可指定其他兼容命令行的可执行文件
+func startLoadBackend(dir string, lw *loadWorker) (*loadBackend, error) {
+	path, name := *loadBackendPath, filepath.Base(*loadBackendPath)
+	if path == "" {
+		self, err := os.Executable()
+		if err != nil {
+			return nil, err
+		}
+		path, name = self, "ech-workers"
+	}
+	ln, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		return nil, err
+	}
+	listen := ln.Addr().String()
+	ln.Close()
+
+	logPath := filepath.Join(dir, "backend.log")
+	logFile, err := os.Create(logPath)
+	if err != nil {
+		return nil, err
+	}
+	defer logFile.Close()
+
+	_, port, _ := net.SplitHostPort(lw.addr)
+	cmd := exec.Command(path,
+		"-l", listen,
+		"-f", net.JoinHostPort(loadBenchHost, port),
+		"-ip", "127.0.0.1",
+		"-dns", lw.dohURL,
+		"-ech", loadBenchHost,
+	)
+	cmd.Env = append(os.Environ(), "SSL_CERT_FILE="+lw.certFile, loadBackendEnv+"=1")
+	cmd.Stdout, cmd.Stderr = logFile, logFile
+	if err := cmd.Start(); err != nil {
+		return nil, err
+	}
+	b := &loadBackend{name: name, cmd: cmd, listen: listen, exited: make(chan struct{})}
+	go func() {
+		cmd.Wait()
+		close(b.exited)
+	}()
+
+	// 被测代理加载 ECH 配置后才开始监听
+	ready := time.Now().Add(loadBenchReadyWait)
+	for {
+		if conn, err := net.DialTimeout("tcp", listen, time.Second); err == nil {
+			conn.Close()
+			return b, nil
+		}
+		select {
+		case <-b.exited:
+		default:
+			if time.Now().Before(ready) {
+				time.Sleep(50 * time.Millisecond)
+				continue
+			}
+			b.stop()
+		}
+		output, _ := os.ReadFile(logPath)
+		if len(output) > 2048 {
+			output = output[len(output)-2048:]
+		}
+		return nil, fmt.Errorf("被测代理未能启动:\n%s", output)
+	}
+}
+
+// stop 结束被测进程并返回它消耗的 CPU 时间
+func (b *loadBackend) stop() time.Duration {
+	if !b.stopped {
+		b.stopped = true
+		b.cmd.Process.Kill()
+		<-b.exited
+	}
+	if b.cmd.ProcessState == nil {
+		return 0
+	}
+	return b.cmd.ProcessState.UserTime() + b.cmd.ProcessState.SystemTime()
+}
+
+// processRSS 读取进程当前与峰值常驻内存（KB），仅 Linux 可用，其他平台返回 0
+func processRSS(pid int) (rss, peak int64) {
+	data, err := os.ReadFile(fmt.Sprintf("/proc/%d/status", pid))
+	if err != nil {
+		return 0, 0
+	}
+	for _, line := range strings.Split(string(data), "\n") {
+		fields := strings.Fields(line)
+		if len(fields) < 2 {
+			continue
+		}
+		switch fields[0] {
+		case "VmRSS:":
+			rss, _ = strconv.ParseInt(fields[1], 10, 64)
+		case "VmHWM:":
+			peak, _ = strconv.ParseInt(fields[1], 10, 64)
+		}
+	}
+	return rss, peak
+}
+
+// compareLoadBaseline 与 -load-baseline 中同平台的基线比较；指定 -load-update 时写入当前结果，没有基线时失败
+func compareLoadBaseline(t *testing.T, report *loadReport) error {
+	baselines := make(map[string]*loadReport)
+	if data, err := os.ReadFile(*loadBaselineFile); err == nil {
+		if err := json.Unmarshal(data, &baselines); err != nil {
+			return fmt.Errorf("解析基线失败: %w", err)
+		}
+	} else if !os.IsNotExist(err) {
+		return err
+	}
+
+	if *loadUpdateBaseline {
+		baselines[report.Platform] = report
+		data, err := json.MarshalIndent(baselines, "", "  ")
+		if err != nil {
+			return err
+		}
+		if err := os.WriteFile(*loadBaselineFile, append(data, '\n'), 0644); err != nil {
+			return err
+		}
+		t.Logf("已写入基线: %s", *loadBaselineFile)
+		return nil
+	}
+	base := baselines[report.Platform]
+	if base == nil {
+		return fmt.Errorf("没有 %s 的本地基线 %s，先加 -load-update 运行一次生成", report.Platform, *loadBaselineFile)
+	}
+	if base.Clients != report.Clients || base.DurationMs != report.DurationMs {
+		return fmt.Errorf("基线的并发数或时长不同 (%d, %dms)，用相同参数运行或加 -load-update 重新生成", base.Clients, base.DurationMs)
+	}
+
+	var regressions []string
+	for name, cur := range report.Results {
+		b := base.Results[name]
+		if b == nil {
+			continue
+		}
+		if cur.ConnsPerSec*loadBenchTolerance < b.ConnsPerSec {
+			regressions = append(regressions, fmt.Sprintf("%s: %.0f 连接/秒 (基线 %.0f)", name, cur.ConnsPerSec, b.ConnsPerSec))
+		}
+		if b.P99Ms > 0 && cur.P99Ms > b.P99Ms*loadBenchTolerance+loadBenchSlackMs {
+			regressions = append(regressions, fmt.Sprintf("%s: p99 %.1fms (基线 %.1fms)", name, cur.P99Ms, b.P99Ms))
+		}
+		if cur.MBPerSec*loadBenchTolerance < b.MBPerSec {
+			regressions = append(regressions, fmt.Sprintf("%s: %.1f MB/s (基线 %.1f MB/s)", name, cur.MBPerSec, b.MBPerSec))
+		}
+	}
+	if base.PeakRSSKB > 0 && float64(report.PeakRSSKB) > float64(base.PeakRSSKB)*loadBenchTolerance {
+		regressions = append(regressions, fmt.Sprintf("peak_rss: %d KB (基线 %d KB)", report.PeakRSSKB, base.PeakRSSKB))
+	}
+	if len(regressions) > 0 {
+		sort.Strings(regressions)
+		return fmt.Errorf("性能退化:\n  %s", strings.Join(regressions, "\n  "))
+	}
+	t.Logf("未超出基线")
+	return nil
+}
+
+// loadWorker 模拟 Worker：wss（带 ECH）按 _worker.js 的协议转发隧道，另用明文 HTTP 提供 DoH
+type loadWorker struct {
+	addr     string
+	dohURL   string
+	certFile string
+	upgrader websocket.Upgrader
+	srv      *http.Server
+	doh      *http.Server
+}
+
+func startLoadWorker(dir string) (*loadWorker, error) {
+	certPEM, cert, err := newBenchCertificate(loadBenchHost)
+	if err != nil {
+		return nil, err
+	}
+	echConfig, echKey, err := newBenchECHKey(loadBenchHost)
+	if err != nil {
+		return nil, err
+	}
+	tlsCfg := &tls.Config{MinVersion: tls.VersionTLS13, Certificates: []tls.Certificate{cert}}
+	if err := setECHServerKey(tlsCfg, echConfig, echKey); err != nil {
+		return nil, err
+	}
+
+	lw := &loadWorker{
+		certFile: filepath.Join(dir, "ca.pem"),
+		upgrader: websocket.Upgrader{ReadBufferSize: relayBufSize, WriteBufferSize: relayBufSize},
+	}
+	if err := os.WriteFile(lw.certFile, certPEM, 0600); err != nil {
+		return nil, err
+	}
+
+	ln, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		return nil, err
+	}
+	lw.addr = ln.Addr().String()
+	lw.srv = &http.Server{Handler: http.HandlerFunc(lw.serveTunnel)}
+	go lw.srv.Serve(tls.NewListener(ln, tlsCfg))
+
+	dohLn, err := net.Listen("tcp", "127.0.0.1:0")
+	if err != nil {
+		lw.srv.Close()
+		return nil, err
+	}
+	lw.dohURL = "http://" + dohLn.Addr().String() + "/dns-query"
+	echConfigList := append([]byte{byte(len(echConfig) >> 8), byte(len(echConfig))}, echConfig...)
+	lw.doh = &http.Server{Handler: http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		query, err := base64.RawURLEncoding.DecodeString(r.URL.Query().Get("dns"))
+		if err != nil || len(query) < 12 {
+			http.Error(w, "bad query", http.StatusBadRequest)
+			return
+		}
+		w.Header().Set("Content-Type", "application/dns-message")
+		w.Write(benchHTTPSResponse(query, echConfigList))
+	})}
+	go lw.doh.Serve(dohLn)
+	return lw, nil
+}
+
+func (lw *loadWorker) Close() {
+	lw.srv.Close()
+	lw.doh.Close()
+}
+
+// serveTunnel 处理一条隧道：支持文本 CONNECT 与 bin1 二进制握手，之后双向转发，"CLOSE" 结束
+func (lw *loadWorker) serveTunnel(w http.ResponseWriter, r *http.Request) {
+	header := http.Header{}
+	if r.Header.Get(protoHeader) == protoBinaryV1 {
+		header.Set(protoHeader, protoBinaryV1)
+	}
+	ws, err := lw.upgrader.Upgrade(w, r, header)
+	if err != nil {
+		return
+	}
+	defer ws.Close()
+
+	mt, msg, err := ws.ReadMessage()
+	if err != nil {
+		return
+	}
+	target, earlyData, err := parseLoadConnect(mt, msg)
+	if err != nil {
+		ws.WriteMessage(websocket.TextMessage, []byte("ERROR:"+err.Error()))
+		return
+	}
+	remote, err := net.DialTimeout("tcp", target, 10*time.Second)
+	if err != nil {
+		ws.WriteMessage(websocket.TextMessage, []byte("ERROR:"+err.Error()))
+		return
+	}
+	defer remote.Close()
+	if len(earlyData) > 0 {
+		if _, err := remote.Write(earlyData); err != nil {
+			return
+		}
+	}
+	if err := ws.WriteMessage(websocket.TextMessage, []byte("CONNECTED")); err != nil {
+		return
+	}
+
+	// CONNECTED 之后只有这个协程写 WebSocket
+	go func() {
+		buf := make([]byte, relayBufSize)
+		for {
+			n, err := remote.Read(buf)
+			if n > 0 {
+				if ws.WriteMessage(websocket.BinaryMessage, buf[:n]) != nil {
+					return
+				}
+			}
+			if err != nil {
+				ws.WriteMessage(websocket.TextMessage, []byte("CLOSE"))
+				return
+			}
+		}
+	}()
+	for {
+		mt, reader, err := ws.NextReader()
+		if err != nil || mt == websocket.TextMessage {
+			return
+		}
+		if _, err := io.Copy(remote, reader); err != nil {
+			return
+		}
+	}
+}
+
+// parseLoadConnect 解析文本 CONNECT 帧或二进制握手帧（见 appendBinaryConnect），返回目标地址与首帧数据
+func parseLoadConnect(mt int, msg []byte) (string, []byte, error) {
+	if mt == websocket.TextMessage {
+		text := string(msg)
+		if !strings.HasPrefix(text, "CONNECT:") {
+			return "", nil, errors.New("意外的消息")
+		}
+		target, earlyData, _ := strings.Cut(text[len("CONNECT:"):], "|")
+		return target, []byte(earlyData), nil
+	}
+
+	if len(msg) < 5 || msg[0] != handshakeMagic || msg[1] != handshakeVersion {
+		return "", nil, errors.New("无效的握手帧")
+	}
+	var host string
+	offset := 4
+	switch msg[3] {
+	case 0x01, 0x04:
+		size := net.IPv4len
+		if msg[3] == 0x04 {
+			size = net.IPv6len
+		}
+		if len(msg) < offset+size {
+			return "", nil, errors.New("握手帧过短")
+		}
+		host = net.IP(msg[offset : offset+size]).String()
+		offset += size
+	case 0x03:
+		size := int(msg[offset])
+		offset++
+		if len(msg) < offset+size {
+			return "", nil, errors.New("握手帧过短")
+		}
+		host = string(msg[offset : offset+size])
+		offset += size
+	default:
+		return "", nil, fmt.Errorf("未知的地址类型: %d", msg[3])
+	}
+	if len(msg) < offset+2 {
+		return "", nil, errors.New("握手帧过短")
+	}
+	port := binary.BigEndian.Uint16(msg[offset : offset+2])
+	return net.JoinHostPort(host, strconv.Itoa(int(port))), msg[offset+2:], nil
+}
+
+// benchHTTPSResponse 构造只含一条 HTTPS 记录（仅 ech 参数）的 DNS 应答，问题部分照抄查询
+func benchHTTPSResponse(query, echConfigList []byte) []byte {
+	resp := append([]byte(nil), query...)
+	resp[2], resp[3] = 0x81, 0x80 // QR RD RA
+	resp[6], resp[7] = 0x00, 0x01 // ANCOUNT
+	copy(resp[8:12], []byte{0, 0, 0, 0})
+
+	rdata := []byte{0x00, 0x01, 0x00} // SvcPriority 1，TargetName "."
+	rdata = append(rdata, 0x00, 0x05, byte(len(echConfigList)>>8), byte(len(echConfigList)))
+	rdata = append(rdata, echConfigList...)
+	resp = append(resp, 0xC0, 0x0C, 0x00, typeHTTPS, 0x00, 0x01, 0x00, 0x00, 0x01, 0x2C)
+	resp = append(resp, byte(len(rdata)>>8), byte(len(rdata)))
+	return append(resp, rdata...)
+}
+
+// loadBenchHost TLS 基准测试和负载测试中自签名证书与 ECH 配置使用的主机名
+const loadBenchHost = "bench.ech-wk.test"
+
+// newBenchCertificate 生成自签名证书，同时作为被测代理信任的根证书
+func newBenchCertificate(host string) ([]byte, tls.Certificate, error) {
+	key, err := ecdsa.GenerateKey(elliptic.P256(), rand.Reader)
+	if err != nil {
+		return nil, tls.Certificate{}, err
+	}
+	tmpl := &x509.Certificate{
+		SerialNumber:          big.NewInt(time.Now().UnixNano()),
+		Subject:               pkix.Name{CommonName: host},
+		DNSNames:              []string{host},
+		NotBefore:             time.Now().Add(-time.Hour),
+		NotAfter:              time.Now().Add(24 * time.Hour),
+		IsCA:                  true,
+		BasicConstraintsValid: true,
+		KeyUsage:              x509.KeyUsageDigitalSignature | x509.KeyUsageCertSign,
+		ExtKeyUsage:           []x509.ExtKeyUsage{x509.ExtKeyUsageServerAuth},
+	}
+	der, err := x509.CreateCertificate(rand.Reader, tmpl, tmpl, &key.PublicKey, key)
+	if err != nil {
+		return nil, tls.Certificate{}, err
+	}
+	certPEM := pem.EncodeToMemory(&pem.Block{Type: "CERTIFICATE", Bytes: der})
+	return certPEM, tls.Certificate{Certificate: [][]byte{der}, PrivateKey: key}, nil
+}
+
+// newBenchECHKey 生成 DHKEM(X25519, HKDF-SHA256) + AES-128-GCM 的 ECHConfig（版本 0xfe0d）及其私钥
+func newBenchECHKey(publicName string) (config, privateKey []byte, err error) {
+	key, err := ecdh.X25519().GenerateKey(rand.Reader)
+	if err != nil {
+		return nil, nil, err
+	}
+	pub := key.PublicKey().Bytes()
+
+	contents := []byte{0x00, 0x00, 0x20} // config_id, kem_id
+	contents = append(contents, byte(len(pub)>>8), byte(len(pub)))
+	contents = append(contents, pub...)
+	contents = append(contents, 0x00, 0x04, 0x00, 0x01, 0x00, 0x01) // HKDF-SHA256, AES-128-GCM
+	contents = append(contents, 0x00, byte(len(publicName)))        // maximum_name_length, public_name
+	contents = append(contents, publicName...)
+	contents = append(contents, 0x00, 0x00) // extensions
+
+	config = append([]byte{0xfe, 0x0d, byte(len(contents) >> 8), byte(len(contents))}, contents...)
+	return config, key.Bytes(), nil
+}
+
+// setECHServerKey 使用反射设置服务端 ECH 密钥（tls.Config.EncryptedClientHelloKeys 需要 Go 1.24+）
+func setECHServerKey(config *tls.Config, echConfig, privateKey []byte) error {
+	field := reflect.ValueOf(config).Elem().FieldByName("EncryptedClientHelloKeys")
+	if !field.IsValid() || !field.CanSet() {
+		return errors.New("EncryptedClientHelloKeys 字段不可用，负载测试的模拟 Worker 需要 Go 1.24+ 版本")
+	}
+	key := reflect.New(field.Type().Elem()).Elem()
+	key.FieldByName("Config").SetBytes(echConfig)
+	key.FieldByName("PrivateKey").SetBytes(privateKey)
+	key.FieldByName("SendAsRetry").SetBool(true)
+	field.Set(reflect.Append(reflect.MakeSlice(field.Type(), 0, 1), key))
+	return nil
+}
@@ -5,17 +5,25 @@ ECH Workers 客户端 - 跨平台版本 (Python + PyQt5)
 支持 Windows 和 macOS
 """
 
+import time
+
+# 启动计时起点，供 -bench-startup 测量导入耗时和托盘就绪耗时
+_STARTUP_T0 = time.perf_counter()
+
 import sys
 import json
 import os
-import subprocess
-import threading
-import urllib.request
-import ipaddress
+import bisect
 from pathlib import Path
 
+# 网络、分流、守护进程相关模块（urllib、ipaddress、subprocess、socket 等）在用到时才导入，
+# 托盘启动路径上只加载 Qt 和上面几个基础模块
+
+# -daemon / -ctl / -bench-startup 为无界面模式，不加载 Qt，也不隐藏控制台
+HEADLESS = any(arg in ('-daemon', '-ctl', '-bench-startup') for arg in sys.argv[1:])
+
 # Windows 特殊处理
-if sys.platform == 'win32':
+if sys.platform == 'win32' and not HEADLESS:
     # 隐藏控制台窗口
     try:
         from ctypes import windll
@@ -36,32 +44,37 @@ if sys.platform == 'win32':
         except:
             pass
 
-# 检查 PyQt5
-try:
-    from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                                  QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                                  QComboBox, QTextEdit, QCheckBox, QGroupBox, 
-                                  QMessageBox, QInputDialog, QSystemTrayIcon, QMenu, QAction)
-    from PyQt5.QtCore import Qt, QThread, pyqtSignal
-    from PyQt5.QtGui import QIcon
-    HAS_PYQT = True
-    
-    # 高 DPI 支持 - 必须在创建 QApplication 之前设置
-    if hasattr(Qt, 'AA_EnableHighDpiScaling'):
-        QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
-    if hasattr(Qt, 'AA_UseHighDpiPixmaps'):
-        QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
-except ImportError:
-    HAS_PYQT = False
-    print("错误: 未安装 PyQt5")
-    print("安装命令: pip3 install PyQt5")
-    sys.exit(1)
-
 APP_VERSION = "1.2"
 APP_TITLE = f"ECH WK 客户端 v{APP_VERSION}"
 
 # 中国IP列表URL
 CHINA_IP_LIST_URL = "https://raw.githubusercontent.com/mayaxcn/china-ip-list/master/chn_ip.txt"
+# 提供给代理进程做进程内分流的IP列表文件（位于配置目录）
+CHINA_IP_FILE_NAME = "chn_ip.txt"
+# 代理进程的缓存文件：ECH 配置（下次启动无需等待 DoH 查询）和 TLS 会话票据（重启后仍可复用会话）
+ECH_CACHE_FILE_NAME = "ech_cache.json"
+TLS_CACHE_FILE_NAME = "tls_sessions.json"
+# 代理进程 -conf 读取的可热加载配置；运行中修改后重写该文件并通知进程重新加载，无需重启
+SETTINGS_FILE_NAME = "proxy_settings.json"
+# 可热加载的服务器字段，其余字段（监听地址、连接限制、指标地址）修改后需重新启动
+RELOADABLE_KEYS = ('name', 'server', 'token', 'ip', 'dns', 'ech', 'routing_mode', 'policy')
+# 策略规则的保留目标：DIRECT 直连，PROXY 当前服务器；同名服务器不能作为规则目标
+POLICY_RESERVED = ('DIRECT', 'PROXY')
+
+# 配置文件格式版本，变更格式时递增并在 CONFIG_MIGRATIONS 中添加迁移
+CONFIG_VERSION = 1
+# 连续多次保存在该延迟内合并为一次写盘（秒）
+CONFIG_SAVE_DELAY = 0.5
+# 新服务器的默认字段
+DEFAULT_SERVER = {
+    'server': 'example.com:443',
+    'listen': '127.0.0.1:30000',
+    'token': '',
+    'ip': 'saas.sin.fan',
+    'dns': 'dns.alidns.com/dns-query',
+    'ech': 'cloudflare-ech.com',
+    'routing_mode': 'bypass_cn'  # 默认跳过中国大陆
+}
 
 # 复用原有的 ConfigManager, ProcessManager, AutoStartManager
 # 从原文件导入这些类（简化版本）
@@ -84,123 +97,509 @@ class ConfigManager:
         self.config_dir.mkdir(parents=True, exist_ok=True)
         self.servers = []
         self.current_server_id = None
+        self.policy_rules = []  # 策略路由规则行，见 parse_policy_rules
+        self.version = CONFIG_VERSION
+        self._index = {}  # 服务器 id -> 在 servers 中的位置
+        self._order = []  # 按名称排序的 (名称, id)，即下拉框中的显示顺序
+        self._names = {}  # 名称 -> id
+        self._addresses = {}  # 规范化的服务地址 -> id，导入订阅时去重
+        self._save_timer = None
+        self._save_lock = None
+        self._pending_save = None  # 尚未写出的配置快照（JSON 文本）
         
     def load_config(self):
-        """加载配置"""
+        """加载配置（先写出尚未落盘的修改）"""
+        self.flush()
+        self.servers = []
+        self.current_server_id = None
         if self.config_file.exists():
             try:
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    self.servers = data.get('servers', [])
-                    self.current_server_id = data.get('current_server_id')
+                data = migrate_config(data)
+                self.version = data['version']
+                self.servers = data.get('servers', [])
+                self.current_server_id = data.get('current_server_id')
+                self.policy_rules = [line for line in data.get('policy_rules', []) if isinstance(line, str)]
             except Exception as e:
-                print(f"加载配置失败: {e}")
+                # 损坏的配置另存一份，避免被默认配置覆盖后无法恢复
+                broken = self.config_file.with_name(f"config.broken-{int(time.time())}.json")
+                print(f"加载配置失败: {e}，原文件已另存为 {broken.name}")
+                try:
+                    os.replace(self.config_file, broken)
+                except OSError:
+                    pass
                 self.servers = []
                 self.current_server_id = None
+                self.policy_rules = []
+        self._reindex()
         
         if not self.servers:
             self.add_default_server()
     
     def save_config(self):
-        """保存配置"""
+        """保存配置：合并短时间内的多次保存，延迟后一次性写出。
+        
+        配置在调用线程中序列化，定时器线程只写出最近一次的快照，不会读到修改到一半的配置
+        """
+        import threading
+        if self._save_lock is None:
+            self._save_lock = threading.Lock()
+            import atexit
+            atexit.register(self.flush)
+        text = json.dumps({
+            'version': self.version,
+            'servers': self.servers,
+            'current_server_id': self.current_server_id,
+            'policy_rules': self.policy_rules
+        }, indent=2, ensure_ascii=False)
+        with self._save_lock:
+            self._pending_save = text
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(CONFIG_SAVE_DELAY, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+    
+    def flush(self):
+        """立即写出尚未落盘的修改；写入失败时保留快照，下次保存或退出时重试"""
+        if self._save_lock is None:
+            return
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if self._pending_save is None:
+                return
+            text, self._pending_save = self._pending_save, None
+            if not self._write_config(text):
+                self._pending_save = text
+    
+    def _write_config(self, text):
+        """先写临时文件再原子替换，写入中途崩溃不会损坏原配置；返回是否成功"""
+        tmp_file = self.config_file.with_suffix('.tmp')
         try:
-            data = {
-                'servers': self.servers,
-                'current_server_id': self.current_server_id
-            }
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.config_file)
+            return True
         except Exception as e:
             print(f"保存配置失败: {e}")
+            return False
+    
+    def _reindex(self):
+        self._index = {server['id']: i for i, server in enumerate(self.servers)}
+        self._order = sorted((server.get('name', ''), server['id']) for server in self.servers)
+        self._names = {server.get('name', ''): server['id'] for server in self.servers}
+        self._addresses = {}
+        for server in self.servers:
+            key = normalize_server_address(server.get('server', ''))
+            if key:
+                self._addresses.setdefault(key, server['id'])
+    
+    def _index_server(self, server):
+        bisect.insort(self._order, (server.get('name', ''), server['id']))
+        self._names[server.get('name', '')] = server['id']
+        key = normalize_server_address(server.get('server', ''))
+        if key:
+            self._addresses.setdefault(key, server['id'])
+    
+    def _unindex_server(self, server):
+        entry = (server.get('name', ''), server['id'])
+        i = bisect.bisect_left(self._order, entry)
+        if i < len(self._order) and self._order[i] == entry:
+            del self._order[i]
+        if self._names.get(server.get('name', '')) == server['id']:
+            del self._names[server.get('name', '')]
+        key = normalize_server_address(server.get('server', ''))
+        if self._addresses.get(key) == server['id']:
+            del self._addresses[key]
+    
+    def sorted_ids(self):
+        """按名称排序的服务器 id 列表"""
+        return [server_id for _, server_id in self._order]
+    
+    def sorted_position(self, server_id):
+        """服务器在排序列表中的位置，不存在返回 -1"""
+        server = self.get_server(server_id)
+        if server is None:
+            return -1
+        return bisect.bisect_left(self._order, (server.get('name', ''), server_id))
+    
+    def insert_position(self, name, server_id):
+        """名称为 name 的服务器在排序列表中的位置（不计该服务器当前所在位置）"""
+        i = bisect.bisect_left(self._order, (name, server_id))
+        current = self.sorted_position(server_id)
+        return i - 1 if 0 <= current < i else i
+    
+    def name_exists(self, name, exclude_id=None):
+        """名称是否已被其他服务器使用"""
+        server_id = self._names.get(name)
+        return server_id is not None and server_id != exclude_id
+    
+    def find_by_address(self, address):
+        """按服务地址查找服务器（忽略大小写、默认端口和默认路径的差异）"""
+        server_id = self._addresses.get(normalize_server_address(address))
+        return self.get_server(server_id) if server_id else None
     
     def add_default_server(self):
         """添加默认服务器"""
         import uuid
-        default_server = {
-            'id': str(uuid.uuid4()),
-            'name': '默认服务器',
-            'server': 'example.com:443',
-            'listen': '127.0.0.1:30000',
-            'token': '',
-            'ip': 'saas.sin.fan',
-            'dns': 'dns.alidns.com/dns-query',
-            'ech': 'cloudflare-ech.com',
-            'routing_mode': 'bypass_cn'  # 默认跳过中国大陆
-        }
-        self.servers.append(default_server)
-        self.current_server_id = default_server['id']
+        default_server = dict(DEFAULT_SERVER, id=str(uuid.uuid4()), name='默认服务器')
+        self.add_server(default_server)
         self.save_config()
     
+    def get_server(self, server_id):
+        """按 id 获取服务器配置"""
+        i = self._index.get(server_id)
+        return self.servers[i] if i is not None else None
+    
     def get_current_server(self):
         """获取当前服务器配置"""
-        if self.current_server_id:
-            for server in self.servers:
-                if server['id'] == self.current_server_id:
-                    return server
+        server = self.get_server(self.current_server_id)
+        if server:
+            return server
         return self.servers[0] if self.servers else None
     
     def update_server(self, server_data):
         """更新服务器配置"""
-        for i, server in enumerate(self.servers):
-            if server['id'] == server_data['id']:
-                self.servers[i] = server_data
-                break
+        i = self._index.get(server_data['id'])
+        if i is not None:
+            self._unindex_server(self.servers[i])
+            self.servers[i] = server_data
+            self._index_server(server_data)
     
-    def add_server(self, server_data):
-        """添加服务器"""
+    def _append_server(self, server_data):
         import uuid
         if 'id' not in server_data:
             server_data['id'] = str(uuid.uuid4())
+        self._index[server_data['id']] = len(self.servers)
         self.servers.append(server_data)
+        self._index_server(server_data)
+    
+    def add_server(self, server_data):
+        """添加服务器"""
+        self._append_server(server_data)
         self.current_server_id = server_data['id']
     
+    def import_servers(self, entries, defaults=None):
+        """批量导入服务器，按服务地址去重，名称冲突时追加序号；返回 (新增列表, 跳过数)"""
+        added, skipped = [], 0
+        for entry in entries:
+            if self.find_by_address(entry.get('server', '')):
+                skipped += 1
+                continue
+            server = dict(defaults or DEFAULT_SERVER, **entry)
+            name, n = server.get('name') or server['server'], 2
+            server['name'] = name
+            while self.name_exists(server['name']):
+                server['name'] = f"{name} ({n})"
+                n += 1
+            server.pop('id', None)
+            self._append_server(server)
+            added.append(server)
+        return added, skipped
+    
     def delete_server(self, server_id):
         """删除服务器"""
-        self.servers = [s for s in self.servers if s['id'] != server_id]
+        server = self.get_server(server_id)
+        if server is None:
+            return
+        self._unindex_server(server)
+        i = self._index.pop(server_id)
+        del self.servers[i]
+        for j in range(i, len(self.servers)):
+            self._index[self.servers[j]['id']] = j
         if self.current_server_id == server_id:
             self.current_server_id = self.servers[0]['id'] if self.servers else None
+    
+    def rename_policy_target(self, old_name, new_name):
+        """服务器改名后同步更新引用它的策略规则"""
+        rules = []
+        for line in self.policy_rules:
+            kind, sep, target = line.rpartition(',')
+            if sep and target.strip() == old_name:
+                line = f"{kind},{new_name}"
+            rules.append(line)
+        self.policy_rules = rules
+    
+    def policy_targets(self):
+        """策略规则引用的目标名称"""
+        return {target for _, _, target in parse_policy_rules(self.policy_rules)[0]}
+    
+    def with_policy(self, server):
+        """附带策略路由参数的服务器配置，用于启动或热加载代理进程"""
+        return dict(server, policy=self.policy_settings(server))
+    
+    def policy_settings(self, server):
+        """以 server 为默认服务端时的策略路由参数，键名与代理进程 -conf 文件一致。
+        
+        引用当前服务器的规则改写为 PROXY；引用已删除或未填地址的服务器的规则被跳过
+        """
+        upstreams = {}
+        for other in self.servers:
+            name = other.get('name', '')
+            if other['id'] == server.get('id') or not (name and other.get('server')) or name in POLICY_RESERVED:
+                continue
+            upstreams[name] = {key: other.get(key, '') for key in ('name', 'server', 'token', 'ip')}
+        rules, used = [], set()
+        for kind, value, target in parse_policy_rules(self.policy_rules)[0]:
+            if target == server.get('name'):
+                target = 'PROXY'
+            elif target not in POLICY_RESERVED and target not in upstreams:
+                continue
+            used.add(target)
+            rules.append(f"{kind},{value},{target}")
+        return {
+            'name': server.get('name', ''),
+            # 只下发规则引用到的服务端，其余服务器地址有误也不影响代理进程加载配置
+            'upstreams': [c for name, c in upstreams.items() if name in used],
+            'rules': rules,
+        }
 
 
-class ProcessThread(QThread):
-    """进程线程"""
-    log_output = pyqtSignal(str)
-    process_finished = pyqtSignal()
+def _migrate_v0(data):
+    """v0 -> v1：丢弃无效条目，补全缺失或重复的 id 和名称"""
+    import uuid
+    servers, seen = [], set()
+    for server in data.get('servers', []):
+        if not isinstance(server, dict):
+            continue
+        if not server.get('id') or server['id'] in seen:
+            server['id'] = str(uuid.uuid4())
+        server.setdefault('name', server.get('server') or '未命名服务器')
+        seen.add(server['id'])
+        servers.append(server)
+    data['servers'] = servers
+    return data
+
+
+# 配置迁移：键为源版本，函数把该版本的数据升级到下一版本
+CONFIG_MIGRATIONS = {
+    0: _migrate_v0,
+}
+
+
+def migrate_config(data):
+    """把任意旧版本的配置逐级升级到 CONFIG_VERSION；更新版本写出的配置原样保留"""
+    if not isinstance(data, dict) or not isinstance(data.get('servers', []), list):
+        raise ValueError("配置格式无效")
+    version = data.get('version', 0)
+    while version < CONFIG_VERSION:
+        data = CONFIG_MIGRATIONS[version](data)
+        version += 1
+    data['version'] = version
+    return data
+
+
+def normalize_server_address(address):
+    """规范化服务地址 host:port/path，用于去重比较"""
+    from urllib.parse import urlsplit
+    address = address.strip()
+    if not address:
+        return ''
+    try:
+        parts = urlsplit(address if '://' in address else '//' + address)
+        host, port = (parts.hostname or '').lower(), parts.port or 443
+    except ValueError:
+        return address.lower()
+    if not host:
+        return ''
+    return f"{host}:{port}{parts.path.rstrip('/') or '/'}"
+
+
+def parse_subscription(text):
+    """解析订阅内容，返回服务器条目列表。
     
-    def __init__(self, config):
-        super().__init__()
+    整体可以是 base64 编码；每行一个 Worker 地址：
+    [wss://]host[:port][/path][?token=令牌&ip=优选IP][#名称]
+    """
+    import base64
+    from urllib.parse import urlsplit, parse_qs, unquote
+    
+    text = text.strip()
+    if text and '://' not in text and '\n' not in text and '.' not in text:
+        try:
+            text = base64.b64decode(text + '=' * (-len(text) % 4)).decode('utf-8')
+        except ValueError:
+            pass
+    
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            parts = urlsplit(line if '://' in line else '//' + line)
+            host, port = parts.hostname, parts.port or 443
+        except ValueError:
+            continue
+        if not host or parts.scheme not in ('', 'ws', 'wss', 'http', 'https'):
+            continue
+        if ':' in host:
+            host = f"[{host}]"
+        entry = {
+            'server': f"{host}:{port}{parts.path if parts.path not in ('', '/') else ''}",
+            'name': unquote(parts.fragment) if parts.fragment else host,
+        }
+        query = parse_qs(parts.query)
+        for key in ('token', 'ip'):
+            if query.get(key):
+                entry[key] = query[key][0]
+        entries.append(entry)
+    return entries
+
+
+def parse_policy_rules(lines):
+    """解析策略路由规则，返回 ([(类型, 值, 目标), ...], [错误说明, ...])。
+    
+    每行 "类型,值,目标"：类型为 DOMAIN-SUFFIX 或 IP-CIDR（IPv4），目标为服务器名称、
+    DIRECT（直连）或 PROXY（当前服务器）；空行和 # 开头的行忽略
+    """
+    import ipaddress
+    rules, errors = [], []
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = [part.strip() for part in line.split(',')]
+        if len(parts) != 3 or not all(parts):
+            errors.append(f"第 {n} 行格式应为 \"类型,值,目标\": {line}")
+            continue
+        kind, value, target = parts[0].upper(), parts[1].lower().rstrip('.'), parts[2]
+        if kind == 'DOMAIN-SUFFIX':
+            value = value.lstrip('.')
+        elif kind == 'IP-CIDR':
+            try:
+                ipaddress.IPv4Network(value, strict=False)
+            except ValueError:
+                errors.append(f"第 {n} 行不是有效的 IPv4 CIDR: {line}")
+                continue
+        else:
+            errors.append(f"第 {n} 行类型未知（支持 DOMAIN-SUFFIX、IP-CIDR）: {line}")
+            continue
+        rules.append((kind, value, target))
+    return rules, errors
+
+
+def local_http_address(address):
+    """把监听地址转换成本机可访问的 host:port（0.0.0.0、:: 或省略主机时用 127.0.0.1）"""
+    host, _, port = address.rpartition(':')
+    if host in ('', '0.0.0.0', '::', '[::]'):
+        host = '127.0.0.1'
+    return f"{host}:{port}"
+
+
+class ProcessRunner:
+    """代理进程监管（不依赖 Qt，GUI 与无界面守护进程共用）"""
+    
+    def __init__(self, config, cn_ip_file=None, on_output=None, cache_dir=None):
         self.config = config
+        self.cn_ip_file = cn_ip_file
+        self.cache_dir = cache_dir
+        self.on_output = on_output or (lambda text: print(text, end=''))
         self.process = None
         self.is_running = False
+        self.stop_requested = False
+        import threading
+        self.reload_lock = threading.Lock()
+    
+    @property
+    def settings_file(self):
+        return Path(self.cache_dir) / SETTINGS_FILE_NAME
+    
+    def settings(self):
+        """可热加载的参数，键名与代理进程 -conf 文件一致"""
+        routing = 'bypass_cn' if self.config.get('routing_mode') == 'bypass_cn' else 'global'
+        cn_ip_list = ''
+        if routing == 'bypass_cn' and self.cn_ip_file and Path(self.cn_ip_file).exists():
+            cn_ip_list = str(self.cn_ip_file)
+        return {
+            'server': self.config.get('server', ''),
+            'token': self.config.get('token', ''),
+            'ip': self.config.get('ip', ''),
+            'dns': self.config.get('dns') or 'dns.alidns.com/dns-query',
+            'ech': self.config.get('ech') or 'cloudflare-ech.com',
+            'routing': routing,
+            'cn_ip_list': cn_ip_list,
+            **(self.config.get('policy') or {}),
+        }
+    
+    def write_settings(self):
+        """写入 -conf 文件（含令牌，仅当前用户可读），先写临时文件再替换"""
+        path = self.settings_file
+        tmp = path.with_suffix('.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.settings(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+    
+    def reload(self, config):
+        """运行中应用新的服务器配置：只替换可热加载的字段，重写 -conf 文件并通知进程重新加载。
+        已建立的连接和缓存保留；返回错误信息，成功时返回 None"""
+        with self.reload_lock:
+            if not (self.is_running and self.cache_dir):
+                return "代理进程未运行"
+            if not config.get('server'):
+                return "服务端地址为空"
+            previous = self.config
+            self.config = dict(previous, **{key: config.get(key, '') for key in RELOADABLE_KEYS})
+            # 切换服务器时 id 随之改变，GUI 据此判断运行中的是哪个服务器
+            if 'id' in config:
+                self.config['id'] = config['id']
+            try:
+                self.write_settings()
+                error = self._send_reload()
+            except OSError as e:
+                error = str(e)
+            if error:
+                self.config = previous
+                self.write_settings()
+            return error
+    
+    def _send_reload(self):
+        """有指标地址时用 POST /reload（可取回失败原因），否则发送 SIGHUP"""
+        if self.config.get('metrics'):
+            import urllib.request
+            import urllib.error
+            url = f"http://{local_http_address(self.config['metrics'])}/reload"
+            try:
+                urllib.request.urlopen(urllib.request.Request(url, method='POST'), timeout=15).close()
+            except urllib.error.HTTPError as e:
+                return e.read().decode('utf-8', errors='replace').strip() or str(e)
+            except (urllib.error.URLError, OSError) as e:
+                return f"无法连接代理进程 - {e}"
+            return None
+        import signal
+        if not hasattr(signal, 'SIGHUP'):
+            return "未配置指标地址，当前平台无法通知代理进程重新加载"
+        self.process.send_signal(signal.SIGHUP)
+        return None
     
     def run(self):
-        """运行进程"""
+        """运行进程，阻塞直到进程退出"""
         exe_path = self._find_executable()
         if not exe_path:
             script_dir = Path(__file__).parent.absolute()
-            self.log_output.emit("错误: 找不到 ech-workers 可执行文件!\n")
-            self.log_output.emit(f"请确保 ech-workers 可执行文件在以下位置之一:\n")
-            self.log_output.emit(f"  - {script_dir}/ech-workers\n")
-            self.log_output.emit(f"  - {script_dir}/ech-workers.exe\n")
-            self.log_output.emit(f"  - {Path.cwd()}/ech-workers\n")
-            self.log_output.emit(f"  - 或者在系统 PATH 中\n")
-            self.log_output.emit(f"\n注意: ech-workers 必须是编译后的可执行文件，不是源文件。\n")
-            self.process_finished.emit()
+            self.on_output("错误: 找不到 ech-workers 可执行文件!\n")
+            self.on_output(f"请确保 ech-workers 可执行文件在以下位置之一:\n")
+            self.on_output(f"  - {script_dir}/ech-workers\n")
+            self.on_output(f"  - {script_dir}/ech-workers.exe\n")
+            self.on_output(f"  - {Path.cwd()}/ech-workers\n")
+            self.on_output(f"  - 或者在系统 PATH 中\n")
+            self.on_output(f"\n注意: ech-workers 必须是编译后的可执行文件，不是源文件。\n")
             return
         
-        cmd = [exe_path]
-        if self.config.get('server'):
-            cmd.extend(['-f', self.config['server']])
-        if self.config.get('listen'):
-            cmd.extend(['-l', self.config['listen']])
-        if self.config.get('token'):
-            cmd.extend(['-token', self.config['token']])
-        if self.config.get('ip'):
-            cmd.extend(['-ip', self.config['ip']])
-        if self.config.get('dns') and self.config['dns'] != 'dns.alidns.com/dns-query':
-            cmd.extend(['-dns', self.config['dns']])
-        if self.config.get('ech') and self.config['ech'] != 'cloudflare-ech.com':
-            cmd.extend(['-ech', self.config['ech']])
+        cmd = [exe_path] + self.build_args()
+        if self.cache_dir:
+            try:
+                self.write_settings()
+            except OSError as e:
+                self.on_output(f"错误: 写入配置文件失败 - {e}\n")
+                return
         
+        import subprocess
         try:
             # Windows 上需要指定 UTF-8 编码，因为 Go 程序输出 UTF-8
             # 同时隐藏子进程的控制台窗口
@@ -216,7 +615,10 @@ class ProcessThread(QThread):
                 popen_kwargs['creationflags'] = CREATE_NO_WINDOW
             
             self.process = subprocess.Popen(cmd, **popen_kwargs)
-            self.is_running = True
+            self.is_running = not self.stop_requested
+            if self.stop_requested:
+                # 启动期间已被要求停止（守护进程中 stop 可能与启动并发）
+                self.process.terminate()
             
             # 使用 UTF-8 解码，忽略无法解码的字符
             while self.is_running:
@@ -233,17 +635,51 @@ class ProcessThread(QThread):
                     except:
                         decoded_line = str(line)
                 if decoded_line:
-                    self.log_output.emit(decoded_line)
+                    self.on_output(decoded_line)
             
             self.process.wait()
             self.is_running = False
-            self.process_finished.emit()
         except Exception as e:
-            self.log_output.emit(f"错误: 启动失败 - {str(e)}\n")
-            self.process_finished.emit()
+            self.is_running = False
+            self.on_output(f"错误: 启动失败 - {str(e)}\n")
+    
+    def build_args(self):
+        """根据服务器配置生成命令行参数"""
+        args = []
+        if self.config.get('listen'):
+            args.extend(['-l', self.config['listen']])
+        if self.cache_dir:
+            # 服务端、令牌、优选 IP、DoH、ECH 域名和分流规则写入 -conf 文件（见 settings），可热加载
+            args.extend(['-conf', str(self.settings_file)])
+            args.extend(['-ech-cache', str(Path(self.cache_dir) / ECH_CACHE_FILE_NAME)])
+            args.extend(['-tls-cache', str(Path(self.cache_dir) / TLS_CACHE_FILE_NAME)])
+        else:
+            if self.config.get('server'):
+                args.extend(['-f', self.config['server']])
+            if self.config.get('token'):
+                args.extend(['-token', self.config['token']])
+            if self.config.get('ip'):
+                args.extend(['-ip', self.config['ip']])
+            if self.config.get('dns') and self.config['dns'] != 'dns.alidns.com/dns-query':
+                args.extend(['-dns', self.config['dns']])
+            if self.config.get('ech') and self.config['ech'] != 'cloudflare-ech.com':
+                args.extend(['-ech', self.config['ech']])
+            # 进程内分流：直接连接 SOCKS5 端口的应用同样按规则直连
+            if self.config.get('routing_mode') == 'bypass_cn':
+                args.extend(['-routing', 'bypass_cn'])
+                if self.cn_ip_file and Path(self.cn_ip_file).exists():
+                    args.extend(['-cn-ip-list', str(self.cn_ip_file)])
+        if self.config.get('max_conns'):
+            args.extend(['-max-conns', str(self.config['max_conns'])])
+        if self.config.get('max_conns_per_client'):
+            args.extend(['-max-conns-per-client', str(self.config['max_conns_per_client'])])
+        if self.config.get('metrics'):
+            args.extend(['-metrics', self.config['metrics']])
+        return args
     
     def stop(self):
         """停止进程"""
+        self.stop_requested = True
         self.is_running = False
         if self.process:
             try:
@@ -325,25 +761,896 @@ class ProcessThread(QThread):
         return None
 
 
+def load_china_ip_list(cache_dir):
+    """下载并解析中国IP列表（24 小时缓存），返回 [(起始, 结束), ...]"""
+    import ipaddress
+    import urllib.request
+    try:
+        # 尝试从缓存读取
+        cache_file = Path(cache_dir) / "china_ip_list.json"
+        if cache_file.exists():
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    cached_data = json.load(f)
+                    # 检查缓存是否过期（24小时）
+                    if time.time() - cached_data.get('timestamp', 0) < 86400:
+                        return cached_data.get('ranges', [])
+            except:
+                pass
+
+        # 下载IP列表
+        with urllib.request.urlopen(CHINA_IP_LIST_URL, timeout=10) as response:
+            content = response.read().decode('utf-8')
+
+        # 解析IP范围
+        ranges = []
+        for line in content.strip().split('\n'):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            parts = line.split()
+            if len(parts) >= 2:
+                start_ip = parts[0]
+                end_ip = parts[1]
+                try:
+                    start = ipaddress.IPv4Address(start_ip)
+                    end = ipaddress.IPv4Address(end_ip)
+                    ranges.append((int(start), int(end)))
+                except:
+                    continue
+
+        # 保存到缓存
+        try:
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'timestamp': time.time(),
+                    'ranges': ranges
+                }, f)
+        except:
+            pass
+
+        return ranges
+    except Exception as e:
+        print(f"加载中国IP列表失败: {e}")
+        return None
+
+
+def write_china_ip_file(config_dir, ranges):
+    """将IP范围写成 "起始IP 结束IP" 文本，供代理进程加载"""
+    import ipaddress
+    try:
+        ip_file = Path(config_dir) / CHINA_IP_FILE_NAME
+        tmp_file = ip_file.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for start, end in ranges:
+                f.write(f"{ipaddress.IPv4Address(start)} {ipaddress.IPv4Address(end)}\n")
+        os.replace(tmp_file, ip_file)
+    except Exception as e:
+        print(f"写入中国IP列表文件失败: {e}")
+
+
+# ======================== 无界面守护进程 ========================
+
+DAEMON_SOCKET_NAME = "daemon.sock"
+# 不支持 Unix 套接字的平台（Windows）改用本机回环端口
+DAEMON_TCP_ADDR = ('127.0.0.1', 30099)
+DAEMON_LOG_LINES = 500
+DAEMON_MAX_BACKOFF = 30
+
+
+class ProxyDaemon:
+    """无界面守护进程：监管代理进程，意外退出时退避重启，命令来自本地控制接口"""
+    
+    def __init__(self, config_manager):
+        import collections
+        import threading
+        self.config_manager = config_manager
+        self.lock = threading.Lock()
+        # 控制连接各自在线程中处理；命令会重新读取并保存配置，需逐条执行。
+        # self.lock 在 start/stop 内部和监管线程中使用，不能在整条命令期间持有
+        self.command_lock = threading.Lock()
+        self.logs = collections.deque(maxlen=DAEMON_LOG_LINES)
+        self.runner = None
+        self.server = None
+        self.want_running = False
+        self.generation = 0
+        self.started_at = None
+        self.restarts = 0
+    
+    def log(self, text):
+        """记录日志（保留最近若干行供 logs 命令查询）"""
+        self.logs.append(text)
+        print(text, end='', flush=True)
+    
+    def cn_ip_file(self):
+        return self.config_manager.config_dir / CHINA_IP_FILE_NAME
+    
+    def refresh_china_ip_list(self):
+        """后台刷新中国IP列表文件，供 bypass_cn 模式的进程内分流使用"""
+        import threading
+        
+        def load_in_thread():
+            ranges = load_china_ip_list(self.config_manager.config_dir)
+            if ranges:
+                write_china_ip_file(self.config_manager.config_dir, ranges)
+                self.log(f"[守护] 已加载中国IP列表，共 {len(ranges)} 个IP段\n")
+            else:
+                self.log("[守护] 加载中国IP列表失败，使用内置规则\n")
+        
+        threading.Thread(target=load_in_thread, daemon=True).start()
+    
+    def find_server(self, key):
+        """按 id 或名称查找服务器"""
+        server = self.config_manager.get_server(key)
+        if server:
+            return server
+        for server in self.config_manager.servers:
+            if server.get('name') == key:
+                return server
+        raise ValueError(f"找不到服务器: {key}")
+    
+    def start(self, server=None):
+        """启动（或以新配置重启）代理进程"""
+        if server is None:
+            server = self.config_manager.get_current_server()
+        if not server or not server.get('server') or not server.get('listen'):
+            raise ValueError("当前服务器缺少服务地址或监听地址")
+        
+        import threading
+        self.stop()
+        with self.lock:
+            self.generation += 1
+            self.want_running = True
+            self.server = server
+            self.restarts = 0
+            generation = self.generation
+        
+        threading.Thread(target=self._supervise, args=(generation,), daemon=True).start()
+        self.log(f"[守护] 已启动服务器: {server.get('name', server['id'])}\n")
+    
+    def stop(self):
+        """停止代理进程，不再自动重启"""
+        with self.lock:
+            self.generation += 1
+            self.want_running = False
+            runner, self.runner = self.runner, None
+            self.started_at = None
+        if runner:
+            runner.stop()
+            self.log("[守护] 代理进程已停止\n")
+    
+    def reload(self):
+        """按配置文件中的最新内容热加载运行中的服务器，不重启代理进程"""
+        with self.lock:
+            runner, server = self.runner, self.server
+        if not (runner and runner.is_running):
+            raise ValueError("代理进程未运行")
+        latest = self.config_manager.get_server(server['id'])
+        if not latest:
+            raise ValueError(f"找不到服务器: {server.get('name', server['id'])}")
+        error = runner.reload(self.config_manager.with_policy(latest))
+        if error:
+            raise ValueError(f"重新加载失败，继续使用原配置: {error}")
+        with self.lock:
+            # 之后意外退出重启时也使用新配置
+            self.server = latest
+        self.log(f"[守护] 已重新加载服务器配置: {latest.get('name', latest['id'])}\n")
+    
+    def _supervise(self, generation):
+        backoff = 1
+        while True:
+            with self.lock:
+                server = self.server
+            runner = ProcessRunner(self.config_manager.with_policy(server), self.cn_ip_file(), self.log,
+                                   self.config_manager.config_dir)
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.runner = runner
+                self.started_at = time.time()
+            
+            started = time.monotonic()
+            runner.run()
+            
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.runner = None
+                self.started_at = None
+                self.restarts += 1
+            
+            # 稳定运行过一段时间后重置退避
+            if time.monotonic() - started > 60:
+                backoff = 1
+            self.log(f"[守护] 代理进程意外退出，{backoff} 秒后重启\n")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, DAEMON_MAX_BACKOFF)
+    
+    def stats(self):
+        """运行状态"""
+        with self.lock:
+            runner = self.runner
+            server = self.server
+            started_at = self.started_at
+            restarts = self.restarts
+            want_running = self.want_running
+        process = runner.process if runner else None
+        return {
+            'running': bool(runner and runner.is_running),
+            'want_running': want_running,
+            'pid': process.pid if process else None,
+            'uptime': round(time.time() - started_at, 1) if started_at else 0,
+            'restarts': restarts,
+            'server': {key: server.get(key) for key in ('id', 'name', 'server', 'listen', 'routing_mode')} if server else None,
+            'log_lines': len(self.logs),
+        }
+    
+    def handle_command(self, request):
+        """处理一条控制命令，返回 JSON 可序列化的结果"""
+        with self.command_lock:
+            return self._handle_command(request)
+    
+    def _handle_command(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'start':
+            self.config_manager.load_config()
+            server = self.find_server(request['server']) if request.get('server') else None
+            self.start(server)
+        elif cmd == 'stop':
+            self.stop()
+        elif cmd == 'reload':
+            self.config_manager.load_config()
+            self.reload()
+        elif cmd == 'switch':
+            self.config_manager.load_config()
+            server = self.find_server(request.get('server', ''))
+            self.config_manager.current_server_id = server['id']
+            self.config_manager.save_config()
+            if self.want_running:
+                self.start(server)
+        elif cmd == 'servers':
+            current = self.config_manager.get_current_server()
+            return {'ok': True, 'servers': [
+                {'id': s['id'], 'name': s.get('name'), 'server': s.get('server'),
+                 'current': current is not None and s['id'] == current['id']}
+                for s in self.config_manager.servers
+            ]}
+        elif cmd == 'logs':
+            lines = int(request.get('lines', 100))
+            return {'ok': True, 'logs': list(self.logs)[-lines:] if lines > 0 else []}
+        elif cmd != 'stats':
+            return {'ok': False, 'error': f"未知命令: {cmd}"}
+        
+        result = self.stats()
+        result['ok'] = True
+        return result
+
+
+def parse_control_address(value, config_dir):
+    """解析控制地址：host:port 为 TCP，其余视为 Unix 套接字路径"""
+    import socket
+    if value:
+        host, sep, port = value.rpartition(':')
+        if sep and port.isdigit() and '/' not in value and '\\' not in value:
+            return (host or '127.0.0.1', int(port))
+        return str(value)
+    if hasattr(socket, 'AF_UNIX'):
+        return str(config_dir / DAEMON_SOCKET_NAME)
+    return DAEMON_TCP_ADDR
+
+
+def create_control_server(address, proxy_daemon):
+    """创建控制接口；Unix 套接字仅当前用户可访问"""
+    import socketserver
+    
+    class _ControlHandler(socketserver.StreamRequestHandler):
+        """控制连接：每行一个 JSON 请求，每行返回一个 JSON 响应"""
+    
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    response = self.server.proxy_daemon.handle_command(json.loads(line.decode('utf-8')))
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+                self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+    
+    if isinstance(address, tuple):
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(address, _ControlHandler)
+    else:
+        if os.path.exists(address):
+            # 残留的套接字文件：能连上说明已有守护进程在运行
+            try:
+                send_daemon_command({'cmd': 'stats'}, address, timeout=1)
+            except OSError:
+                os.unlink(address)
+            else:
+                raise RuntimeError(f"守护进程已在运行: {address}")
+        old_umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(address, _ControlHandler)
+        finally:
+            os.umask(old_umask)
+    server.daemon_threads = True
+    server.proxy_daemon = proxy_daemon
+    return server
+
+
+def send_daemon_command(request, address, timeout=5):
+    """向守护进程发送一条命令并返回响应"""
+    import socket
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall((json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("守护进程未返回响应")
+    return json.loads(line.decode('utf-8'))
+
+
+def _arg_value(argv, name):
+    """读取 "-name value" 形式的参数"""
+    if name in argv:
+        i = argv.index(name)
+        if i + 1 < len(argv):
+            return argv[i + 1]
+    return None
+
+
+def run_daemon(argv):
+    """gui.py -daemon [-control 地址] [-idle]"""
+    config_manager = ConfigManager()
+    config_manager.load_config()
+    address = parse_control_address(_arg_value(argv, '-control'), config_manager.config_dir)
+    
+    proxy_daemon = ProxyDaemon(config_manager)
+    try:
+        server = create_control_server(address, proxy_daemon)
+    except (OSError, RuntimeError) as e:
+        print(f"错误: 无法创建控制接口 - {e}")
+        return 1
+    
+    import signal
+    import threading
+    
+    def shutdown(signum, frame):
+        # serve_forever 运行在主线程，shutdown 必须从其他线程调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, shutdown)
+    
+    proxy_daemon.log(f"[守护] 控制接口: {address}\n")
+    proxy_daemon.refresh_china_ip_list()
+    if '-idle' not in argv:
+        try:
+            proxy_daemon.start()
+        except ValueError as e:
+            proxy_daemon.log(f"[守护] 未自动启动: {e}\n")
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy_daemon.stop()
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.unlink(address)
+    return 0
+
+
+def run_control_client(argv):
+    """gui.py -ctl <stats|start|stop|reload|switch|servers|logs> [参数] [-control 地址]"""
+    i = argv.index('-ctl')
+    args = [a for a in argv[i + 1:] if a not in ('-control', _arg_value(argv, '-control'))]
+    if not args:
+        print(run_control_client.__doc__)
+        return 2
+    
+    request = {'cmd': args[0]}
+    if args[0] in ('start', 'switch') and len(args) > 1:
+        request['server'] = args[1]
+    elif args[0] == 'logs' and len(args) > 1:
+        request['lines'] = args[1]
+    
+    address = parse_control_address(_arg_value(argv, '-control'), ConfigManager().config_dir)
+    try:
+        response = send_daemon_command(request, address)
+    except OSError as e:
+        print(f"错误: 无法连接守护进程 {address} - {e}")
+        return 1
+    
+    if request['cmd'] == 'logs' and response.get('ok'):
+        print(''.join(response['logs']), end='')
+    else:
+        print(json.dumps(response, indent=2, ensure_ascii=False))
+    return 0 if response.get('ok') else 1
+
+
+# ======================== 启动耗时基准 ========================
+
+STARTUP_BENCH_ENV = "ECH_WK_BENCH_STARTUP"
+STARTUP_BENCH_MARK = "STARTUP_BENCH"
+STARTUP_BASELINE_FILE = Path(__file__).parent / "bench" / "startup_baseline.json"
+# 超过基线 × 倍数 + 余量即视为退化
+STARTUP_BENCH_TOLERANCE = 1.25
+STARTUP_BENCH_SLACK_MS = 20
+
+
+def _run_startup_probe(args):
+    """在子进程中启动一次，返回 (就绪方式, 进程内耗时ms, 含解释器启动的总耗时ms)"""
+    import subprocess
+    env = dict(os.environ, **{STARTUP_BENCH_ENV: '1'})
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, env=env, capture_output=True, text=True, timeout=60)
+    wall_ms = (time.perf_counter() - started) * 1000
+    for line in result.stdout.splitlines():
+        if line.startswith(STARTUP_BENCH_MARK):
+            _, mode, seconds = line.split()
+            return mode, float(seconds) * 1000, wall_ms
+    raise RuntimeError(f"启动探测失败: {' '.join(args)}\n{result.stdout}{result.stderr}")
+
+
+def run_startup_bench(argv):
+    """gui.py -bench-startup [-runs N] [-update-baseline]：测量导入耗时和托盘/窗口就绪耗时，并与基线比较"""
+    import statistics
+    script = str(Path(__file__).absolute())
+    runs = int(_arg_value(argv, '-runs') or 5)
+    import_probe = (
+        "import importlib.util, sys, time; t = time.perf_counter(); sys.argv = ['gui.py']; "
+        f"spec = importlib.util.spec_from_file_location('gui', {script!r}); "
+        "spec.loader.exec_module(importlib.util.module_from_spec(spec)); "
+        f"print('{STARTUP_BENCH_MARK} import', time.perf_counter() - t)"
+    )
+    probes = {
+        'import': ['-c', import_probe],
+        'autostart': [script, '-autostart'],
+        'window': [script],
+    }
+    
+    results = {}
+    for name, args in probes.items():
+        try:
+            samples = [_run_startup_probe(args) for _ in range(runs)]
+        except (RuntimeError, OSError) as e:
+            print(e)
+            return 1
+        results[name] = {
+            'ready': samples[0][0],
+            'median_ms': round(statistics.median(s[1] for s in samples), 1),
+            'max_ms': round(max(s[1] for s in samples), 1),
+            'wall_median_ms': round(statistics.median(s[2] for s in samples), 1),
+        }
+    report = {'python': sys.version.split()[0], 'platform': sys.platform, 'cpus': os.cpu_count(), 'runs': runs,
+              'results': results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    
+    baselines = {}
+    if STARTUP_BASELINE_FILE.exists():
+        with open(STARTUP_BASELINE_FILE, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+    if '-update-baseline' in argv:
+        baselines[sys.platform] = report
+        STARTUP_BASELINE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(STARTUP_BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"已写入基线: {STARTUP_BASELINE_FILE}")
+        return 0
+    
+    if sys.platform not in baselines:
+        # 没有基线时不能视为通过，也不自动写入（否则第一次运行的结果会悄悄成为基线）
+        print(f"没有 {sys.platform} 的基线: {STARTUP_BASELINE_FILE}，在参考机器上加 -update-baseline 运行以生成")
+        return 2
+    
+    regressions = []
+    for name, current in results.items():
+        base = baselines[sys.platform]['results'].get(name)
+        if base and current['median_ms'] > base['median_ms'] * STARTUP_BENCH_TOLERANCE + STARTUP_BENCH_SLACK_MS:
+            regressions.append(f"{name}: {current['median_ms']}ms (基线 {base['median_ms']}ms)")
+    if regressions:
+        print("启动耗时退化:\n  " + "\n  ".join(regressions))
+        return 1
+    print("启动耗时未超出基线")
+    return 0
+
+
+# 无界面模式在导入 Qt 之前分派，路由器/服务器上无需安装 PyQt5
+if __name__ == '__main__' and HEADLESS:
+    if '-bench-startup' in sys.argv:
+        sys.exit(run_startup_bench(sys.argv))
+    sys.exit(run_control_client(sys.argv) if '-ctl' in sys.argv else run_daemon(sys.argv))
+
+
+# 检查 PyQt5
+try:
+    from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
+                                  QHBoxLayout, QLabel, QLineEdit, QPushButton, 
+                                  QComboBox, QTextEdit, QCheckBox, QGroupBox, 
+                                  QMessageBox, QInputDialog, QSystemTrayIcon, QMenu, QAction,
+                                  QTabWidget, QTableView, QHeaderView, QStyledItemDelegate)
+    from PyQt5.QtCore import (Qt, QObject, QThread, QTimer, pyqtSignal, QAbstractListModel,
+                              QAbstractTableModel, QModelIndex, QSortFilterProxyModel, QPointF)
+    from PyQt5.QtGui import QIcon, QPainter, QPen, QPolygonF
+    HAS_PYQT = True
+    
+    # 高 DPI 支持 - 必须在创建 QApplication 之前设置
+    if hasattr(Qt, 'AA_EnableHighDpiScaling'):
+        QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
+    if hasattr(Qt, 'AA_UseHighDpiPixmaps'):
+        QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
+except ImportError:
+    HAS_PYQT = False
+    print("错误: 未安装 PyQt5")
+    print("安装命令: pip3 install PyQt5")
+    sys.exit(1)
+
+
+
+def format_bytes(value):
+    """字节数格式化为 B/KB/MB/GB"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if value < 1024 or unit == 'GB':
+            return f"{value:.0f} {unit}" if unit == 'B' else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def format_duration(seconds):
+    seconds = max(0, int(seconds))
+    hours, rest = divmod(seconds, 3600)
+    if hours:
+        return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+    return f"{rest // 60:02d}:{rest % 60:02d}"
+
+
+def pick_local_address():
+    """选一个空闲的本机端口，供未配置指标地址时的连接面板使用"""
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"127.0.0.1:{sock.getsockname()[1]}"
+
+
+class ProcessThread(QThread):
+    """进程线程（ProcessRunner 的 Qt 包装）"""
+    log_output = pyqtSignal(str)
+    process_finished = pyqtSignal()
+    
+    def __init__(self, config, cn_ip_file=None, cache_dir=None):
+        super().__init__()
+        if not config.get('metrics'):
+            # 连接面板依赖 /connections 接口；临时端口只传给本次进程，不写入配置
+            config = dict(config, metrics=pick_local_address())
+        self.runner = ProcessRunner(config, cn_ip_file, self.log_output.emit, cache_dir)
+    
+    @property
+    def is_running(self):
+        return self.runner.is_running
+    
+    @property
+    def metrics_address(self):
+        return local_http_address(self.runner.config['metrics'])
+    
+    @property
+    def server_id(self):
+        return self.runner.config.get('id')
+    
+    def reload(self, config):
+        """热加载新配置（阻塞，需在后台线程调用）"""
+        return self.runner.reload(config)
+    
+    def run(self):
+        """运行进程"""
+        self.runner.run()
+        self.process_finished.emit()
+    
+    def stop(self):
+        """停止进程"""
+        self.runner.stop()
+
+
+class ServerListModel(QAbstractListModel):
+    """服务器列表模型：数据直接取自 ConfigManager 的排序索引，增删改逐行通知视图"""
+    ServerIdRole = Qt.UserRole
+    FilterRole = Qt.UserRole + 1
+    
+    # 批量导入超过该数量时整体重置，否则逐行插入
+    RESET_THRESHOLD = 100
+    
+    def __init__(self, config_manager, parent=None):
+        super().__init__(parent)
+        self.config_manager = config_manager
+        self.ids = config_manager.sorted_ids()
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.ids)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.ids):
+            return None
+        server_id = self.ids[index.row()]
+        if role == self.ServerIdRole:
+            return server_id
+        server = self.config_manager.get_server(server_id)
+        if role == Qt.DisplayRole:
+            return server.get('name', '')
+        if role == Qt.ToolTipRole:
+            return server.get('server', '')
+        if role == self.FilterRole:
+            return f"{server.get('name', '')} {server.get('server', '')}"
+        return None
+    
+    def row_of(self, server_id):
+        return self.config_manager.sorted_position(server_id)
+    
+    def reload(self):
+        """重新加载全部数据（配置整体替换后使用）"""
+        self.beginResetModel()
+        self.ids = self.config_manager.sorted_ids()
+        self.endResetModel()
+    
+    def add_server(self, server):
+        """添加服务器并设为当前"""
+        self.config_manager.add_server(server)
+        row = self.row_of(server['id'])
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.ids.insert(row, server['id'])
+        self.endInsertRows()
+    
+    def update_server(self, server):
+        """更新服务器；名称变化时把该行移动到新位置"""
+        old_row = self.row_of(server['id'])
+        if old_row < 0:
+            return
+        new_row = self.config_manager.insert_position(server.get('name', ''), server['id'])
+        if new_row != old_row:
+            # beginMoveRows 的目标位置以移动前的行号计
+            self.beginMoveRows(QModelIndex(), old_row, old_row, QModelIndex(),
+                               new_row + 1 if new_row > old_row else new_row)
+            self.config_manager.update_server(server)
+            self.ids.insert(new_row, self.ids.pop(old_row))
+            self.endMoveRows()
+        else:
+            self.config_manager.update_server(server)
+        index = self.index(new_row)
+        self.dataChanged.emit(index, index)
+    
+    def remove_server(self, server_id):
+        row = self.row_of(server_id)
+        if row < 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.config_manager.delete_server(server_id)
+        del self.ids[row]
+        self.endRemoveRows()
+    
+    def import_servers(self, entries, defaults=None):
+        """批量导入，返回 (新增列表, 跳过数)"""
+        if len(entries) > self.RESET_THRESHOLD:
+            self.beginResetModel()
+            result = self.config_manager.import_servers(entries, defaults)
+            self.ids = self.config_manager.sorted_ids()
+            self.endResetModel()
+            return result
+        
+        added, skipped = [], 0
+        for entry in entries:
+            new, dup = self.config_manager.import_servers([entry], defaults)
+            skipped += dup
+            for server in new:
+                row = self.row_of(server['id'])
+                self.beginInsertRows(QModelIndex(), row, row)
+                self.ids.insert(row, server['id'])
+                self.endInsertRows()
+            added.extend(new)
+        return added, skipped
+
+
+def draw_sparkline(painter, rect, values, color):
+    """在 rect 内画折线，纵轴按序列最大值缩放"""
+    if len(values) < 2 or rect.width() <= 0:
+        return
+    peak = max(values) or 1
+    step = rect.width() / (len(values) - 1)
+    points = [QPointF(rect.left() + i * step, rect.bottom() - rect.height() * v / peak)
+              for i, v in enumerate(values)]
+    painter.save()
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setPen(QPen(color, 1.5))
+    painter.drawPolyline(QPolygonF(points))
+    painter.restore()
+
+
+class ConnectionTableModel(QAbstractTableModel):
+    """活动连接表：按连接 id 合并 /connections 快照，只通知增删的行和变化的列"""
+    COLUMNS = ("客户端", "目标", "模式", "路径", "时长", "上行", "下行", "上行速率", "下行速率", "趋势")
+    TREND_COLUMN = 9
+    HistoryRole = Qt.UserRole
+    
+    # 每条连接保留的速率采样数（刷新间隔 1 秒即最近 30 秒）
+    HISTORY_LEN = 30
+    MODE_NAMES = {'socks5': 'SOCKS5', 'connect': 'CONNECT', 'http': 'HTTP'}
+    PATH_NAMES = {'tunnel': '隧道', 'direct': '直连'}
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        import collections
+        self.rows = []
+        self.now = 0
+        # 总带宽（含已关闭连接）的采样，供面板顶部的折线图使用
+        self.total = None
+        self.total_history = collections.deque(maxlen=self.HISTORY_LEN * 2)
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+    
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        row, column = self.rows[index.row()], index.column()
+        if role == self.HistoryRole:
+            return row['history']
+        if role == Qt.TextAlignmentRole and 4 <= column < self.TREND_COLUMN:
+            return Qt.AlignRight | Qt.AlignVCenter
+        if role == Qt.ToolTipRole and column == 1:
+            return row['target']
+        if role != Qt.DisplayRole:
+            return None
+        if column == 0:
+            return row['client']
+        if column == 1:
+            return row['target']
+        if column == 2:
+            return self.MODE_NAMES.get(row['mode'], row['mode'])
+        if column == 3:
+            path = self.PATH_NAMES.get(row['path'], row['path'])
+            return f"{path} ({row['upstream']})" if row.get('upstream') else path
+        if column == 4:
+            return format_duration((self.now - row['start']) / 1000)
+        if column == 5:
+            return format_bytes(row['up'])
+        if column == 6:
+            return format_bytes(row['down'])
+        if column == 7:
+            return f"{format_bytes(row['up_rate'])}/s"
+        if column == 8:
+            return f"{format_bytes(row['down_rate'])}/s"
+        return None
+    
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.now = 0
+        self.total = None
+        self.total_history.clear()
+        self.endResetModel()
+    
+    def apply_snapshot(self, snapshot):
+        """合并一次快照：删除已关闭的连接，追加新连接，其余行只刷新数值列"""
+        now = snapshot.get('now', 0)
+        elapsed = (now - self.now) / 1000 if self.now else 0
+        self.now = now
+        incoming = {conn['id']: conn for conn in snapshot.get('connections', [])}
+        
+        total = (snapshot.get('up', 0), snapshot.get('down', 0))
+        if self.total is not None and elapsed > 0:
+            self.total_history.append(
+                max(0, (total[0] - self.total[0]) + (total[1] - self.total[1])) / elapsed)
+        self.total = total
+        
+        # 从后往前按连续区间删除，行号不受前面删除的影响
+        end = len(self.rows)
+        while end > 0:
+            if self.rows[end - 1]['id'] in incoming:
+                end -= 1
+                continue
+            start = end - 1
+            while start > 0 and self.rows[start - 1]['id'] not in incoming:
+                start -= 1
+            self.beginRemoveRows(QModelIndex(), start, end - 1)
+            del self.rows[start:end]
+            self.endRemoveRows()
+            end = start
+        
+        for row in self.rows:
+            conn = incoming.pop(row['id'])
+            if elapsed > 0:
+                row['up_rate'] = max(0, conn['up'] - row['up']) / elapsed
+                row['down_rate'] = max(0, conn['down'] - row['down']) / elapsed
+                row['history'].append(row['up_rate'] + row['down_rate'])
+            row['up'], row['down'] = conn['up'], conn['down']
+        if self.rows:
+            self.dataChanged.emit(self.index(0, 4),
+                                  self.index(len(self.rows) - 1, self.TREND_COLUMN))
+        
+        # 连接 id 单调递增，新连接追加在末尾即可保持按 id 排序
+        if incoming:
+            import collections
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(incoming) - 1)
+            for conn_id in sorted(incoming):
+                conn = incoming[conn_id]
+                self.rows.append(dict(conn, up_rate=0, down_rate=0,
+                                      history=collections.deque(maxlen=self.HISTORY_LEN)))
+            self.endInsertRows()
+
+
+class SparklineDelegate(QStyledItemDelegate):
+    """趋势列：画该连接最近的速率折线"""
+    
+    def paint(self, painter, option, index):
+        super().paint(painter, option, index)
+        history = index.data(ConnectionTableModel.HistoryRole)
+        if history:
+            draw_sparkline(painter, option.rect.adjusted(3, 4, -3, -4), list(history),
+                           option.palette.highlight().color())
+
+
+class SparklineWidget(QWidget):
+    """总带宽折线图"""
+    
+    def __init__(self, values, parent=None):
+        super().__init__(parent)
+        self.values = values
+        self.setMinimumHeight(60)
+    
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        draw_sparkline(painter, self.rect().adjusted(4, 6, -4, -6), list(self.values),
+                       self.palette().highlight().color())
+        painter.end()
+
+
 class MainWindow(QMainWindow):
     """主窗口"""
+    subscription_loaded = pyqtSignal(object, str)
+    connections_loaded = pyqtSignal(object)
+    reload_finished = pyqtSignal(str)
     
-    def __init__(self):
+    # 连接面板刷新间隔（毫秒）
+    CONNECTIONS_INTERVAL = 1000
+    
+    def __init__(self, launcher=None):
         super().__init__()
-        self.config_manager = ConfigManager()
-        self.config_manager.load_config()
+        # 由 TrayLauncher 延迟创建时，接管它已加载的配置、托盘图标和已启动的代理进程
+        if launcher:
+            self.config_manager = launcher.config_manager
+        else:
+            self.config_manager = ConfigManager()
+            self.config_manager.load_config()
         self.process_thread = None
-        self.is_autostart = '-autostart' in sys.argv
-        self.china_ip_ranges = None  # 缓存中国IP列表
-        self.tray_icon = None  # 系统托盘图标
+        self.loading_server_config = False  # load_server_config 填充控件期间不触发热加载
+        self.is_autostart = '-autostart' in sys.argv and not launcher
+        self.china_ip_ranges = launcher.china_ip_ranges if launcher else None  # 缓存中国IP列表
+        self.tray_icon = launcher.tray_icon if launcher else None  # 系统托盘图标
         
+        self.subscription_loaded.connect(self.on_subscription_loaded)
+        self.connections_loaded.connect(self.on_connections_loaded)
+        self.reload_finished.connect(self.on_reload_finished)
         self.init_ui()
         self.init_server_combo()  # 初始化下拉框
         self.load_server_config()
         self.init_tray_icon()  # 初始化系统托盘
         
-        # 异步加载中国IP列表
-        self.load_china_ip_list_async()
+        if launcher:
+            self.adopt_launcher(launcher)
+        else:
+            # 异步加载中国IP列表
+            self.load_china_ip_list_async()
         
         if self.is_autostart:
             self.hide()
@@ -355,21 +1662,36 @@ class MainWindow(QMainWindow):
         self.setWindowTitle(APP_TITLE)
         self.setGeometry(100, 100, 900, 750)
         
-        central_widget = QWidget()
-        self.setCentralWidget(central_widget)
-        layout = QVBoxLayout(central_widget)
+        self.tabs = QTabWidget()
+        self.setCentralWidget(self.tabs)
+        control_page = QWidget()
+        layout = QVBoxLayout(control_page)
+        self.tabs.addTab(control_page, "控制")
         
         # 服务器管理
         server_group = QGroupBox("服务器管理")
         server_layout = QHBoxLayout()
         server_layout.addWidget(QLabel("选择服务器:"))
+        self.server_model = ServerListModel(self.config_manager, self)
+        self.server_filter = QSortFilterProxyModel(self)
+        self.server_filter.setSourceModel(self.server_model)
+        self.server_filter.setFilterRole(ServerListModel.FilterRole)
+        self.server_filter.setFilterCaseSensitivity(Qt.CaseInsensitive)
         self.server_combo = QComboBox()
+        self.server_combo.setModel(self.server_filter)
+        self.server_combo.setMinimumContentsLength(16)
         self.server_combo.currentIndexChanged.connect(self.on_server_changed)
         server_layout.addWidget(self.server_combo)
+        self.server_filter_edit = QLineEdit()
+        self.server_filter_edit.setPlaceholderText("筛选名称或地址")
+        self.server_filter_edit.setClearButtonEnabled(True)
+        self.server_filter_edit.textChanged.connect(self.server_filter.setFilterFixedString)
+        server_layout.addWidget(self.server_filter_edit)
         server_layout.addWidget(QPushButton("新增", clicked=self.add_server))
         server_layout.addWidget(QPushButton("保存", clicked=self.save_server))
         server_layout.addWidget(QPushButton("重命名", clicked=self.rename_server))
         server_layout.addWidget(QPushButton("删除", clicked=self.delete_server))
+        server_layout.addWidget(QPushButton("导入订阅", clicked=self.import_subscription))
         server_group.setLayout(server_layout)
         layout.addWidget(server_group)
         
@@ -390,12 +1712,25 @@ class MainWindow(QMainWindow):
         advanced_layout.addWidget(self.create_label_edit("身份令牌:", self.token_edit))
         row1 = QHBoxLayout()
         self.ip_edit = QLineEdit()
+        self.ip_edit.setToolTip("可填写多个，用逗号分隔，连接时并行择优")
         row1.addWidget(self.create_label_edit("优选IP或域名:", self.ip_edit))
         self.dns_edit = QLineEdit()
         row1.addWidget(self.create_label_edit("DOH服务器:", self.dns_edit))
         advanced_layout.addLayout(row1)
         self.ech_edit = QLineEdit()
         advanced_layout.addWidget(self.create_label_edit("ECH域名:", self.ech_edit))
+        row2 = QHBoxLayout()
+        self.max_conns_edit = QLineEdit()
+        self.max_conns_edit.setPlaceholderText("4096")
+        row2.addWidget(self.create_label_edit("最大连接数:", self.max_conns_edit))
+        self.max_conns_per_client_edit = QLineEdit()
+        self.max_conns_per_client_edit.setPlaceholderText("不限制")
+        row2.addWidget(self.create_label_edit("单客户端连接数:", self.max_conns_per_client_edit))
+        self.metrics_edit = QLineEdit()
+        self.metrics_edit.setPlaceholderText("不启用")
+        self.metrics_edit.setToolTip("Prometheus 指标监听地址，如 127.0.0.1:9464，访问 /metrics")
+        row2.addWidget(self.create_label_edit("指标地址:", self.metrics_edit))
+        advanced_layout.addLayout(row2)
         advanced_group.setLayout(advanced_layout)
         layout.addWidget(advanced_group)
         
@@ -409,6 +1744,7 @@ class MainWindow(QMainWindow):
         self.routing_combo.addItem("不改变代理", "none")
         self.routing_combo.currentIndexChanged.connect(self.on_routing_changed)
         routing_layout.addWidget(self.routing_combo)
+        routing_layout.addWidget(QPushButton("策略规则...", clicked=self.edit_policy_rules))
         routing_layout.addStretch()
         routing_group.setLayout(routing_layout)
         layout.addWidget(routing_group)
@@ -447,28 +1783,49 @@ class MainWindow(QMainWindow):
         log_layout.addWidget(self.log_text)
         log_group.setLayout(log_layout)
         layout.addWidget(log_group)
+        
+        self.tabs.addTab(self.create_connections_page(), "连接")
+    
+    def create_connections_page(self):
+        """连接面板：总带宽折线 + 活动连接表，代理运行且面板可见时每秒刷新一次"""
+        page = QWidget()
+        layout = QVBoxLayout(page)
+        
+        self.connection_model = ConnectionTableModel(self)
+        self.bandwidth_label = QLabel("代理未运行")
+        layout.addWidget(self.bandwidth_label)
+        self.bandwidth_chart = SparklineWidget(self.connection_model.total_history)
+        layout.addWidget(self.bandwidth_chart)
+        
+        self.connection_view = QTableView()
+        self.connection_view.setModel(self.connection_model)
+        self.connection_view.setItemDelegateForColumn(ConnectionTableModel.TREND_COLUMN,
+                                                      SparklineDelegate(self.connection_view))
+        self.connection_view.setSelectionBehavior(QTableView.SelectRows)
+        self.connection_view.setAlternatingRowColors(True)
+        self.connection_view.verticalHeader().hide()
+        # 固定行高和列宽，避免数百行时按内容逐行测量
+        self.connection_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.connection_view.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.connection_view.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        layout.addWidget(self.connection_view)
+        
+        self.connections_timer = QTimer(self)
+        self.connections_timer.setInterval(self.CONNECTIONS_INTERVAL)
+        self.connections_timer.timeout.connect(self.refresh_connections)
+        self.connections_fetching = False
+        return page
     
     def init_tray_icon(self):
         """初始化系统托盘图标"""
         if not QSystemTrayIcon.isSystemTrayAvailable():
             return
         
-        # 创建系统托盘图标
-        self.tray_icon = QSystemTrayIcon(self)
-        
-        # 尝试创建简单的图标（如果没有图标文件，使用默认图标）
-        try:
-            # 创建一个简单的图标
-            icon = QIcon()
-            # 使用应用程序图标或创建一个简单的图标
-            if hasattr(QApplication, 'style'):
-                icon = self.style().standardIcon(self.style().SP_ComputerIcon)
-            self.tray_icon.setIcon(icon)
-        except:
-            # 如果创建图标失败，使用默认图标
-            pass
-        
-        self.tray_icon.setToolTip(APP_TITLE)
+        if self.tray_icon:
+            # 沿用启动器创建的托盘图标，只替换菜单和事件
+            self.tray_icon.activated.disconnect()
+        else:
+            self.tray_icon = create_tray_icon(self)
         
         # 创建右键菜单
         tray_menu = QMenu(self)
@@ -495,6 +1852,22 @@ class MainWindow(QMainWindow):
         # 显示托盘图标
         self.tray_icon.show()
     
+    def adopt_launcher(self, launcher):
+        """接管托盘启动阶段已运行的代理进程，并补上窗口创建前的日志"""
+        for text in launcher.pending_logs:
+            self.append_log(text)
+        launcher.pending_logs.clear()
+        
+        thread = launcher.process_thread
+        if thread is None or thread.isFinished():
+            return
+        thread.log_output.disconnect()
+        thread.process_finished.disconnect()
+        self.process_thread = thread
+        thread.log_output.connect(self.append_log)
+        thread.process_finished.connect(self.on_process_finished)
+        self.set_running_state()
+    
     def tray_icon_activated(self, reason):
         """托盘图标激活事件"""
         if reason == QSystemTrayIcon.DoubleClick:
@@ -534,74 +1907,30 @@ class MainWindow(QMainWindow):
                 ranges = self._load_china_ip_list()
                 if ranges:
                     self.china_ip_ranges = ranges
+                    self._write_china_ip_file(ranges)
                     self.append_log(f"[系统] 已加载中国IP列表，共 {len(ranges)} 个IP段\n")
                 else:
                     self.append_log("[系统] 加载中国IP列表失败，使用默认列表\n")
             except Exception as e:
                 self.append_log(f"[系统] 加载中国IP列表出错: {e}\n")
         
+        import threading
         thread = threading.Thread(target=load_in_thread, daemon=True)
         thread.start()
     
     def _load_china_ip_list(self):
         """下载并解析中国IP列表"""
-        try:
-            # 尝试从缓存读取
-            cache_file = self.config_manager.config_dir / "china_ip_list.json"
-            if cache_file.exists():
-                try:
-                    with open(cache_file, 'r', encoding='utf-8') as f:
-                        cached_data = json.load(f)
-                        # 检查缓存是否过期（24小时）
-                        import time
-                        if time.time() - cached_data.get('timestamp', 0) < 86400:
-                            return cached_data.get('ranges', [])
-                except:
-                    pass
-            
-            # 下载IP列表
-            with urllib.request.urlopen(CHINA_IP_LIST_URL, timeout=10) as response:
-                content = response.read().decode('utf-8')
-            
-            # 解析IP范围
-            ranges = []
-            for line in content.strip().split('\n'):
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                
-                parts = line.split()
-                if len(parts) >= 2:
-                    start_ip = parts[0]
-                    end_ip = parts[1]
-                    try:
-                        start = ipaddress.IPv4Address(start_ip)
-                        end = ipaddress.IPv4Address(end_ip)
-                        ranges.append((int(start), int(end)))
-                    except:
-                        continue
-            
-            # 保存到缓存
-            try:
-                import time
-                with open(cache_file, 'w', encoding='utf-8') as f:
-                    json.dump({
-                        'timestamp': time.time(),
-                        'ranges': ranges
-                    }, f)
-            except:
-                pass
-            
-            return ranges
-        except Exception as e:
-            print(f"加载中国IP列表失败: {e}")
-            return None
+        return load_china_ip_list(self.config_manager.config_dir)
+    
+    def _write_china_ip_file(self, ranges):
+        write_china_ip_file(self.config_manager.config_dir, ranges)
     
     def _convert_ip_ranges_to_wildcards(self, ranges):
         """将IP范围转换为Windows ProxyOverride通配符格式"""
         if not ranges:
             return []
         
+        import ipaddress
         wildcards = set()
         
         for start, end in ranges:
@@ -671,92 +2000,40 @@ class MainWindow(QMainWindow):
     
     def init_server_combo(self):
         """初始化服务器下拉框（首次加载）"""
-        # 暂时断开信号，避免触发 on_server_changed
-        try:
-            self.server_combo.currentIndexChanged.disconnect()
-        except:
-            pass
-        
-        self.server_combo.clear()
-        sorted_servers = sorted(self.config_manager.servers, key=lambda x: x['name'])
-        for server in sorted_servers:
-            self.server_combo.addItem(server['name'], server['id'])
-        
-        # 选中当前服务器
+        self.select_current_server()
+    
+    def select_current_server(self):
+        """在下拉框中选中当前服务器（不触发 on_server_changed）"""
         current = self.config_manager.get_current_server()
-        if current:
-            for i in range(self.server_combo.count()):
-                if self.server_combo.itemData(i) == current['id']:
-                    self.server_combo.setCurrentIndex(i)
-                    break
-        
-        # 重新连接信号
-        self.server_combo.currentIndexChanged.connect(self.on_server_changed)
+        if not current:
+            return
+        index = self.server_filter.mapFromSource(self.server_model.index(self.server_model.row_of(current['id'])))
+        self.server_combo.blockSignals(True)
+        self.server_combo.setCurrentIndex(index.row() if index.isValid() else -1)
+        self.server_combo.blockSignals(False)
     
     def load_server_config(self):
         """加载服务器配置"""
         # 只更新界面，不刷新 combo（避免递归）
         server = self.config_manager.get_current_server()
         if server:
+            self.loading_server_config = True
             self.server_edit.setText(server.get('server', ''))
             self.listen_edit.setText(server.get('listen', ''))
             self.token_edit.setText(server.get('token', ''))
             self.ip_edit.setText(server.get('ip', ''))
             self.dns_edit.setText(server.get('dns', ''))
             self.ech_edit.setText(server.get('ech', ''))
+            self.max_conns_edit.setText(server.get('max_conns', ''))
+            self.max_conns_per_client_edit.setText(server.get('max_conns_per_client', ''))
+            self.metrics_edit.setText(server.get('metrics', ''))
             # 加载分流模式
             routing_mode = server.get('routing_mode', 'bypass_cn')
             for i in range(self.routing_combo.count()):
                 if self.routing_combo.itemData(i) == routing_mode:
                     self.routing_combo.setCurrentIndex(i)
                     break
-    
-    def refresh_server_combo(self):
-        """刷新服务器下拉框"""
-        # 暂时断开信号连接，避免递归
-        try:
-            self.server_combo.currentIndexChanged.disconnect()
-        except:
-            pass
-        
-        self.server_combo.clear()
-        
-        # 确保有服务器
-        if not self.config_manager.servers:
-            # 如果没有服务器，添加默认服务器
-            self.config_manager.add_default_server()
-        
-        sorted_servers = sorted(self.config_manager.servers, key=lambda x: x['name'])
-        for server in sorted_servers:
-            self.server_combo.addItem(server['name'], server['id'])
-        
-        # 确保有当前服务器
-        current = self.config_manager.get_current_server()
-        if current:
-            # 查找并选中当前服务器
-            found = False
-            for i in range(self.server_combo.count()):
-                if self.server_combo.itemData(i) == current['id']:
-                    self.server_combo.setCurrentIndex(i)
-                    found = True
-                    break
-            
-            # 如果找不到当前服务器，选中第一个
-            if not found and self.server_combo.count() > 0:
-                self.server_combo.setCurrentIndex(0)
-                # 更新当前服务器ID
-                if self.server_combo.itemData(0):
-                    self.config_manager.current_server_id = self.server_combo.itemData(0)
-        else:
-            # 如果没有当前服务器，选中第一个
-            if self.server_combo.count() > 0:
-                self.server_combo.setCurrentIndex(0)
-                # 更新当前服务器ID
-                if self.server_combo.itemData(0):
-                    self.config_manager.current_server_id = self.server_combo.itemData(0)
-        
-        # 重新连接信号
-        self.server_combo.currentIndexChanged.connect(self.on_server_changed)
+            self.loading_server_config = False
     
     def get_control_values(self):
         """获取界面输入值"""
@@ -769,6 +2046,9 @@ class MainWindow(QMainWindow):
             server['ip'] = self.ip_edit.text()
             server['dns'] = self.dns_edit.text()
             server['ech'] = self.ech_edit.text()
+            server['max_conns'] = self.max_conns_edit.text().strip()
+            server['max_conns_per_client'] = self.max_conns_per_client_edit.text().strip()
+            server['metrics'] = self.metrics_edit.text().strip()
             # 保存分流模式
             routing_mode = self.routing_combo.currentData()
             if routing_mode:
@@ -776,20 +2056,7 @@ class MainWindow(QMainWindow):
         return server
     
     def on_server_changed(self):
-        """服务器选择改变"""
-        if self.process_thread and self.process_thread.is_running:
-            # 暂时断开信号，恢复选择
-            self.server_combo.currentIndexChanged.disconnect()
-            current = self.config_manager.get_current_server()
-            if current:
-                for i in range(self.server_combo.count()):
-                    if self.server_combo.itemData(i) == current['id']:
-                        self.server_combo.setCurrentIndex(i)
-                        break
-            self.server_combo.currentIndexChanged.connect(self.on_server_changed)
-            QMessageBox.warning(self, "提示", "请先停止当前连接后再切换服务器")
-            return
-        
+        """服务器选择改变；代理运行中时热加载到新服务器"""
         index = self.server_combo.currentIndex()
         if index >= 0:
             server_id = self.server_combo.itemData(index)
@@ -800,13 +2067,14 @@ class MainWindow(QMainWindow):
                 self.load_server_config()
                 self.server_combo.currentIndexChanged.connect(self.on_server_changed)
                 self.config_manager.save_config()
+                self.apply_running_config(self.config_manager.get_current_server())
     
     def add_server(self):
         """添加服务器"""
         name, ok = QInputDialog.getText(self, "新增服务器", "请输入服务器名称:", text="新服务器")
         if ok and name.strip():
             name = name.strip()
-            if any(s['name'] == name for s in self.config_manager.servers):
+            if self.config_manager.name_exists(name):
                 QMessageBox.warning(self, "提示", "服务器名称已存在")
                 return
             
@@ -821,17 +2089,16 @@ class MainWindow(QMainWindow):
                 'dns': current.get('dns', 'dns.alidns.com/dns-query') if current else 'dns.alidns.com/dns-query',
                 'ech': current.get('ech', 'cloudflare-ech.com') if current else 'cloudflare-ech.com',
                 'routing_mode': current.get('routing_mode', 'bypass_cn') if current else 'bypass_cn',
+                'max_conns': current.get('max_conns', '') if current else '',
+                'max_conns_per_client': current.get('max_conns_per_client', '') if current else '',
+                'metrics': current.get('metrics', '') if current else '',
                 'name': name
             }
-            # 添加服务器（会自动生成新的 id）
-            self.config_manager.add_server(new_server)
+            # 添加服务器（会自动生成新的 id）并切换过去
+            self.server_model.add_server(new_server)
             self.config_manager.save_config()
-            self.refresh_server_combo()
-            # 切换到新添加的服务器
-            for i in range(self.server_combo.count()):
-                if self.server_combo.itemText(i) == name:
-                    self.server_combo.setCurrentIndex(i)
-                    break
+            self.server_filter_edit.clear()
+            self.select_current_server()
             self.load_server_config()
             self.append_log(f"[系统] 已添加新服务器: {name}\n")
     
@@ -839,9 +2106,42 @@ class MainWindow(QMainWindow):
         """保存服务器配置"""
         server = self.get_control_values()
         if server:
-            self.config_manager.update_server(server)
+            self.server_model.update_server(server)
             self.config_manager.save_config()
             self.append_log(f"[系统] 服务器 \"{server['name']}\" 配置已保存\n")
+            if self.process_thread and self.process_thread.server_id == server['id']:
+                self.apply_running_config(server)
+            elif server['name'] in self.config_manager.policy_targets():
+                self.refresh_running_policy()
+    
+    def edit_policy_rules(self):
+        """编辑策略路由规则：按域名后缀或 IP 段把流量分给指定服务器或直连"""
+        text, ok = QInputDialog.getMultiLineText(
+            self, "策略规则",
+            "每行一条 \"类型,值,目标\"，如 DOMAIN-SUFFIX,youtube.com,视频节点 或 IP-CIDR,10.0.0.0/8,DIRECT\n"
+            "目标为服务器名称、DIRECT（直连）或 PROXY（当前服务器）；域名取最长后缀匹配，IP 段重叠时靠前的优先",
+            "\n".join(self.config_manager.policy_rules))
+        if not ok:
+            return
+        lines = text.splitlines()
+        rules, errors = parse_policy_rules(lines)
+        names = {server.get('name', '') for server in self.config_manager.servers}
+        for kind, value, target in rules:
+            if target not in POLICY_RESERVED and target not in names:
+                errors.append(f"找不到服务器 \"{target}\": {kind},{value},{target}")
+        if errors:
+            QMessageBox.warning(self, "策略规则有误", "\n".join(errors[:10]))
+            return
+        
+        self.config_manager.policy_rules = [line.strip() for line in lines if line.strip()]
+        self.config_manager.save_config()
+        self.append_log(f"[系统] 策略规则已保存: {len(rules)} 条\n")
+        self.refresh_running_policy()
+    
+    def refresh_running_policy(self):
+        """服务器列表或策略规则变化后，按最新内容重新下发运行中代理的策略路由"""
+        if self.process_thread and self.process_thread.is_running:
+            self.apply_running_config(self.process_thread.runner.config)
     
     def delete_server(self):
         """删除服务器"""
@@ -858,14 +2158,20 @@ class MainWindow(QMainWindow):
                 deleted_id = server['id']
                 
                 # 删除服务器
-                self.config_manager.delete_server(deleted_id)
+                self.server_combo.blockSignals(True)
+                self.server_model.remove_server(deleted_id)
+                self.server_combo.blockSignals(False)
                 self.config_manager.save_config()
                 
-                # 刷新下拉框（会自动选中新的当前服务器）
-                self.refresh_server_combo()
+                # 选中新的当前服务器
+                self.select_current_server()
                 
-                # 加载新当前服务器的配置
+                # 加载新当前服务器的配置；删除的是运行中的服务器时改用新的当前服务器
                 self.load_server_config()
+                if self.process_thread and self.process_thread.server_id == deleted_id:
+                    self.apply_running_config(self.config_manager.get_current_server())
+                elif name in self.config_manager.policy_targets():
+                    self.refresh_running_policy()
                 
                 self.append_log(f"[系统] 已删除服务器: {name}\n")
     
@@ -876,17 +2182,66 @@ class MainWindow(QMainWindow):
             new_name, ok = QInputDialog.getText(self, "重命名服务器", "请输入新的服务器名称:", text=server['name'])
             if ok and new_name.strip():
                 new_name = new_name.strip()
-                if any(s['name'] == new_name and s['id'] != server['id'] for s in self.config_manager.servers):
+                if self.config_manager.name_exists(new_name, server['id']):
                     QMessageBox.warning(self, "提示", "服务器名称已存在")
                     return
                 
                 old_name = server['name']
-                server['name'] = new_name
-                self.config_manager.update_server(server)
+                server = dict(server, name=new_name)
+                self.server_model.update_server(server)
+                self.config_manager.rename_policy_target(old_name, new_name)
                 self.config_manager.save_config()
-                self.refresh_server_combo()
+                if self.process_thread and self.process_thread.server_id == server['id']:
+                    self.apply_running_config(dict(self.process_thread.runner.config, name=new_name))
+                elif new_name in self.config_manager.policy_targets():
+                    self.refresh_running_policy()
                 self.append_log(f"[系统] 服务器已重命名: {old_name} -> {new_name}\n")
     
+    def import_subscription(self):
+        """从订阅地址或本地文件批量导入服务器"""
+        source, ok = QInputDialog.getText(self, "导入订阅", "订阅地址或本地文件路径:")
+        source = source.strip()
+        if not ok or not source:
+            return
+        self.append_log(f"[系统] 正在导入订阅: {source}\n")
+        
+        def load_in_thread():
+            try:
+                if os.path.isfile(source):
+                    with open(source, 'r', encoding='utf-8', errors='replace') as f:
+                        text = f.read()
+                else:
+                    import urllib.request
+                    with urllib.request.urlopen(source, timeout=15) as response:
+                        text = response.read().decode('utf-8', errors='replace')
+                self.subscription_loaded.emit(parse_subscription(text), '')
+            except Exception as e:
+                self.subscription_loaded.emit(None, str(e))
+        
+        import threading
+        threading.Thread(target=load_in_thread, daemon=True).start()
+    
+    def on_subscription_loaded(self, entries, error):
+        """订阅下载解析完成（主线程）"""
+        if entries is None:
+            self.append_log(f"[系统] 导入订阅失败: {error}\n")
+            return
+        
+        # 新条目沿用当前服务器的监听地址、DOH、ECH 和分流设置
+        defaults = dict(DEFAULT_SERVER)
+        current = self.config_manager.get_current_server() or {}
+        for key in ('listen', 'dns', 'ech', 'routing_mode'):
+            if current.get(key):
+                defaults[key] = current[key]
+        
+        self.server_combo.blockSignals(True)
+        added, skipped = self.server_model.import_servers(entries, defaults)
+        self.server_combo.blockSignals(False)
+        self.select_current_server()
+        if added:
+            self.config_manager.save_config()
+        self.append_log(f"[系统] 订阅导入完成: 新增 {len(added)} 个，跳过重复 {skipped} 个\n")
+    
     def start_process(self):
         """启动进程"""
         server = self.get_control_values()
@@ -899,21 +2254,52 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "提示", "请输入监听地址")
             return
         
-        self.config_manager.update_server(server)
+        for key, label in (('max_conns', '最大连接数'), ('max_conns_per_client', '单客户端连接数')):
+            if server.get(key) and not server[key].isdigit():
+                QMessageBox.warning(self, "提示", f"{label}必须是非负整数")
+                return
+        
+        self.server_model.update_server(server)
         self.config_manager.save_config()
         
-        self.process_thread = ProcessThread(server)
+        config_dir = self.config_manager.config_dir
+        self.process_thread = ProcessThread(self.config_manager.with_policy(server), config_dir / CHINA_IP_FILE_NAME,
+                                            config_dir)
         self.process_thread.log_output.connect(self.append_log)
         self.process_thread.process_finished.connect(self.on_process_finished)
         self.process_thread.start()
-        
+        self.set_running_state()
+        self.append_log(f"[系统] 已启动服务器: {server['name']}\n")
+    
+    def set_running_state(self):
+        """代理运行中的界面状态；监听地址之外的服务器配置可在运行中修改并热加载"""
         self.start_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
         self.proxy_btn.setEnabled(True)  # 启动后可以设置系统代理
-        self.server_edit.setEnabled(False)
         self.listen_edit.setEnabled(False)
-        self.server_combo.setEnabled(False)
-        self.append_log(f"[系统] 已启动服务器: {server['name']}\n")
+        self.connections_timer.start()
+    
+    def apply_running_config(self, server):
+        """代理运行中时热加载服务器配置：不重启进程，已有连接保持，新连接使用新配置"""
+        thread = self.process_thread
+        if not (server and thread and thread.is_running):
+            return
+        if server.get('listen') != thread.runner.config.get('listen'):
+            self.append_log("[系统] 监听地址的修改需要重新启动后生效\n")
+        server = self.config_manager.with_policy(server)
+        
+        def reload_in_thread():
+            self.reload_finished.emit(thread.reload(server) or '')
+        
+        import threading
+        threading.Thread(target=reload_in_thread, daemon=True).start()
+    
+    def on_reload_finished(self, error):
+        """热加载完成（主线程）"""
+        if error:
+            self.append_log(f"[系统] 应用新配置失败，继续使用原配置: {error}\n")
+        else:
+            self.append_log(f"[系统] 已应用服务器 \"{self.process_thread.runner.config.get('name', '')}\" 的配置，现有连接不受影响\n")
     
     def stop_process(self):
         """停止进程"""
@@ -934,11 +2320,46 @@ class MainWindow(QMainWindow):
         self.start_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
         self.proxy_btn.setEnabled(False)  # 停止后禁用系统代理按钮
-        self.server_edit.setEnabled(True)
         self.listen_edit.setEnabled(True)
-        self.server_combo.setEnabled(True)
+        self.connections_timer.stop()
+        self.connection_model.clear()
+        self.bandwidth_chart.update()
+        self.bandwidth_label.setText("代理未运行")
         self.append_log("[系统] 进程已停止。\n")
     
+    def refresh_connections(self):
+        """后台拉取 /connections；窗口隐藏、面板不可见或上一次请求未返回时跳过"""
+        if (self.connections_fetching or not self.isVisible()
+                or self.tabs.currentIndex() != 1
+                or not (self.process_thread and self.process_thread.is_running)):
+            return
+        url = f"http://{self.process_thread.metrics_address}/connections"
+        self.connections_fetching = True
+        
+        def load_in_thread():
+            try:
+                import urllib.request
+                with urllib.request.urlopen(url, timeout=2) as response:
+                    self.connections_loaded.emit(json.loads(response.read()))
+            except Exception:
+                self.connections_loaded.emit(None)
+        
+        import threading
+        threading.Thread(target=load_in_thread, daemon=True).start()
+    
+    def on_connections_loaded(self, snapshot):
+        """连接快照到达（主线程）"""
+        self.connections_fetching = False
+        if snapshot is None or not self.connections_timer.isActive():
+            return
+        self.connection_model.apply_snapshot(snapshot)
+        self.bandwidth_chart.update()
+        rate = self.connection_model.total_history[-1] if self.connection_model.total_history else 0
+        total = self.connection_model.total or (0, 0)
+        self.bandwidth_label.setText(
+            f"活动连接: {self.connection_model.rowCount()}    总带宽: {format_bytes(rate)}/s    "
+            f"累计上行: {format_bytes(total[0])}    累计下行: {format_bytes(total[1])}")
+    
     def on_auto_start_changed(self):
         """开机启动改变"""
         enabled = self.auto_start_check.isChecked()
@@ -1076,6 +2497,10 @@ class MainWindow(QMainWindow):
     
     def on_routing_changed(self):
         """分流模式改变"""
+        # 代理运行中时进程内分流立即切换（切换服务器时由 on_server_changed 整体应用）
+        if not self.loading_server_config and self.process_thread and self.process_thread.is_running:
+            self.apply_running_config(dict(self.process_thread.runner.config,
+                                           routing_mode=self.routing_combo.currentData()))
         # 如果已经设置了系统代理，重新设置以应用新的绕过规则
         if self.system_proxy_enabled:
             routing_mode = self.routing_combo.currentData()
@@ -1281,6 +2706,7 @@ class MainWindow(QMainWindow):
     
     def _set_macos_proxy(self, enabled, listen, routing_mode):
         """设置 macOS 系统代理"""
+        import subprocess
         try:
             # 解析监听地址
             if ':' in listen:
@@ -1369,10 +2795,127 @@ class MainWindow(QMainWindow):
                 self.append_log("[系统] 开机自动启动代理\n")
 
 
+def create_tray_icon(parent):
+    """创建托盘图标（尚未设置菜单）"""
+    tray_icon = QSystemTrayIcon(parent)
+    
+    # 尝试创建简单的图标（如果没有图标文件，使用默认图标）
+    try:
+        style = QApplication.style()
+        tray_icon.setIcon(style.standardIcon(style.SP_ComputerIcon))
+    except:
+        # 如果创建图标失败，使用默认图标
+        tray_icon.setIcon(QIcon())
+    
+    tray_icon.setToolTip(APP_TITLE)
+    return tray_icon
+
+
+class TrayLauncher(QObject):
+    """开机自启动路径：先显示托盘并启动代理，主窗口在首次打开时才创建"""
+    ip_list_loaded = pyqtSignal(object)
+    
+    def __init__(self):
+        super().__init__()
+        self.config_manager = ConfigManager()
+        self.config_manager.load_config()
+        self.process_thread = None
+        self.window = None
+        self.china_ip_ranges = None
+        self.pending_logs = []
+        self.ip_list_loaded.connect(self._on_ip_list_loaded)
+        
+        self.tray_icon = create_tray_icon(None)
+        menu = QMenu()
+        menu.addAction("显示窗口", self.show_window)
+        menu.addSeparator()
+        menu.addAction("退出", self.quit_application)
+        self.tray_menu = menu
+        self.tray_icon.setContextMenu(menu)
+        self.tray_icon.activated.connect(self.tray_icon_activated)
+        self.tray_icon.show()
+    
+    def log(self, text):
+        if self.window:
+            self.window.append_log(text)
+        else:
+            self.pending_logs.append(text)
+    
+    def auto_start(self):
+        """按当前服务器配置直接启动代理，无需先构建窗口控件"""
+        server = self.config_manager.get_current_server()
+        if not (server and server.get('server') and server.get('listen')):
+            return
+        
+        config_dir = self.config_manager.config_dir
+        self.process_thread = ProcessThread(self.config_manager.with_policy(server), config_dir / CHINA_IP_FILE_NAME,
+                                            config_dir)
+        self.process_thread.log_output.connect(self.log)
+        self.process_thread.process_finished.connect(lambda: self.log("[系统] 进程已停止。\n"))
+        self.process_thread.start()
+        self.log(f"[系统] 已启动服务器: {server['name']}\n")
+        self.log("[系统] 开机自动启动代理\n")
+        self.load_china_ip_list_async()
+    
+    def load_china_ip_list_async(self):
+        """后台加载中国IP列表，结果通过信号回到主线程"""
+        import threading
+        
+        def load_in_thread():
+            ranges = load_china_ip_list(self.config_manager.config_dir)
+            if ranges:
+                write_china_ip_file(self.config_manager.config_dir, ranges)
+            self.ip_list_loaded.emit(ranges)
+        
+        threading.Thread(target=load_in_thread, daemon=True).start()
+    
+    def _on_ip_list_loaded(self, ranges):
+        if ranges:
+            self.china_ip_ranges = ranges
+            if self.window:
+                self.window.china_ip_ranges = ranges
+            self.log(f"[系统] 已加载中国IP列表，共 {len(ranges)} 个IP段\n")
+        else:
+            self.log("[系统] 加载中国IP列表失败，使用默认列表\n")
+    
+    def tray_icon_activated(self, reason):
+        if reason == QSystemTrayIcon.DoubleClick:
+            self.show_window()
+    
+    def show_window(self):
+        """首次打开时才构建主窗口，之后托盘交给主窗口管理"""
+        if self.window is None:
+            self.window = MainWindow(launcher=self)
+        self.window.show_window()
+    
+    def quit_application(self):
+        if self.window:
+            self.window.quit_application()
+            return
+        if self.process_thread and self.process_thread.is_running:
+            self.process_thread.stop()
+            self.process_thread.wait()
+        self.tray_icon.hide()
+        QApplication.quit()
+
+
 def main():
     app = QApplication(sys.argv)
-    window = MainWindow()
-    window.show()
+    if '-autostart' in sys.argv and QSystemTrayIcon.isSystemTrayAvailable():
+        # 托盘优先：窗口控件推迟到首次打开时构建
+        app.setQuitOnLastWindowClosed(False)
+        launcher = TrayLauncher()
+        if os.environ.get(STARTUP_BENCH_ENV):
+            print(f"{STARTUP_BENCH_MARK} tray {time.perf_counter() - _STARTUP_T0:.6f}", flush=True)
+            return
+        launcher.auto_start()
+    else:
+        window = MainWindow()
+        window.show()
+        if os.environ.get(STARTUP_BENCH_ENV):
+            app.processEvents()
+            print(f"{STARTUP_BENCH_MARK} window {time.perf_counter() - _STARTUP_T0:.6f}", flush=True)
+            return
     sys.exit(app.exec_())
 
 
@@ -0,0 +1,13 @@
+package main
+
+import "syscall"
+
+// enableReusePort 开启 SO_REUSEPORT，多个进程共享同一监听端口
+func enableReusePort(fd uintptr) error {
+	return syscall.SetsockoptInt(int(fd), syscall.SOL_SOCKET, soReusePort, 1)
+}
+
+// enableTransparent 开启 IP_TRANSPARENT，接受 TPROXY 转来的、目标地址不属于本机的连接
+func enableTransparent(fd uintptr) error {
+	return syscall.SetsockoptInt(int(fd), syscall.SOL_IP, syscall.IP_TRANSPARENT, 1)
+}
@@ -0,0 +1,13 @@
+//go:build !linux
+
+package main
+
+import "errors"
+
+func enableReusePort(fd uintptr) error {
+	return errors.New("SO_REUSEPORT 仅支持 Linux")
+}
+
+func enableTransparent(fd uintptr) error {
+	return errors.New("透明代理仅支持 Linux")
+}
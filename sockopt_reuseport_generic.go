@@ -0,0 +1,6 @@
+//go:build linux && !mips && !mipsle && !mips64 && !mips64le
+
+package main
+
+// soReusePort asm-generic 的 SO_REUSEPORT；syscall 包在 amd64/386/arm 上没有定义这个常量
+const soReusePort = 0xf
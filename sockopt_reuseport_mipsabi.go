@@ -0,0 +1,8 @@
+//go:build linux && (mips || mipsle || mips64 || mips64le)
+
+package main
+
+import "syscall"
+
+// soReusePort MIPS 的套接字选项编号与其他架构不同（SOL_SOCKET 0xffff，SO_REUSEPORT 0x200）
+const soReusePort = syscall.SO_REUSEPORT
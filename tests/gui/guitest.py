@@ -0,0 +1,37 @@
+"""测试辅助：加载 gui.py 中不依赖 Qt 的部分（无界面模式分派之前的内容），测试无需安装 PyQt5"""
+
+import os
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+GUI_FILE = Path(__file__).resolve().parents[2] / 'gui.py'
+QT_BOUNDARY = '# 无界面模式在导入 Qt 之前分派'
+
+
+def load_gui():
+    source = GUI_FILE.read_text(encoding='utf-8')
+    head, found, _ = source.partition(QT_BOUNDARY)
+    if not found:
+        raise RuntimeError(f"gui.py 中找不到分界注释: {QT_BOUNDARY}")
+    module = types.ModuleType('gui')
+    module.__file__ = str(GUI_FILE)
+    exec(compile(head, str(GUI_FILE), 'exec'), module.__dict__)
+    return module
+
+
+gui = load_gui()
+
+
+class TempHomeTestCase(unittest.TestCase):
+    """配置目录指向临时目录，不读写真实的用户配置"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.home = Path(tmp.name)
+        patcher = mock.patch.dict(os.environ, {'HOME': tmp.name, 'APPDATA': tmp.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
@@ -0,0 +1,109 @@
+import unittest
+
+from guitest import TempHomeTestCase, gui
+
+
+class ParsePolicyRulesTest(unittest.TestCase):
+
+    def test_valid_rules_are_normalized(self):
+        rules, errors = gui.parse_policy_rules([
+            '# 注释',
+            '',
+            'domain-suffix, .Example.COM. ,香港',
+            'IP-CIDR,10.1.2.3/8,DIRECT',
+            'IP-CIDR,192.168.1.1,PROXY',
+        ])
+        self.assertEqual(errors, [])
+        self.assertEqual(rules, [
+            ('DOMAIN-SUFFIX', 'example.com', '香港'),
+            ('IP-CIDR', '10.1.2.3/8', 'DIRECT'),
+            ('IP-CIDR', '192.168.1.1', 'PROXY'),
+        ])
+
+    def test_invalid_rules_report_line_numbers(self):
+        cases = [
+            'DOMAIN-SUFFIX,example.com',
+            'DOMAIN-SUFFIX,,PROXY',
+            'DOMAIN-SUFFIX,example.com,PROXY,extra',
+            'GEOIP,CN,DIRECT',
+            'IP-CIDR,300.0.0.0/8,DIRECT',
+            'IP-CIDR,2001:db8::/32,DIRECT',
+        ]
+        for line in cases:
+            with self.subTest(line=line):
+                rules, errors = gui.parse_policy_rules(['# 注释', line])
+                self.assertEqual(rules, [])
+                self.assertEqual(len(errors), 1)
+                self.assertTrue(errors[0].startswith('第 2 行'), errors[0])
+
+
+class PolicySettingsTest(TempHomeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = gui.ConfigManager()
+        for server_id, name, address in (
+            ('hk', '香港', 'hk.example.com:443'),
+            ('us', '美国', 'us.example.com:443'),
+            ('jp', '日本', 'jp.example.com:443'),
+            ('empty', '未填地址', ''),
+        ):
+            self.config.add_server(dict(gui.DEFAULT_SERVER, id=server_id, name=name, server=address, token=f'{server_id}-token'))
+
+    def test_rules_are_rewritten_for_the_running_server(self):
+        self.config.policy_rules = [
+            'DOMAIN-SUFFIX,video.com,美国',
+            'DOMAIN-SUFFIX,news.com,香港',
+            'IP-CIDR,10.0.0.0/8,DIRECT',
+            'DOMAIN-SUFFIX,other.com,PROXY',
+            'DOMAIN-SUFFIX,gone.com,已删除',
+            'DOMAIN-SUFFIX,blank.com,未填地址',
+            '不是规则',
+        ]
+        settings = self.config.policy_settings(self.config.get_server('hk'))
+        self.assertEqual(settings['name'], '香港')
+        self.assertEqual(settings['rules'], [
+            'DOMAIN-SUFFIX,video.com,美国',
+            'DOMAIN-SUFFIX,news.com,PROXY',
+            'IP-CIDR,10.0.0.0/8,DIRECT',
+            'DOMAIN-SUFFIX,other.com,PROXY',
+        ])
+        # 只下发被引用的服务端；运行中的服务器本身、未引用的日本和未填地址的服务器都不在其中
+        self.assertEqual(settings['upstreams'], [
+            {'name': '美国', 'server': 'us.example.com:443', 'token': 'us-token', 'ip': gui.DEFAULT_SERVER['ip']},
+        ])
+
+    def test_switching_server_changes_which_rules_become_proxy(self):
+        self.config.policy_rules = ['DOMAIN-SUFFIX,video.com,美国', 'DOMAIN-SUFFIX,news.com,香港']
+        settings = self.config.with_policy(self.config.get_server('us'))['policy']
+        self.assertEqual(settings['rules'], ['DOMAIN-SUFFIX,video.com,PROXY', 'DOMAIN-SUFFIX,news.com,香港'])
+        self.assertEqual([c['name'] for c in settings['upstreams']], ['香港'])
+
+    def test_server_named_like_a_reserved_target_is_not_an_upstream(self):
+        self.config.add_server(dict(gui.DEFAULT_SERVER, id='direct', name='DIRECT', server='d.example.com:443'))
+        self.config.policy_rules = ['DOMAIN-SUFFIX,example.com,DIRECT']
+        settings = self.config.policy_settings(self.config.get_server('hk'))
+        self.assertEqual(settings['rules'], ['DOMAIN-SUFFIX,example.com,DIRECT'])
+        self.assertEqual(settings['upstreams'], [])
+
+    def test_rename_updates_only_matching_targets(self):
+        self.config.policy_rules = [
+            'DOMAIN-SUFFIX,a.com,香港',
+            'DOMAIN-SUFFIX,香港.com,美国',
+            'IP-CIDR,10.0.0.0/8, 香港 ',
+            'DOMAIN-SUFFIX,b.com,香港2',
+            '# 香港',
+        ]
+        self.config.rename_policy_target('香港', '香港新')
+        self.assertEqual(self.config.policy_rules, [
+            'DOMAIN-SUFFIX,a.com,香港新',
+            'DOMAIN-SUFFIX,香港.com,美国',
+            'IP-CIDR,10.0.0.0/8,香港新',
+            'DOMAIN-SUFFIX,b.com,香港2',
+            '# 香港',
+        ])
+        self.assertEqual(self.config.policy_targets(), {'香港新', '美国', '香港2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import signal
+import unittest
+
+from guitest import TempHomeTestCase, gui
+
+
+class FakeProcess:
+    """代替运行中的代理进程，记录收到的信号"""
+
+    def __init__(self):
+        self.signals = []
+
+    def send_signal(self, sig):
+        self.signals.append(sig)
+
+
+def server(server_id, name, address):
+    return dict(gui.DEFAULT_SERVER, id=server_id, name=name, server=address)
+
+
+@unittest.skipUnless(hasattr(signal, 'SIGHUP'), "没有指标地址时热加载依赖 SIGHUP")
+class ReloadTest(TempHomeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.a = server('a', 'A', 'a.example.com:443')
+        self.b = server('b', 'B', 'b.example.com:443')
+        self.runner = gui.ProcessRunner(dict(self.a), on_output=lambda text: None, cache_dir=self.home)
+        self.runner.is_running = True
+        self.runner.process = FakeProcess()
+
+    def running_id(self):
+        # 与 ProcessThread.server_id 相同：GUI 保存、删除、重命名时据此判断运行中的服务器
+        return self.runner.config.get('id')
+
+    def save(self, saved):
+        """模拟 MainWindow.save_server：只有保存运行中的服务器才热加载"""
+        if self.running_id() == saved['id']:
+            self.assertIsNone(self.runner.reload(saved))
+
+    def test_switch_carries_id(self):
+        self.assertIsNone(self.runner.reload(self.b))
+        self.assertEqual(self.running_id(), 'b')
+        self.assertEqual(self.runner.config['server'], 'b.example.com:443')
+        self.assertEqual(self.runner.process.signals, [signal.SIGHUP])
+
+    def test_switch_then_save_running_server(self):
+        self.runner.reload(self.b)
+        self.save(dict(self.b, token='new-token'))
+        self.assertEqual(self.runner.config['token'], 'new-token')
+        self.assertEqual(len(self.runner.process.signals), 2)
+
+    def test_switch_then_save_previous_server(self):
+        self.runner.reload(self.b)
+        self.save(dict(self.a, token='new-token'))
+        self.assertEqual(self.running_id(), 'b')
+        self.assertEqual(self.runner.config['server'], 'b.example.com:443')
+        self.assertEqual(len(self.runner.process.signals), 1)
+
+    def test_failed_reload_keeps_previous_server(self):
+        self.assertEqual(self.runner.reload(dict(self.b, server='')), "服务端地址为空")
+        self.runner.process.send_signal = lambda sig: (_ for _ in ()).throw(OSError("进程已退出"))
+        self.assertEqual(self.runner.reload(self.b), "进程已退出")
+        self.assertEqual(self.running_id(), 'a')
+        self.assertEqual(self.runner.settings()['server'], 'a.example.com:443')
+
+
+if __name__ == '__main__':
+    unittest.main()
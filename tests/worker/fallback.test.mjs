@@ -0,0 +1,113 @@
+// 直连与 Cloudflare 回退地址的错开竞速（_worker.js openRemoteSocket）
+import assert from 'node:assert/strict';
+import { after, beforeEach, test } from 'node:test';
+import { loadWorker, openSession, plannedConnect, sockets, waitFor } from './harness.mjs';
+
+const FALLBACK = '[2a00:1098:2b::1:6815:5881]';
+const CACHE_SIZE = 1024;
+
+let plan;
+let log;
+beforeEach(() => {
+  plan = {};
+  ({ connect: sockets.connect, log } = plannedConnect(plan));
+});
+
+// 建立一条隧道，返回 Worker 的应答（CONNECTED 或 ERROR:...）和本次的连接记录
+async function tunnel(worker, host) {
+  log.length = 0;
+  const { ws } = await openSession(worker);
+  const start = Date.now();
+  ws.message(`CONNECT:${host}:443|`);
+  await waitFor(() => ws.texts().length > 0, 3000);
+  const attempts = log.map((r) => ({ ...r, at: r.at - start }));
+  ws.message('CLOSE');
+  return { reply: ws.texts()[0], attempts };
+}
+
+const hosts = (attempts) => attempts.map((a) => a.hostname);
+
+test('直连成功时采用直连，先打开的回退连接被关闭', async () => {
+  const worker = await loadWorker();
+  plan['slow.test'] = { delay: 300 };
+  plan[FALLBACK] = { delay: 10 };
+
+  const { reply, attempts } = await tunnel(worker, 'slow.test');
+  assert.equal(reply, 'CONNECTED');
+  assert.deepEqual(hosts(attempts), ['slow.test', FALLBACK]);
+  assert.ok(attempts[1].at >= 150, `回退应在错开间隔后发起，实际 ${attempts[1].at}ms`);
+  assert.equal(attempts[0].closed, false);
+  assert.equal(attempts[1].closed, true);
+});
+
+test('直连被 Cloudflare 拒绝时立即采用已打开的回退连接，之后该主机直接走回退', async () => {
+  const worker = await loadWorker();
+  plan['cf.test'] = { delay: 400, fail: 'cf' };
+  plan[FALLBACK] = { delay: 10 };
+
+  let { reply, attempts } = await tunnel(worker, 'cf.test');
+  assert.equal(reply, 'CONNECTED');
+  assert.deepEqual(hosts(attempts), ['cf.test', FALLBACK]);
+  assert.equal(attempts[1].closed, false);
+
+  ({ reply, attempts } = await tunnel(worker, 'cf.test'));
+  assert.equal(reply, 'CONNECTED');
+  assert.deepEqual(hosts(attempts), [FALLBACK]);
+});
+
+test('直连很快被 Cloudflare 拒绝时不等错开间隔，立即发起回退', async () => {
+  const worker = await loadWorker();
+  plan['quick.test'] = { delay: 20, fail: 'cf' };
+
+  const { reply, attempts } = await tunnel(worker, 'quick.test');
+  assert.equal(reply, 'CONNECTED');
+  assert.deepEqual(hosts(attempts), ['quick.test', FALLBACK]);
+  assert.ok(attempts[1].at < 150, `回退应在直连失败后立即发起，实际 ${attempts[1].at}ms`);
+});
+
+test('直连因其他原因失败时返回错误，不采用回退', async () => {
+  const worker = await loadWorker();
+  plan['refused.test'] = { delay: 300, fail: 'refused' };
+  plan[FALLBACK] = { delay: 10 };
+
+  let { reply, attempts } = await tunnel(worker, 'refused.test');
+  assert.equal(reply, 'ERROR:connection refused');
+  assert.equal(attempts[1].closed, true);
+
+  // 没有记入回退缓存
+  ({ attempts } = await tunnel(worker, 'refused.test'));
+  assert.equal(hosts(attempts)[0], 'refused.test');
+});
+
+test('缓存的主机回退失败时返回错误并移出缓存，下次重新直连', async () => {
+  const worker = await loadWorker();
+  plan['cf.test'] = { delay: 0, fail: 'cf' };
+  await tunnel(worker, 'cf.test');
+
+  plan[FALLBACK] = { delay: 0, fail: 'refused' };
+  let { reply, attempts } = await tunnel(worker, 'cf.test');
+  assert.equal(reply, 'ERROR:connection refused');
+  assert.deepEqual(hosts(attempts), [FALLBACK]);
+
+  plan[FALLBACK] = { delay: 0 };
+  ({ reply, attempts } = await tunnel(worker, 'cf.test'));
+  assert.equal(reply, 'CONNECTED');
+  assert.deepEqual(hosts(attempts), ['cf.test', FALLBACK]);
+});
+
+test('回退缓存按最近使用淘汰', async () => {
+  const worker = await loadWorker();
+  for (let i = 0; i <= CACHE_SIZE; i++) plan[`h${i}.test`] = { delay: 0, fail: 'cf' };
+
+  for (let i = 0; i < CACHE_SIZE; i++) await tunnel(worker, `h${i}.test`);
+  // 重新使用 h0，最久未用的变成 h1
+  assert.deepEqual(hosts((await tunnel(worker, 'h0.test')).attempts), [FALLBACK]);
+  await tunnel(worker, `h${CACHE_SIZE}.test`);
+
+  assert.deepEqual(hosts((await tunnel(worker, 'h0.test')).attempts), [FALLBACK]);
+  assert.deepEqual(hosts((await tunnel(worker, 'h1.test')).attempts), ['h1.test', FALLBACK]);
+});
+
+after(() => {
+  sockets.connect = null;
+});
@@ -0,0 +1,41 @@
+// 二进制握手帧解析（_worker.js handleBinaryConnect），字节与 Go 端 TestAppendBinaryConnect 共用 binary-connect.json
+import assert from 'node:assert/strict';
+import fs from 'node:fs';
+import { after, before, test } from 'node:test';
+import { loadWorker, openSession, sockets, waitFor } from './harness.mjs';
+
+const fixtures = JSON.parse(fs.readFileSync(new URL('./binary-connect.json', import.meta.url), 'utf8'));
+
+let worker;
+before(async () => {
+  worker = await loadWorker();
+});
+
+for (const f of fixtures.filter((f) => !f.error)) {
+  test(`解析握手帧: ${f.name}`, async () => {
+    const connects = [];
+    const written = [];
+    sockets.connect = ({ hostname, port }) => {
+      connects.push({ hostname, port });
+      return {
+        opened: Promise.resolve(),
+        readable: new ReadableStream({ pull: () => new Promise(() => {}) }),
+        writable: new WritableStream({ write(chunk) { written.push(...chunk); } }),
+        close() {},
+      };
+    };
+
+    const { ws } = await openSession(worker, { 'X-ECH-Proto': 'bin1' });
+    ws.message(Buffer.from(f.frame, 'hex'));
+    await waitFor(() => ws.texts().length > 0);
+
+    assert.equal(ws.texts()[0], 'CONNECTED');
+    assert.deepEqual(connects[0], { hostname: f.host, port: f.port });
+    assert.deepEqual(written, [...Buffer.from(f.early, 'hex')]);
+    ws.message('CLOSE');
+  });
+}
+
+after(() => {
+  sockets.connect = null;
+});
@@ -0,0 +1,137 @@
+// 在 Node 中运行 _worker.js：cloudflare:sockets 换成 sockets.mjs，WebSocketPair 和 Response 用最小的替身
+import fs from 'node:fs';
+import net from 'node:net';
+import os from 'node:os';
+import path from 'node:path';
+import { Duplex } from 'node:stream';
+import { fileURLToPath, pathToFileURL } from 'node:url';
+
+export { sockets } from './sockets.mjs';
+
+const here = path.dirname(fileURLToPath(import.meta.url));
+
+// 服务端一侧的 WebSocket：send() 记入 sent，emit() 模拟客户端发来的事件
+export class FakeWebSocket {
+  constructor() {
+    this.readyState = 1;
+    this.listeners = {};
+    this.sent = [];
+  }
+  accept() {}
+  addEventListener(type, fn) {
+    (this.listeners[type] ||= []).push(fn);
+  }
+  send(data) {
+    this.sent.push(data);
+  }
+  close() {
+    this.readyState = 3;
+  }
+  emit(type, event) {
+    for (const fn of this.listeners[type] || []) fn(event);
+  }
+  // 客户端发来的消息：字符串原样传递，字节数组转成 ArrayBuffer（与 Workers 运行时一致）
+  message(data) {
+    this.emit('message', { data: typeof data === 'string' ? data : Uint8Array.from(data).buffer });
+  }
+  texts() {
+    return this.sent.filter((m) => typeof m === 'string');
+  }
+  binaries() {
+    return this.sent.filter((m) => typeof m !== 'string');
+  }
+}
+
+let lastServer = null;
+globalThis.WebSocketPair = function () {
+  const pair = { 0: new FakeWebSocket(), 1: new FakeWebSocket() };
+  lastServer = pair[1];
+  return pair;
+};
+globalThis.Response = class {
+  constructor(body, init = {}) {
+    this.body = body;
+    this.status = init.status ?? 200;
+    this.headers = init.headers ?? {};
+    this.webSocket = init.webSocket;
+  }
+};
+
+// 每个测试文件各自加载一份 Worker（模块级状态如回退主机缓存互不影响）
+export async function loadWorker() {
+  const source = fs.readFileSync(path.join(here, '../../_worker.js'), 'utf8');
+  const shim = JSON.stringify(pathToFileURL(path.join(here, 'sockets.mjs')).href);
+  const patched = source.replace("'cloudflare:sockets'", shim);
+  if (patched === source) throw new Error('_worker.js 中找不到 cloudflare:sockets 导入');
+
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'ech-wk-worker-'));
+  try {
+    const file = path.join(dir, 'worker.mjs');
+    fs.writeFileSync(file, patched);
+    return (await import(pathToFileURL(file).href)).default;
+  } finally {
+    fs.rmSync(dir, { recursive: true, force: true });
+  }
+}
+
+// 发起一次 WebSocket 升级，返回 Worker 的响应和服务端一侧的 WebSocket
+export async function openSession(worker, headers = {}) {
+  const h = { upgrade: 'websocket' };
+  for (const [k, v] of Object.entries(headers)) h[k.toLowerCase()] = v;
+  const response = await worker.fetch(
+    { url: 'https://worker.test/', headers: { get: (k) => h[k.toLowerCase()] ?? null } }, {}, {});
+  return { response, ws: lastServer };
+}
+
+// 用 Node 的 TCP 实现 connect()，连接本机的测试服务
+export function tcpConnect({ hostname, port }) {
+  const sock = net.connect(port, hostname);
+  const opened = new Promise((resolve, reject) => {
+    sock.once('connect', resolve);
+    sock.once('error', reject);
+  });
+  const { readable, writable } = Duplex.toWeb(sock);
+  return { opened, readable, writable, close() { sock.destroy(); } };
+}
+
+// 在回环上启动 TCP 服务，handle 处理每个连接
+export async function listen(handle) {
+  const server = net.createServer(handle);
+  await new Promise((resolve) => server.listen(0, '127.0.0.1', resolve));
+  return server;
+}
+
+export const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// 等待 cond() 为真，超时则失败
+export async function waitFor(cond, timeout = 2000) {
+  const deadline = Date.now() + timeout;
+  while (!cond()) {
+    if (Date.now() > deadline) throw new Error('等待超时');
+    await sleep(5);
+  }
+}
+
+// 按主机名预设结果的 connect()：plan[hostname] = { delay, fail: 'cf' | 'refused' }，
+// 每次调用记入 log（主机名、发起时间、是否被关闭）
+export function plannedConnect(plan) {
+  const log = [];
+  const connect = ({ hostname }) => {
+    const p = plan[hostname] || { delay: 0 };
+    const record = { hostname, at: Date.now(), closed: false };
+    log.push(record);
+    const opened = new Promise((resolve, reject) => setTimeout(() => {
+      if (p.fail === 'cf') reject(new Error('proxy request failed, cannot connect to Cloudflare IPs'));
+      else if (p.fail) reject(new Error('connection refused'));
+      else resolve();
+    }, p.delay));
+    opened.catch(() => {});
+    return {
+      opened,
+      readable: new ReadableStream({ pull: () => new Promise(() => {}) }),
+      writable: new WritableStream(),
+      close() { record.closed = true; },
+    };
+  };
+  return { connect, log };
+}
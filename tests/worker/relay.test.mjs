@@ -0,0 +1,116 @@
+// 上行流水线与下行合并（_worker.js handleSession）
+import assert from 'node:assert/strict';
+import { after, before, test } from 'node:test';
+import { listen, loadWorker, openSession, sleep, sockets, tcpConnect, waitFor } from './harness.mjs';
+
+let worker;
+before(async () => {
+  worker = await loadWorker();
+});
+
+// 可控的远端连接：readable 由测试推入数据，writable 收集上行字节
+function fakeRemote() {
+  const remote = { written: [], controller: null, closed: false };
+  remote.socket = {
+    opened: Promise.resolve(),
+    readable: new ReadableStream({ start(c) { remote.controller = c; } }),
+    writable: new WritableStream({ write(chunk) { remote.written.push(Uint8Array.from(chunk)); } }),
+    close() { remote.closed = true; },
+  };
+  return remote;
+}
+
+const totalBytes = (chunks) => chunks.reduce((n, c) => n + c.byteLength, 0);
+
+test('连接建立前到达的二进制帧排队，之后的上行帧按顺序流水线写出', async (t) => {
+  const received = [];
+  const server = await listen((s) => s.on('data', (d) => received.push(d)));
+  t.after(() => server.close());
+  sockets.connect = tcpConnect;
+
+  const { ws } = await openSession(worker);
+  const early = [0x16, 0x03, 0x01, 0x00];
+  ws.message(`CONNECT:127.0.0.1:${server.address().port}|`);
+  ws.message(early); // 与 CONNECT 同时到达，此时远端尚未连接
+
+  const frames = 200;
+  const expected = [...early];
+  for (let i = 0; i < frames; i++) {
+    const frame = new Array(1000).fill(i & 0xff);
+    expected.push(...frame);
+    ws.message(frame);
+  }
+  await waitFor(() => totalBytes(received) >= expected.length);
+  assert.equal(ws.texts()[0], 'CONNECTED');
+  assert.deepEqual([...Buffer.concat(received)], expected);
+  ws.message('CLOSE');
+});
+
+test('突发的下行小块合并成少量 WebSocket 帧，字节顺序不变', async () => {
+  const remote = fakeRemote();
+  sockets.connect = () => remote.socket;
+
+  const { ws } = await openSession(worker);
+  ws.message('CONNECT:remote.test:443|');
+  await waitFor(() => ws.texts().includes('CONNECTED'));
+
+  const chunks = 500;
+  const expected = [];
+  for (let i = 0; i < chunks; i++) {
+    const chunk = new Uint8Array(100).fill(i & 0xff);
+    expected.push(...chunk);
+    remote.controller.enqueue(chunk);
+  }
+  await waitFor(() => totalBytes(ws.binaries()) >= expected.length);
+
+  const sent = ws.binaries();
+  assert.ok(sent.length < 10, `500 个小块被拆成了 ${sent.length} 帧`);
+  assert.deepEqual(sent.flatMap((m) => [...m]), expected);
+  ws.message('CLOSE');
+});
+
+test('空闲后的单个小块和大块立即发送，不等待合并', async () => {
+  const remote = fakeRemote();
+  sockets.connect = () => remote.socket;
+
+  const { ws } = await openSession(worker);
+  ws.message('CONNECT:remote.test:443|');
+  await waitFor(() => ws.texts().includes('CONNECTED'));
+
+  await sleep(10);
+  remote.controller.enqueue(new Uint8Array([1, 2, 3]));
+  await sleep(0);
+  await sleep(0);
+  assert.equal(ws.binaries().length, 1, '空闲后的小块应在合并计时器触发前发出');
+
+  const big = new Uint8Array(32 * 1024).fill(9);
+  remote.controller.enqueue(big);
+  await waitFor(() => ws.binaries().length === 2);
+  assert.equal(ws.binaries()[1], big, '大块应原样发送，不复制');
+
+  remote.controller.close();
+  await waitFor(() => ws.texts().includes('CLOSE'));
+  assert.equal(ws.readyState, 3);
+});
+
+test('UDP 通道中的数据报（包括 DNS）一律拒绝，不发起出站连接', async () => {
+  let connects = 0;
+  sockets.connect = () => { connects++; throw new Error('不应发起连接'); };
+
+  const { ws } = await openSession(worker);
+  ws.message('UDP');
+  const dns = [0x01, 8, 8, 8, 8, 0x00, 53, 0xab, 0xcd, 0x01, 0x00];
+  const quic = [0x01, 1, 1, 1, 1, 0x01, 0xbb, 0xc0];
+  ws.message(dns);
+  ws.message(dns);
+  ws.message(quic);
+  await sleep(10);
+
+  assert.equal(connects, 0);
+  assert.deepEqual(ws.texts().filter((m) => m.startsWith('ERROR:UDP')).map((m) => m.split(' ')[1]),
+    ['8.8.8.8:53', '1.1.1.1:443']);
+});
+
+after(() => {
+  sockets.connect = null;
+});
@@ -0,0 +1,6 @@
+// cloudflare:sockets 的替身：测试通过 sockets.connect 指定 connect() 的实现
+export const sockets = { connect: null };
+
+export function connect(options) {
+  return sockets.connect(options);
+}